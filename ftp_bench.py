@@ -0,0 +1,518 @@
+"""
+ftp_bench.py
+BENCHMARKS FOR ftp_server.py / ftp_client.py
+"""
+
+""" load libraries """
+import socket
+import os
+import sys
+import time
+import getopt
+import tempfile
+import json
+import shutil
+import statistics
+import subprocess
+import contextlib
+import random
+from threading import Thread
+
+import ftp_server
+import ftp_client
+import ftp_protocol
+
+""" configuration """
+BENCH_FILE_SIZE = 512 * 1024 * 1024 # 512MB
+BENCH_WINDOW = 8
+FRAMING_MSG_SIZES = (1024, 2048000, 64 * 1024 * 1024) # 1KB, 2MB, 64MB
+FRAMING_MAX_MSGS = 100000
+TRANSFER_SIZES = (1024 * 1024, 16 * 1024 * 1024, 128 * 1024 * 1024) # 1MB, 16MB, 128MB ; capped at -s
+TRANSFER_REPEAT = 3 # median of
+LATENCY_ROUNDS = 200
+LATENCY_DIR_ENTRIES = 100
+CONCURRENCY = (1, 10, 100)
+CONCURRENT_FILE_SIZE = 8 * 1024 * 1024 # 8MB per client
+SYNC_FILE_SIZE = 64 * 1024 * 1024 # 64MB ; capped at -s
+SYNC_EDITS = 100 # edited spots of the overwrite and insert cases
+UPLOAD_SIZES = (4 * 1024, 64 * 1024) # small files of the uploads bench
+UPLOAD_COUNT = 200 # files put per size and durability
+DURABILITIES = ('none', 'file', 'dir')
+BENCH_ID, BENCH_PW = 'admin', 'adminpw'
+SERVER_ENGINE = 'thread'
+SERVER_WORKERS = 1 # server processes of the loopback benches
+
+
+""" helpers """
+def make_file(size, dir_path=None):
+    # random head repeated ; page-cache resident after writing
+    f = tempfile.NamedTemporaryFile(dir=dir_path, delete=False)
+    chunk = os.urandom(1024 * 1024)
+    written = 0
+    while written < size:
+        f.write(chunk[:size - written])
+        written = written + len(chunk)
+    f.close()
+    return f.name
+
+def quiet():
+    # client progress and messages off while timing
+    return contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+def drain_get(conn, result):
+    # client side of a get ; recv blocks and ack them
+    cli = ftp_client.Client()
+    cli.attach(conn)
+    recved, nbytes = 0, 0
+    while True:
+        mt, m = cli.recv()
+        if not m:
+            break
+        recved = recved + 1
+        nbytes = nbytes + len(m)
+        cli.send(ftp_client.MsgToSend.GET_PROCEED, str(recved))
+    result['bytes'] = nbytes
+
+
+""" sendfile : cpu per GB of the server get path """
+def bench_sendfile(size):
+
+    file_path = make_file(size)
+    results = []
+    try:
+        for use_sendfile in (False, True):
+            srv_conn, cli_conn = socket.socketpair()
+            th = ftp_server.ClientThread(srv_conn, 'bench', 0)
+            th.window = BENCH_WINDOW
+            th.use_sendfile = use_sendfile
+
+            result = {}
+            drainer = Thread(target=drain_get, args=(cli_conn, result))
+            drainer.start()
+
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time() # this thread only ; sendfile time is system time
+            with open(file_path, 'rb') as f:
+                th.send_file_blocks(f)
+            cpu_s = time.thread_time() - cpu_start
+            drainer.join()
+            wall_s = time.perf_counter() - wall_start
+
+            srv_conn.close()
+            cli_conn.close()
+
+            gb = result['bytes'] / 1e9
+            results.append({
+                'mode': 'sendfile' if use_sendfile else 'read+send',
+                'bytes': result['bytes'],
+                'cpu_s_per_gb': round(cpu_s / gb, 4),
+                'mb_per_s': round(result['bytes'] / 1e6 / wall_s, 1),
+            })
+    finally:
+        os.remove(file_path)
+
+    for r in results:
+        print('[BENCH] get {:>10}   {:8.4f} cpu-s/GB   {:8.1f} MB/s'
+              .format(r['mode'], r['cpu_s_per_gb'], r['mb_per_s']))
+    return results
+
+
+""" framing : recv of 1KB / 2MB / 64MB messages """
+def legacy_read_frame(conn, pending):
+    # concatenating reader FrameReader replaced ; asks for 10MB on every call
+    recv_binary = pending
+    msg_len = -1
+    while True:
+        if len(recv_binary) >= 10:
+            msg_len = int(recv_binary[2:10])
+            if len(recv_binary) >= msg_len:
+                break
+        recv_binary = recv_binary + conn.recv(10240000)
+    return recv_binary[12:msg_len], recv_binary[msg_len:]
+
+def send_frames(conn, frame, count):
+    for _ in range(count):
+        conn.sendall(frame)
+
+def bench_framing(size):
+
+    results = []
+    for msg_size in FRAMING_MSG_SIZES:
+        count = max(4, min(FRAMING_MAX_MSGS, size // msg_size))
+        body = os.urandom(msg_size)
+        for reader_name in ('concat', 'recv_into', 'recv_into v2'):
+            proto = 2 if reader_name.endswith('v2') else 1
+            frame = ftp_protocol.pack_header(b'dg', proto, 16, msg_size) + body
+            srv_conn, cli_conn = socket.socketpair()
+            sender = Thread(target=send_frames, args=(srv_conn, frame, count))
+            sender.start()
+
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            if reader_name == 'concat':
+                pending = b''
+                for _ in range(count):
+                    data, pending = legacy_read_frame(cli_conn, pending)
+                    assert len(data) == msg_size
+            else:
+                reader = ftp_protocol.FrameReader(cli_conn)
+                reader.proto = proto
+                for _ in range(count):
+                    _, _, _, data = reader.read_frame()
+                    assert len(data) == msg_size
+            cpu_s = time.thread_time() - cpu_start
+            wall_s = time.perf_counter() - wall_start
+            sender.join()
+            srv_conn.close()
+            cli_conn.close()
+
+            results.append({
+                'reader': reader_name,
+                'msg_size': msg_size,
+                'msgs': count,
+                'us_per_msg': round(wall_s / count * 1e6, 2),
+                'cpu_s_per_gb': round(cpu_s / (count * msg_size / 1e9), 4),
+                'mb_per_s': round(count * msg_size / 1e6 / wall_s, 1),
+            })
+
+    for r in results:
+        print('[BENCH] recv {:>12} {:>10}B   {:10.2f} us/msg   {:8.4f} cpu-s/GB   {:8.1f} MB/s'
+              .format(r['reader'], r['msg_size'], r['us_per_msg'], r['cpu_s_per_gb'], r['mb_per_s']))
+    return results
+
+
+""" loopback : ftp_server.py in a subprocess, driven through Client.run_command """
+class LoopbackServer():
+
+    def __init__(self, engine=None, args=()):
+        self.engine = engine or SERVER_ENGINE
+        self.args = list(args) + (['--workers={}'.format(SERVER_WORKERS)] if SERVER_WORKERS > 1 else [])
+        self.home = tempfile.mkdtemp(prefix='sftp-bench-')
+        self.proc = None
+        self.port = None
+
+    def __enter__(self):
+        # a free port, then the server with its own HOME (auth.csv, served files)
+        soc = socket.socket()
+        soc.bind(('127.0.0.1', 0))
+        self.port = soc.getsockname()[1]
+        soc.close()
+        server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ftp_server.py')
+        self.proc = subprocess.Popen(
+            [sys.executable, server_path, '--engine=' + self.engine] + self.args + [str(self.port)],
+            env=dict(os.environ, HOME=self.home),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc):
+        # SIGTERM ; a server with workers stops them first
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    def client(self, local_dir):
+        cli = ftp_client.Client()
+        cli.login('127.0.0.1', self.port, BENCH_ID, BENCH_PW)
+        cli.pwd = local_dir
+        return cli
+
+def timed(cli, *cmd):
+    start_time = time.perf_counter()
+    cli.run_command(*cmd)
+    return time.perf_counter() - start_time
+
+def bench_transfer(size):
+
+    results = []
+    sizes = sorted(set(min(file_size, size) for file_size in TRANSFER_SIZES))
+    with LoopbackServer() as server:
+        local_dir = tempfile.mkdtemp(prefix='sftp-bench-cli-')
+        cli = server.client(local_dir)
+        try:
+            for file_size in sizes:
+                name = 'bench-{}'.format(file_size)
+                os.rename(make_file(file_size, server.home), os.path.join(server.home, name))
+                os.rename(make_file(file_size, local_dir), os.path.join(local_dir, name))
+                for op in ('get', 'put'):
+                    times = []
+                    with quiet():
+                        for _ in range(TRANSFER_REPEAT):
+                            times.append(timed(cli, op, name, None))
+                    results.append({
+                        'op': op,
+                        'bytes': file_size,
+                        'window': cli.window,
+                        'streams': len(ftp_client.split_ranges(file_size, cli.streams, cli.block_size))
+                                   if cli.segments else 1,
+                        'mb_per_s': round(file_size / 1e6 / statistics.median(times), 1),
+                    })
+                os.remove(os.path.join(server.home, name))
+                os.remove(os.path.join(local_dir, name))
+        finally:
+            cli.end_session()
+            shutil.rmtree(local_dir, ignore_errors=True)
+
+    for r in results:
+        print('[BENCH] {} {:>10}B   window {:>2}   streams {}   {:8.1f} MB/s'
+              .format(r['op'], r['bytes'], r['window'], r['streams'], r['mb_per_s']))
+    return results
+
+def bench_latency(size):
+
+    results = []
+    with LoopbackServer() as server:
+        os.mkdir(os.path.join(server.home, 'sub'))
+        for idx in range(LATENCY_DIR_ENTRIES):
+            open(os.path.join(server.home, 'sub', 'f{}'.format(idx)), 'w').close()
+        local_dir = tempfile.mkdtemp(prefix='sftp-bench-cli-')
+        cli = server.client(local_dir)
+        try:
+            for cmds in ((('cd', 'sub', None), ('cd', '..', None)),
+                         (('pwd', None, None),),
+                         (('ls', 'sub', None),)):
+                times = []
+                with quiet():
+                    for idx in range(LATENCY_ROUNDS):
+                        times.append(timed(cli, *cmds[idx % len(cmds)]) * 1000)
+                results.append({
+                    'cmd': cmds[0][0],
+                    'rounds': LATENCY_ROUNDS,
+                    'mean_ms': round(statistics.mean(times), 3),
+                    'p50_ms': round(percentile(times, 50), 3),
+                    'p99_ms': round(percentile(times, 99), 3),
+                })
+        finally:
+            cli.end_session()
+            shutil.rmtree(local_dir, ignore_errors=True)
+
+    for r in results:
+        print('[BENCH] {:>4}   mean {:8.3f} ms   p50 {:8.3f} ms   p99 {:8.3f} ms'
+              .format(r['cmd'], r['mean_ms'], r['p50_ms'], r['p99_ms']))
+    return results
+
+def bench_concurrency(size):
+
+    results = []
+    file_size = min(CONCURRENT_FILE_SIZE, size)
+    with LoopbackServer() as server:
+        os.rename(make_file(file_size, server.home), os.path.join(server.home, 'bench'))
+        for num_clients in CONCURRENCY:
+            local_dirs = [tempfile.mkdtemp(prefix='sftp-bench-cli-') for _ in range(num_clients)]
+            errors = []
+            def run_client(local_dir):
+                try:
+                    cli = server.client(local_dir)
+                    cli.run_command('get', 'bench', None)
+                    cli.end_session()
+                    if os.path.getsize(os.path.join(local_dir, 'bench')) != file_size:
+                        errors.append(local_dir)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [Thread(target=run_client, args=(local_dir,)) for local_dir in local_dirs]
+            with quiet():
+                wall_start = time.perf_counter()
+                for th in threads:
+                    th.start()
+                for th in threads:
+                    th.join()
+                wall_s = time.perf_counter() - wall_start
+            for local_dir in local_dirs:
+                shutil.rmtree(local_dir, ignore_errors=True)
+
+            results.append({
+                'clients': num_clients,
+                'engine': server.engine,
+                'workers': SERVER_WORKERS,
+                'bytes_per_client': file_size,
+                'errors': len(errors),
+                'wall_s': round(wall_s, 3),
+                'mb_per_s': round(num_clients * file_size / 1e6 / wall_s, 1),
+            })
+
+    for r in results:
+        print('[BENCH] {:>3} clients ({})   {:8.3f} s   {:8.1f} MB/s aggregate   {} errors'
+              .format(r['clients'], r['engine'], r['wall_s'], r['mb_per_s'], r['errors']))
+    return results
+
+
+""" sync : delta get/put of edited copies against a full get/put """
+def edit_copy(data, case, rand):
+    # the new version of data ; about 1% changed
+    if case == 'unchanged':
+        return data
+    if case == 'append':
+        return data + os.urandom(len(data) // 100)
+    edited = bytearray(data)
+    span = len(data) // 100 // SYNC_EDITS
+    for _ in range(SYNC_EDITS):
+        pos = rand.randrange(len(edited))
+        if case == 'overwrite': # same length ; blocks stay aligned
+            edited[pos:pos + span] = os.urandom(span)
+        else: # 'insert' ; shifts everything after it
+            edited[pos:pos] = os.urandom(rand.randrange(1, 100))
+    return bytes(edited)
+
+def bench_sync(size):
+
+    results = []
+    file_size = min(size, SYNC_FILE_SIZE)
+    rand = random.Random(0)
+    data = os.urandom(file_size)
+    with LoopbackServer() as server:
+        local_dir = tempfile.mkdtemp(prefix='sftp-bench-cli-')
+        cli = server.client(local_dir)
+        remote_path, local_path = os.path.join(server.home, 'sync.bin'), os.path.join(local_dir, 'sync.bin')
+        try:
+            for case in ('unchanged', 'overwrite', 'insert', 'append'):
+                edited = edit_copy(data, case, rand)
+                for op in ('get', 'put'):
+                    # the receiver holds the old version, the sender the edited one
+                    old_path, new_path = (local_path, remote_path) if op == 'get' else (remote_path, local_path)
+                    times = {}
+                    with quiet():
+                        for mode in ('full', 'sync'):
+                            with open(old_path, 'wb') as f:
+                                f.write(data)
+                            with open(new_path, 'wb') as f:
+                                f.write(edited)
+                            start_time = time.perf_counter()
+                            if mode == 'full':
+                                cli.run_command(op, 'sync.bin', None)
+                            elif op == 'get':
+                                literal, copied = cli.sync_get('sync.bin', None)
+                            else:
+                                literal, copied = cli.sync_put('sync.bin', None)
+                            times[mode] = time.perf_counter() - start_time
+                            cli.run_command('pwd', None, None) # a plain put is renamed after its last ack
+                            with open(old_path, 'rb') as f:
+                                if f.read() != edited:
+                                    raise AssertionError('{} {} {} : wrong result'.format(case, mode, op))
+                    results.append({
+                        'op': op,
+                        'edit': case,
+                        'bytes': len(edited),
+                        'sent_bytes': literal,
+                        'full_s': round(times['full'], 3),
+                        'sync_s': round(times['sync'], 3),
+                        # links slower than this favour sync : size / B > sync_s + sent / B
+                        'break_even_mb_per_s': round((len(edited) - literal) / 1e6 / times['sync'], 1),
+                    })
+        finally:
+            cli.end_session()
+            shutil.rmtree(local_dir, ignore_errors=True)
+
+    for r in results:
+        print('[BENCH] sync {} {:<9}  {:>10}B   sent {:>10}B ({:5.2f}%)   full {:7.3f}s   sync {:7.3f}s'
+              '   sync wins below {:6.1f} MB/s'
+              .format(r['op'], r['edit'], r['bytes'], r['sent_bytes'], 100.0 * r['sent_bytes'] / r['bytes'],
+                      r['full_s'], r['sync_s'], r['break_even_mb_per_s']))
+    return results
+
+def bench_uploads(size):
+
+    # puts of small files, where the commit (rename, fsync) is most of the cost
+    results = []
+    for durability in DURABILITIES:
+        with LoopbackServer(args=['--durability=' + durability]) as server:
+            local_dir = tempfile.mkdtemp(prefix='sftp-bench-cli-')
+            cli = server.client(local_dir)
+            try:
+                for file_size in UPLOAD_SIZES:
+                    name = 'bench-{}'.format(file_size)
+                    os.rename(make_file(file_size, local_dir), os.path.join(local_dir, name))
+                    with quiet():
+                        start_time = time.perf_counter()
+                        for _ in range(UPLOAD_COUNT):
+                            cli.run_command('put', name, None)
+                        elapsed = time.perf_counter() - start_time
+                    results.append({
+                        'durability': durability,
+                        'bytes': file_size,
+                        'uploads': UPLOAD_COUNT,
+                        'uploads_per_s': round(UPLOAD_COUNT / elapsed, 1),
+                        'ms_per_upload': round(elapsed / UPLOAD_COUNT * 1000, 3),
+                    })
+                    os.remove(os.path.join(local_dir, name))
+            finally:
+                cli.end_session()
+                shutil.rmtree(local_dir, ignore_errors=True)
+
+    for r in results:
+        print('[BENCH] put {:>8}B   durability {:<4}   {:8.1f} uploads/s   {:8.3f} ms/upload'
+              .format(r['bytes'], r['durability'], r['uploads_per_s'], r['ms_per_upload']))
+    return results
+
+""" main """
+BENCHES = {
+    'sendfile': bench_sendfile,
+    'framing': bench_framing,
+    'transfer': bench_transfer,
+    'latency': bench_latency,
+    'concurrency': bench_concurrency,
+    'sync': bench_sync,
+    'uploads': bench_uploads,
+}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+if __name__ == "__main__":
+
+    size = BENCH_FILE_SIZE
+    output_path = None
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 's:o:e:w:')
+        for opt, val in opts:
+            if opt == '-s': # file size in MB
+                size = int(val) * 1024 * 1024
+            elif opt == '-o': # results as JSON
+                output_path = val
+            elif opt == '-e': # server engine of the loopback benches
+                if val not in ('thread', 'asyncio'):
+                    raise ValueError(val)
+                SERVER_ENGINE = val
+            elif opt == '-w': # server processes (--workers) of the loopback benches
+                SERVER_WORKERS = max(1, int(val))
+        names = args if args else list(BENCHES)
+        for name in names:
+            BENCHES[name]
+    except Exception:
+        print('usage: python3 ftp_bench.py [-s SIZE_MB] [-e thread|asyncio] [-w WORKERS] [-o RESULTS.json] [{}]'
+              .format('|'.join(BENCHES)))
+        sys.exit(2)
+
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'size': size,
+        'engine': SERVER_ENGINE,
+        'workers': SERVER_WORKERS,
+        'results': {},
+    }
+    for name in names:
+        report['results'][name] = BENCHES[name](size)
+
+    if output_path:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('[BENCH] results written to {}'.format(output_path))
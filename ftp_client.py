@@ -15,6 +15,18 @@ import getpass
 import random
 import traceback
 import warnings
+import getopt
+import signal
+import collections
+import math
+import json
+import queue
+from threading import Thread, Event, Lock
+from ftp_protocol import (DATA_BLOCK_SIZE, DATA_BLOCK_SIZE_V2, SFTP_DISCRIMINATOR_TOKEN, PARTIAL_SUFFIX, DIGESTS,
+                          TREE_INLINE_SIZE, parse_options, format_options, set_nodelay, pack_fields, unpack_fields,
+                          partial_name, resume_offset, preallocate, tree_frames, TreeWriter, sync_block_size,
+                          signature_frames, read_signatures, delta_frames, DeltaWriter, new_digest, hash_range,
+                          CODECS, compress_block, decompress_block, pack_header, FrameReader)
 
 """ configuration """
 warnings.filterwarnings("ignore")
@@ -23,9 +35,23 @@ SOCKET_TIMEOUT = 10
 
 """ global variables """
 CONN = None
-CONN_BUFFER_SIZE = 10240000 # 10MB
-DATA_BLOCK_SIZE = 2048000 # 2MB
-SFTP_DISCRIMINATOR_TOKEN = b'dg'
+TRANSFER_WINDOW = 8 # blocks in flight asked to the server
+TRANSFER_STREAMS = 4 # connections of a parallel get/put
+MIN_SEGMENT_SIZE = 64 * 1024 * 1024 # 64MB ; smaller files use fewer streams
+METER_INTERVAL = 1.0 # seconds between progress updates of a get/put
+METER_EWMA_SEC = 5.0 # time constant of the rate shown ; the average is shown next to it
+MUX_BLOCK_SIZE = TREE_INLINE_SIZE + 65536 # put blocks of a background transfer, interleaved with the other streams ;
+                                          # a tree batch still holds one inline file, its record and path
+PIPELINE_DEPTH = 16 # gets of a batch sent ahead of the running one
+EXIT_OK = 0 # exit codes of a batch
+EXIT_COMMAND_FAILED = 1 # a command failed ; the rest of the batch is skipped
+EXIT_BAD_SCRIPT = 2 # unreadable script or invalid command ; nothing ran
+EXIT_CONNECT_FAILED = 3 # connection, login or session lost
+CMD_FLAGS = { # flags right after a command ; flag -> (option name, takes a number)
+    'get': {'-P': ('streams', True), '-r': ('recursive', False)},
+    'put': {'-P': ('streams', True), '-r': ('recursive', False)},
+    'ls': {'-l': ('long', False), '-o': ('offset', True), '-n': ('count', True)},
+}
 
 """ MSGTYPE ; Exactly opposite with server msg """
 @enum.unique
@@ -54,6 +80,12 @@ class MsgToRecv(enum.Enum):
     PUT_SUCCESS =  enum.auto()
     PUT_FAILURE =  enum.auto()
     EXIT_SUCCESS = enum.auto()  # 24 exit
+    COMMIT_SUCCESS = enum.auto() # 25 commit of a parallel put
+    COMMIT_FAILURE = enum.auto()
+    SYNC_SIG = enum.auto()      # 27 block signatures of a sync put
+    CHECKSUM_PATHERR = enum.auto() # 28 checksum
+    CHECKSUM_SUCCESS = enum.auto()
+    SERVER_BUSY = enum.auto()   # 30 no session or transfer slot free
 
 @enum.unique
 class MsgToSend(enum.Enum):
@@ -75,70 +107,256 @@ class MsgToSend(enum.Enum):
     PUT_PROCEED = enum.auto()   # 15 put
     PUT_STOP = enum.auto()
     PUT_DATA = enum.auto()
+    CMD_COMMIT = enum.auto()    # 18 commit of a parallel put
+    CMD_GET_TREE = enum.auto()  # 19 get -r
+    CMD_PUT_TREE = enum.auto()  # 20 put -r
+    CMD_SYNC_GET = enum.auto()  # 21 sync
+    CMD_SYNC_PUT = enum.auto()
+    SYNC_SIG = enum.auto()      # 23 block signatures of a sync get
+    CMD_CHECKSUM = enum.auto()  # 24 checksum
+    PUT_DIGEST = enum.auto()    # 25 digest of the blocks of a put
+
+""" parallel transfers ; byte ranges written in place """
+def split_ranges(size, streams, block_size):
+    # contiguous block-aligned (offset, length) ranges ; at least MIN_SEGMENT_SIZE each
+    streams = max(1, min(streams, size // MIN_SEGMENT_SIZE))
+    step = -(-size // streams)
+    step = max(1, -(-step // block_size)) * block_size
+    return [(offset, min(step, size - offset)) for offset in range(0, size, step)]
+
+""" transfer meter ; progress line and report of one get/put """
+class TransferMeter():
+
+    # bytes moved on the monotonic clock. The rate shown is an EWMA over METER_EWMA_SEC,
+    # next to the average ; the ETA follows from the announced size. Puts also time each
+    # block from its send to its ack.
+    def __init__(self, op, name, size=None, offset=0, window=1, streams=1, quiet=False):
+        self.op = op
+        self.name = name
+        self.size = size # of the whole file ; None for trees and deltas
+        self.offset = offset # bytes a resumed transfer did not move
+        self.window = window
+        self.streams = streams
+        self.nbytes = 0
+        self.started_at = time.time()
+        self.start = time.monotonic()
+        self.end = None
+        self.last, self.last_bytes = self.start, 0
+        self.ewma = None # bytes/s
+        self.rtts = [] # seconds, of the blocks acked
+        self.quiet = quiet # a background transfer ; its line is shown by 'jobs'
+
+    def add(self, nbytes):
+        self.nbytes = self.nbytes + nbytes
+        self.tick()
+
+    def set(self, nbytes):
+        # parallel transfers ; the sum of their ranges
+        self.nbytes = nbytes
+        self.tick()
+
+    def tick(self, final=False):
+        now = time.monotonic()
+        delta_s = now - self.last
+        if delta_s < METER_INTERVAL and not final:
+            return
+        if delta_s > 0:
+            rate = (self.nbytes - self.last_bytes) / delta_s
+            weight = 1 - math.exp(-delta_s / METER_EWMA_SEC)
+            self.ewma = rate if self.ewma is None else self.ewma + weight * (rate - self.ewma)
+        self.last, self.last_bytes = now, self.nbytes
+        if final:
+            self.end = now
+        self.show()
+
+    def elapsed(self):
+        return (self.end or time.monotonic()) - self.start
+
+    def average(self):
+        elapsed_s = self.elapsed()
+        return self.nbytes / elapsed_s if elapsed_s > 0 else 0.0
+
+    def eta(self):
+        if self.size is None or not self.ewma:
+            return None
+        return max(0, self.size - self.offset - self.nbytes) / self.ewma
+
+    def show(self):
+        if self.quiet:
+            return
+        sys.stdout.write('%s\r' % self.line())
+        sys.stdout.flush()
+
+    def line(self):
+        parts = [self.name, '{}s'.format(int(self.elapsed())), '{:.2f}MB'.format((self.offset + self.nbytes) / 1e6)]
+        if self.size:
+            parts.append('{:.0f}%'.format(100.0 * (self.offset + self.nbytes) / self.size))
+        parts.append('{:.2f}MB/s (avg {:.2f})'.format((self.ewma or 0.0) / 1e6, self.average() / 1e6))
+        eta = self.eta()
+        if eta is not None and self.end is None:
+            parts.append('ETA {}s'.format(int(math.ceil(eta))))
+        parts.append('window {}'.format(self.window))
+        if self.streams > 1:
+            parts.append('streams {}'.format(self.streams))
+        return '   '.join(parts)
+
+    def report(self, success):
+        rtts_ms = sorted(rtt * 1000 for rtt in self.rtts)
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started_at)),
+            'op': self.op,
+            'name': self.name,
+            'result': 'ok' if success else 'failed',
+            'bytes': self.nbytes,
+            'size': self.size,
+            'resumed_from': self.offset,
+            'duration_s': round(self.elapsed(), 6),
+            'mb_per_s': round(self.average() / 1e6, 3),
+            'window': self.window,
+            'streams': self.streams,
+            'block_rtt_ms': {
+                'count': len(rtts_ms),
+                'mean': round(sum(rtts_ms) / len(rtts_ms), 3),
+                'p50': round(rtts_ms[len(rtts_ms) // 2], 3),
+                'p99': round(rtts_ms[min(len(rtts_ms) - 1, int(len(rtts_ms) * 0.99))], 3),
+                'max': round(rtts_ms[-1], 3),
+            } if rtts_ms else None,
+        }
 
 
 class Client():
 
-    def __init__(self):
+    def __init__(self, window=TRANSFER_WINDOW, streams=TRANSFER_STREAMS, codecs='', report=None):
         self.conn = None
         self.ip = None
         self.port = None
         self.uid = None
+        self.password = None # kept to log in the connections of a parallel get/put
         self.pwd = os.path.abspath(os.getcwd())
 
-        self.conn_buffer_size = CONN_BUFFER_SIZE
         self.token = SFTP_DISCRIMINATOR_TOKEN
+        self.reader = None
+        self.stop_requested = False # Ctrl-C while a command runs
+        self.abort = None # Event shared by the connections of a parallel get/put
+
+        self.window_asked = window
+        self.window = 1 # blocks in flight ; 1 is stop-and-wait (old servers)
+        self.proto = 1
+        self.block_size = DATA_BLOCK_SIZE
+        self.resume = False # byte-offset restart of get/put
+        self.segments = False # byte ranges of a parallel get/put
+        self.streams = streams
+        self.ls2 = False # structured, paged listing
+        self.codecs_asked = codecs # 'zlib,lzma' ; offered in order, '' : off
+        self.codec = None # compression of GET_DATA/PUT_DATA blocks
+        self.compress_count = [0, 0] # raw, wire bytes of the blocks ; shared by parallel ranges
+        self.compress_lock = Lock()
+        self.tree = False # get/put -r
+        self.sync = False # delta sync get/put
+        self.digest = None # hash of get/put blocks, checked before the rename
+        self.alive = 0 # seconds between ALIVE_SIGNALs at an idle prompt ; 0 : off (old servers)
+        self.lock = Lock() # held while a command runs ; the keepalive thread pings only when it is free
+        self.server_closed = False # the server ended the session while the prompt waited
+        self.pipeline = False # the server holds commands sent before the previous one is done
+        self.pipelined = collections.deque() # remote paths of the gets sent ahead, oldest first
+        self.rtt1 = False # cd, ls and get answered in one round trip
+        self.report_path = report # JSON line per get/put appended to it ; None : off
+        self.meters = [] # of the command running
+        self.mux = 0 # background transfers the server runs at once on their own streams ; 0 : off
+        self.stream_id = 0 # of the frames this client sends and receives ; jobs have their own
+        self.inbox = None # frames of this stream, routed by the reader thread once a job runs
+        self.inboxes = {} # stream id -> inbox ; shared with the jobs
+        self.send_lock = Lock() # one frame at a time on the socket ; shared with the jobs
+        self.jobs = {} # stream id -> job running on it
+        self.failed_jobs = [] # stream ids of the jobs that failed
+        self.next_stream = 1
+        self.quiet = False # a job ; no progress line
+
+    def attach(self, conn):
+        self.conn = conn
+        self.reader = FrameReader(conn, self.token)
+
+    def read_frame(self):
+        # (msgtype, flags, stream_id, data) ; once a job runs, frames come through the inbox of their stream
+        if self.inbox is None:
+            return self.reader.read_frame()
+        frame = self.inbox.get()
+        if isinstance(frame, Exception): # the reader thread stopped ; every later read sees it too
+            self.inbox.put(frame)
+            raise frame
+        return frame
 
     def recv(self):
 
-        recv_binary = b''
-        msg_len = -1
-        firstMsgArrived = False
-        stop_raised = False
-
-        while True:
-            try:
-                recved = self.conn.recv(self.conn_buffer_size)
-                recv_binary = recv_binary + recved
-                if recv_binary[:2] != b'dg':
-                    return (MsgToRecv.GET_FAILURE, b'')
-            except KeyboardInterrupt:
-                stop_raised = True
-                flush = b'1'
-                while flush:
-                    flush = self.conn.recv(self.conn_buffer_size)
-                break
-            else:
-                if not firstMsgArrived:
-                    msg_len = int(recv_binary[2:10])
-                    firstMsgArrived = True
-                if len(recv_binary) == msg_len :
-                    break
-
-        if stop_raised:
-            raise KeyboardInterrupt
-
-        recv_msgtype = MsgToRecv(int(recv_binary[10:12]))
-        recv_data_bin = recv_binary[12:]
+        try:
+            msgtype, flags, stream_id, recv_data_bin = self.read_frame()
+            if self.codec is not None and msgtype == MsgToRecv.GET_DATA.value:
+                wire_len = len(recv_data_bin)
+                if flags: # compressed block
+                    recv_data_bin = decompress_block(flags, recv_data_bin)
+                self.count_block(len(recv_data_bin), wire_len)
+        except ValueError as e: # a bad token or block ; not the same as a refused transfer
+            print('Corrupted message from the server : {}'.format(e))
+            return (MsgToRecv.GET_FAILURE, b'')
+        except ConnectionError:
+            return (MsgToRecv.GET_FAILURE, b'')
+        recv_msgtype = MsgToRecv(msgtype)
+        if recv_msgtype == MsgToRecv.EXIT_SUCCESS: # the server ended the session, e.g. reaped when idle
+            self.disp_server_closed()
 
         return recv_msgtype, recv_data_bin  # (MsgToRecv, bytes)
 
-    def send(self, send_msgtype, send_data=''):
+    def send(self, send_msgtype, send_data='', flags=0):
 
-        send_msgtype_bin = str(send_msgtype.value).zfill(2).encode()
-        send_data_bin = send_data if type(send_data) is bytes \
+        send_data_bin = send_data if type(send_data) in (bytes, bytearray) \
                                     else send_data.encode()
-        send_binary = send_msgtype_bin + send_data_bin
-        send_len_bin = str(int(len(send_binary))+10).zfill(8).encode()
-        send_binary = self.token + send_len_bin + send_binary
+        header = pack_header(self.token, self.proto, send_msgtype.value, len(send_data_bin), flags,
+                             self.stream_id)
+
+        with self.send_lock:
+            if len(send_data_bin) < 65536: # one segment
+                self.conn.sendall(header + send_data_bin)
+            else: # no copy of the block
+                self.conn.sendall(header, getattr(socket, 'MSG_MORE', 0))
+                self.conn.sendall(send_data_bin)
+
+    def send_block(self, send_msgtype, data):
+        # a data block, compressed when the session has a codec and it pays off
+        if self.codec is None:
+            self.send(send_msgtype, data)
+            return
+        flags, payload = compress_block(self.codec, data)
+        self.send(send_msgtype, payload, flags)
+        self.count_block(len(data), len(payload))
+
+    def count_block(self, raw_len, wire_len):
+        with self.compress_lock:
+            self.compress_count[0] = self.compress_count[0] + raw_len
+            self.compress_count[1] = self.compress_count[1] + wire_len
+
+    def request_stop(self, signum, frame):
+        # SIGINT while a command runs ; stop at the next block boundary, so no
+        # message is cut in half. A second Ctrl-C stops right away.
+        if self.stop_requested:
+            raise KeyboardInterrupt
+        self.stop_requested = True
 
-        try:
-            self.conn.send(send_binary)
-        except KeyboardInterrupt:
-            self.conn.send(send_binary)
+    def check_stop(self):
+        if self.stop_requested or (self.abort is not None and self.abort.is_set()):
+            self.stop_requested = False
             raise KeyboardInterrupt
 
-    def close(self, ever_connected):
+    def recv_until(self, *msgtypes):
+        # skip blocks still in flight after a stop
+        while True:
+            try:
+                msgtype, flags, stream_id, m = self.read_frame()
+            except (ValueError, ConnectionError):
+                return (MsgToRecv.GET_FAILURE, b'')
+            if MsgToRecv(msgtype) in msgtypes:
+                return MsgToRecv(msgtype), m
+
+    def close(self, ever_connected, code=EXIT_OK):
         try:
             self.send(MsgToSend.CMD_EXIT)
         except:
@@ -148,9 +366,49 @@ class Client():
             # exit
             if ever_connected:
                 print('Connection closed.')
-            sys.exit(0)
+            sys.exit(code)
         return
 
+    def end_session(self):
+        # a connection of a parallel get/put ; the main one ends with close()
+        try:
+            self.send(MsgToSend.CMD_EXIT)
+        except:
+            pass
+        self.conn.close()
+
+    def say_hi(self):
+        # session options ; old servers ignore them
+        offered = {'window': self.window_asked, 'proto': 2, 'resume': '', 'segments': '', 'ls2': '',
+                   'tree': '', 'sync': '', 'digest': ','.join(DIGESTS), 'busy': '', 'alive': '',
+                   'pipeline': '', 'rtt1': '', 'mux': ''}
+        if self.codecs_asked:
+            offered['compress'] = self.codecs_asked
+        self.send(MsgToSend.AUTH_HI, 'hi' + format_options(offered))
+        (mt, m) = self.recv()
+        if mt == MsgToRecv.SERVER_BUSY: # every session slot taken
+            raise ConnectionRefusedError('server busy')
+        options = parse_options(m.decode())
+        if options:
+            set_nodelay(self.conn)
+        if options.get('window', '').isdigit():
+            self.window = max(1, int(options['window']))
+        if options.get('proto') == '2': # every later message uses the v2 header
+            self.proto = 2
+            self.reader.proto = 2
+            self.block_size = DATA_BLOCK_SIZE_V2
+        self.resume = 'resume' in options
+        self.segments = 'segments' in options
+        self.ls2 = 'ls2' in options
+        self.codec = options.get('compress') if options.get('compress') in CODECS else None
+        self.tree = 'tree' in options
+        self.sync = 'sync' in options
+        self.digest = options.get('digest') if options.get('digest') in DIGESTS else None
+        self.alive = int(options['alive']) if options.get('alive', '').isdigit() else 0
+        self.pipeline = 'pipeline' in options
+        self.rtt1 = 'rtt1' in options
+        self.mux = int(options['mux']) if options.get('mux', '').isdigit() else 0
+
     def connect(self, user, ip, port):
         # connect to port
         try:
@@ -158,10 +416,12 @@ class Client():
         except:
             print('ssh: Could not connect to {} {} {}'.format(self.uid, self.ip, self.port))
             return False, False
-        # say hi
+        # say hi (with session options)
         try:
-            self.send(MsgToSend.AUTH_HI, 'hi')
-            (_, _) = self.recv()
+            self.say_hi()
+        except ConnectionRefusedError as e :
+            print('ssh: connect to {} {} port {}: Server busy, try again later'.format(self.uid, self.ip, self.port))
+            return False, True
         except Exception as e :
             print('ssh: connect to {} {} port {}: Connection refused'.format(self.uid, self.ip, self.port))
             return False, True
@@ -180,12 +440,41 @@ class Client():
                 continue
             elif m1t == MsgToRecv.AUTH_SUCCESS :
                 print('Connected to {}@{}'.format(self.uid, self.ip))
+                self.password = pw
                 break
 
+    def login(self, ip, port, uid, pw):
+        # non-interactive connect and authenticate ; raises when refused
+        self.ip, self.port, self.uid = ip, port, uid
+        self.attach(socket.create_connection((ip, port)))
+        try:
+            self.say_hi()
+            self.send(MsgToSend.AUTH_ID, uid)
+            _, _ = self.recv()
+            self.send(MsgToSend.AUTH_PW, pw)
+            m1t, _ = self.recv()
+            if m1t != MsgToRecv.AUTH_SUCCESS:
+                raise ConnectionError('authentication failed')
+        except:
+            self.conn.close()
+            raise
+        self.password = pw
+
+    def open_session(self):
+        # one more connection, logged in as this one ; carries a range of a parallel get/put
+        sub = Client(self.window_asked, self.streams, self.codecs_asked)
+        sub.abort = self.abort
+        sub.compress_count, sub.compress_lock = self.compress_count, self.compress_lock
+        sub.login(self.ip, self.port, self.uid, self.password)
+        if not sub.segments:
+            sub.end_session()
+            raise ConnectionError('session refused')
+        return sub
+
     def argparse(self, cmd_str):
 
         isValid = True
-        result = [None, None, None] # cmd1, cmd2, cmd3
+        result = [None, None, None, {}] # cmd1, cmd2, cmd3, options
 
         # change '\ ' to '\n' temporarily
         cmd_str = cmd_str.replace('\ ', '\n')
@@ -201,6 +490,24 @@ class Client():
             else:
                 pass
 
+        # '&' at the end runs a transfer in the background
+        if len(cmd_ls) >= 2 and cmd_ls[-1] == '&' and cmd_ls[0] in ('get', 'put', 'sync'):
+            result[3]['background'] = True
+            del cmd_ls[-1]
+
+        # command flags
+        flags = CMD_FLAGS.get(cmd_ls[0], {}) if len(cmd_ls) > 0 else {}
+        while len(cmd_ls) >= 2 and cmd_ls[1] in flags:
+            name, takes_number = flags[cmd_ls[1]]
+            if not takes_number:
+                result[3][name] = True
+                del cmd_ls[1]
+                continue
+            if len(cmd_ls) < 3 or not cmd_ls[2].isdigit():
+                return False, result
+            result[3][name] = int(cmd_ls[2])
+            del cmd_ls[1:3]
+
         # arg check
         if len(cmd_ls) == 0:
             isValid = False
@@ -230,6 +537,19 @@ class Client():
             result[1] = cmd_ls[1]
             if len(cmd_ls) == 3 :
                 result[2] = cmd_ls[2]
+        elif cmd_ls[0] == 'sync' and len(cmd_ls) in (3, 4) and cmd_ls[1] in ('get', 'put'):
+            result[0] = cmd_ls[0]
+            result[1] = cmd_ls[2]
+            if len(cmd_ls) == 4 :
+                result[2] = cmd_ls[3]
+            result[3]['direction'] = cmd_ls[1]
+        elif cmd_ls[0] == 'checksum' and len(cmd_ls) in (2, 3):
+            result[0] = cmd_ls[0]
+            result[1] = cmd_ls[1]
+            if len(cmd_ls) == 3 :
+                result[2] = cmd_ls[2]
+        elif cmd_ls[0] == 'jobs' and len(cmd_ls) == 1 :
+            result[0] = cmd_ls[0]
         elif cmd_ls[0] == 'exit' and len(cmd_ls) >= 1 :
             result[0] = cmd_ls[0]
         else:
@@ -252,70 +572,727 @@ class Client():
     def get_absolute_path(self, path_str):
         return os.path.realpath(self.absolutify(path_str))
 
-    def stats(self, recent_time, uptime, upspeed, data_size): # (ms, ms, B/s, B)
+    def new_meter(self, op, name, size=None, offset=0, streams=1):
+        meter = TransferMeter(op, name, size, offset, self.window, streams, self.quiet)
+        self.meters.append(meter)
+        return meter
 
-        curr_mil = int(round(time.time() * 1000))
-        if curr_mil - recent_time <= 1000: # less than 1sec
-            return (False, None, None)
+    def write_reports(self, success):
+        if self.report_path is None or not self.meters:
+            return
+        try:
+            with open(self.report_path, 'a') as f:
+                for meter in self.meters:
+                    f.write(json.dumps(meter.report(success)) + '\n')
+        except OSError as e:
+            print('Report not written : {}'.format(e))
+
+    def disp_listing(self, records, long):
+        # records : (type, size, mtime_ns, name) ; sorted by name like ls
+        lines = []
+        for ftype, size, mtime, name in sorted(records, key=lambda record: record[3]):
+            if long:
+                mtime_str = time.strftime('%Y-%m-%d %H:%M', time.localtime(int(mtime) / 1e9))
+                lines.append('{} {:>12} {} {}\n'.format(ftype, size, mtime_str, name))
+            else:
+                lines.append(name + '\n')
+        sys.stdout.write(''.join(lines))
 
-        delta_time_s = (curr_mil - recent_time) / 1000.0
-        tot_size_B = (upspeed * uptime)/1000.0 + data_size
-        tot_time_s = (uptime + delta_time_s)/1000.0
-        Bps = tot_size_B / tot_time_s
-        return (True, delta_time_s/1000.0, Bps)
+    def disp_mismatch(self, file_name):
+        print('''Checksum mismatch ; "{}" discarded.'''.format(file_name))
 
-    def disp_mpbs(self, filename, uptime_ms, upbyte):
+    def disp_busy(self):
+        print('Server busy ; try again later.')
 
-        time_s = int(uptime_ms*1000.0)
-        upbyte_MB = round(upbyte/1000000.0 * 2.0, 2)
+    def disp_server_closed(self):
+        print('Connection closed by the server.')
+        self.conn.close()
+        sys.exit(EXIT_CONNECT_FAILED)
 
-        size_str = '{}   {}s   {}MB'.format(filename, time_s, upbyte_MB)
-        sys.stdout.write('%s\r' % size_str)
-        sys.stdout.flush()
+    def disp_delta(self, literal, copied):
+
+        total = literal + copied
+        print('''{} bytes sent, {} bytes matched ({:.1f}% of {} bytes reused)'''.format(
+            literal, copied, 100.0 * copied / total if total else 0.0, total))
+
+    def disp_compression(self):
+
+        raw, wire = self.compress_count
+        if self.codec is None or not raw:
+            return
+        print('Compression {} : {} -> {} bytes ({:.2f}x)'.format(self.codec, raw, wire, raw / max(1, wire)))
 
     def disp_flush(self):
+        if self.quiet: # no progress line to end
+            return
         print('')
         sys.stdout.flush()
 
+    def recv_blocks(self, write_block, meter=None):
+
+        # GET_DATA blocks until the empty one ; False on GET_FAILURE.
+        # Raises KeyboardInterrupt on a stop ; the caller sends GET_STOP.
+        recved = 0
+        while True:
+            m2t, m2 = self.recv()
+            if m2t == MsgToRecv.GET_FAILURE:
+                return False
+            if not m2:  # empty
+                if meter is not None:
+                    meter.tick(True)
+                return True
+            # stop before the ack ; the server never sends the empty block with one missing
+            self.check_stop()
+            write_block(m2)
+            if meter is not None:
+                meter.add(len(m2))
+            recved = recved + 1
+            # cumulative ack ; the server keeps self.window blocks in flight
+            self.send(MsgToSend.GET_PROCEED, str(recved))
+
+    def send_blocks(self, read_block, meter=None):
+
+        # PUT_DATA blocks until the empty one, the first go already received ; False on failure.
+        # Raises KeyboardInterrupt on a stop ; the caller sends PUT_STOP.
+        sent, proceeds = 0, 1  # PUT_PROCEED = first go + one ack per block
+        sent_times = collections.deque() # of the blocks not acked yet
+        while True:
+            self.check_stop()
+            data_frag_bin = read_block()
+            # keep self.window blocks in flight ; every block acked before the empty one
+            needed = sent + 2 - self.window if data_frag_bin else sent + 1
+            while proceeds < needed:
+                m2t, m2 = self.recv()
+                if m2t != MsgToRecv.PUT_PROCEED:
+                    return False
+                proceeds = proceeds + 1
+                if meter is not None:
+                    meter.rtts.append(time.monotonic() - sent_times.popleft())
+            self.send_block(MsgToSend.PUT_DATA, data_frag_bin)
+            sent = sent + 1
+            if not data_frag_bin:
+                if meter is not None:
+                    meter.tick(True)
+                return True
+            if meter is not None:
+                sent_times.append(time.monotonic())
+                meter.add(len(data_frag_bin))
+
+    """ parallel get/put ; one byte range per connection """
+    def run_segments(self, targets, done, meter):
+
+        # targets[i] runs range i in its own thread and returns True, False, 'stop', 'mismatch' or 'busy'.
+        # A stop or a failure in any range stops the others at their next block.
+        results = [None] * len(targets)
+        def run_segment(idx):
+            try:
+                results[idx] = targets[idx]()
+            except ConnectionRefusedError as e: # no session slot for the range
+                results[idx] = 'busy'
+            except Exception as e:
+                results[idx] = False
+
+        threads = [Thread(target=run_segment, args=(idx,)) for idx in range(len(targets))]
+        for th in threads:
+            th.start()
+        while any(th.is_alive() for th in threads):
+            try:
+                [th for th in threads if th.is_alive()][0].join(1.0)
+            except KeyboardInterrupt: # second Ctrl-C ; still wait for the ranges to stop
+                self.stop_requested = True
+            if self.stop_requested or any(r is not None and r is not True for r in results):
+                self.abort.set()
+            meter.set(sum(done))
+        meter.nbytes = sum(done) # the last blocks of the ranges
+        meter.tick(True)
+        self.disp_flush()
+        return results
+
+    def get_range(self, fd, offset, length, done, idx):
+        # range of a parallel get ; the GET_PROCEED with path, size and mtime was received
+        hasher = new_digest(self.digest) if self.digest else None # of this range
+        def write_block(data):
+            os.pwrite(fd, data, offset + done[idx])
+            if hasher is not None:
+                hasher.update(data)
+            done[idx] = done[idx] + len(data)
+
+        self.send(MsgToSend.GET_PROCEED, pack_fields(offset, length))
+        try:
+            recv_success = self.recv_blocks(write_block)
+        except KeyboardInterrupt:
+            self.send(MsgToSend.GET_STOP)
+            _, _ = self.recv_until(MsgToRecv.GET_FAILURE)
+            return 'stop'
+        except Exception as e:
+            self.send(MsgToSend.GET_STOP)
+            _, _ = self.recv_until(MsgToRecv.GET_FAILURE)
+            return False
+        if recv_success and hasher is not None: # the server's digest follows the empty block
+            m3t, m3 = self.recv()
+            if m3t != MsgToRecv.GET_SUCCESS or m3.decode() != hasher.hexdigest():
+                return 'mismatch'
+        return recv_success and done[idx] == length
+
+    def get_segment(self, file_addr, size, mtime, fd, offset, length, done, idx):
+        sub = self.open_session()
+        try:
+            sub.send(MsgToSend.CMD_GET, file_addr)
+            m1t, m1 = sub.recv()
+            if m1t == MsgToRecv.SERVER_BUSY:
+                return 'busy'
+            # the remote file must not have changed since the main connection saw it
+            if m1t != MsgToRecv.GET_PROCEED or unpack_fields(m1)[1:3] != [str(size), str(mtime)]:
+                return False
+            return sub.get_range(fd, offset, length, done, idx)
+        finally:
+            sub.end_session()
+
+    def get_segmented(self, file_addr, size, mtime, get_path, file_name, ranges):
+
+        # returns (recv_success, user_cancellation)
+        tmpfile_path = get_path + '.' + str(random.randint(10000000, 99999999))  # 8-digit number
+        try:
+            fd = os.open(tmpfile_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        except OSError:
+            self.send(MsgToSend.GET_STOP) # the server waits for the range
+            _, _ = self.recv()
+            return False, False
+        self.abort = Event()
+        try:
+            preallocate(fd, size)
+            done = [0] * len(ranges)
+            targets = [lambda: self.get_range(fd, ranges[0][0], ranges[0][1], done, 0)]
+            for idx in range(1, len(ranges)):
+                targets.append(lambda idx=idx: self.get_segment(
+                    file_addr, size, mtime, fd, ranges[idx][0], ranges[idx][1], done, idx))
+            results = self.run_segments(targets, done,
+                                        self.new_meter('get', file_addr, size, streams=len(ranges)))
+        except OSError:
+            self.send(MsgToSend.GET_STOP)
+            _, _ = self.recv()
+            results = [False]
+        finally:
+            os.close(fd)
+            self.abort = None
+
+        # every range complete ; the file appears at once
+        if all(r is True for r in results) and os.path.getsize(tmpfile_path) == size:
+            os.replace(tmpfile_path, get_path + file_name)
+            return True, False
+        os.remove(tmpfile_path)
+        if 'mismatch' in results:
+            self.disp_mismatch(file_name)
+            return False, True
+        if 'busy' in results:
+            self.disp_busy()
+            return False, True
+        return False, 'stop' in results and False not in results
+
+    def put_range(self, fd, offset, length, done, idx):
+        # range of a parallel put ; its first go was received
+        hasher = new_digest(self.digest) if self.digest else None # of this range
+        def read_block():
+            data = os.pread(fd, min(self.block_size, length - done[idx]), offset + done[idx])
+            if hasher is not None:
+                hasher.update(data)
+            done[idx] = done[idx] + len(data)
+            return data
+
+        try:
+            if not self.send_blocks(read_block):
+                return False
+            if hasher is not None:
+                self.send(MsgToSend.PUT_DIGEST, hasher.hexdigest())
+            m3t, m3 = self.recv()
+            if m3t == MsgToRecv.PUT_FAILURE and m3 == b'digest':
+                return 'mismatch'
+            return m3t == MsgToRecv.PUT_SUCCESS and done[idx] == length
+        except KeyboardInterrupt:
+            self.send(MsgToSend.PUT_STOP)
+            _, _ = self.recv_until(MsgToRecv.PUT_FAILURE)
+            return 'stop'
+        except Exception as e:
+            self.send(MsgToSend.PUT_STOP)
+            _, _ = self.recv_until(MsgToRecv.PUT_FAILURE)
+            return False
+
+    def put_segment(self, dir_str, fields, fd, offset, length, done, idx):
+        sub = self.open_session()
+        try:
+            sub.send(MsgToSend.CMD_PUT, dir_str)
+            m1t, m1 = sub.recv()
+            if m1t == MsgToRecv.SERVER_BUSY:
+                return 'busy'
+            if m1t != MsgToRecv.PUT_PROCEED:
+                return False
+            sub.send(MsgToSend.PUT_PROCEED, pack_fields(*fields[:3], offset, length, fields[3]))
+            m2t, m2 = sub.recv()
+            if m2t != MsgToRecv.PUT_PROCEED:
+                return False
+            return sub.put_range(fd, offset, length, done, idx)
+        finally:
+            sub.end_session()
+
+    def put_segmented(self, fd, dir_str, put_filename, st, ranges):
+
+        # returns (send_success, user_cancellation)
+        transfer_id = str(random.randint(10000000, 99999999))  # temp file '.' + id on the server
+        fields = (put_filename, st.st_size, st.st_mtime_ns, transfer_id)
+        # the range at offset 0 creates the temp file ; the others start once it got its go
+        self.send(MsgToSend.PUT_PROCEED,
+                  pack_fields(put_filename, st.st_size, st.st_mtime_ns, 0, ranges[0][1], transfer_id))
+        m2t, m2 = self.recv()
+        if m2t != MsgToRecv.PUT_PROCEED:
+            return False, False
+
+        self.abort = Event()
+        try:
+            done = [0] * len(ranges)
+            targets = [lambda: self.put_range(fd, 0, ranges[0][1], done, 0)]
+            for idx in range(1, len(ranges)):
+                targets.append(lambda idx=idx: self.put_segment(
+                    dir_str, fields, fd, ranges[idx][0], ranges[idx][1], done, idx))
+            results = self.run_segments(targets, done,
+                                        self.new_meter('put', put_filename, st.st_size, streams=len(ranges)))
+        finally:
+            self.abort = None
+
+        # every range acked ; the server renames the temp file, or removes it
+        send_success = all(r is True for r in results)
+        self.send(MsgToSend.CMD_COMMIT, pack_fields(
+            dir_str, transfer_id, put_filename, st.st_size, 'commit' if send_success else 'abort'))
+        m3t, m3 = self.recv()
+        if send_success and m3t == MsgToRecv.COMMIT_SUCCESS:
+            return True, False
+        if 'mismatch' in results:
+            self.disp_mismatch(put_filename)
+            return False, True
+        if 'busy' in results:
+            self.disp_busy()
+            return False, True
+        return False, 'stop' in results and False not in results
+
+    """ recursive get/put ; the tree streams as batches of records """
+    def get_tree(self, rem_dir, loc_dir):
+
+        # True when the whole tree arrived
+        if loc_dir and not self.existance_check(loc_dir, True):
+            print('''Couldn't get to local directory "{}": No such file or directory'''.format(loc_dir))
+            return False
+        self.send(MsgToSend.CMD_GET_TREE, rem_dir)
+        m1t, m1 = self.recv()
+        if m1t == MsgToRecv.SERVER_BUSY:
+            self.disp_busy()
+            return False
+        foreign_path_name = m1.decode()
+        if m1t == MsgToRecv.GET_PATHERR:
+            print('''Directory "{}" not found.'''.format(foreign_path_name))
+            return False
+
+        get_path = self.absolutify(loc_dir) if loc_dir else self.pwd
+        tree_path = os.path.join(get_path, os.path.basename(foreign_path_name.rstrip('/')))
+        print('''Fetching {} to {}'''.format(foreign_path_name, tree_path))
+        writer = TreeWriter(tree_path)
+        recv_success = False
+        user_cancellation = False
+        try:
+            recv_success = self.recv_blocks(writer.feed, self.new_meter('get_tree', foreign_path_name))
+            if recv_success:
+                writer.finish()
+        except KeyboardInterrupt:
+            user_cancellation = True
+            self.send(MsgToSend.GET_STOP)
+            _, _ = self.recv_until(MsgToRecv.GET_FAILURE)
+        except Exception as e:
+            if not recv_success: # the server still sends
+                self.send(MsgToSend.GET_STOP)
+                _, _ = self.recv_until(MsgToRecv.GET_FAILURE)
+            recv_success = False
+
+        self.disp_flush()
+        if recv_success:
+            print('''{} files, {} directories, {} bytes'''.format(writer.files, writer.dirs, writer.nbytes))
+            return True
+        writer.abort()
+        if not user_cancellation:
+            print('Error Occured')
+        return False
+
+    def put_tree(self, loc_dir, rem_dir):
+
+        # True when the server wrote the whole tree
+        if not self.existance_check(loc_dir, True):
+            print('''Couldn't get to local directory "{}": No such file or directory'''.format(loc_dir))
+            return False
+        tree_path = self.get_absolute_path(loc_dir)
+        self.send(MsgToSend.CMD_PUT_TREE, pack_fields(rem_dir or '', os.path.basename(tree_path)))
+        m1t, m1 = self.recv()
+        if m1t == MsgToRecv.SERVER_BUSY:
+            self.disp_busy()
+            return False
+        if m1t != MsgToRecv.PUT_PROCEED:
+            print('''Directory "{}" not found.'''.format(rem_dir or ''))
+            return False
+
+        frames = tree_frames(tree_path, self.block_size)
+        def read_block():
+            frame = next(frames, b'')
+            if type(frame) is tuple: # (file, offset, length) of a large file
+                f, offset, length = frame
+                frame = os.pread(f.fileno(), length, offset)
+                if len(frame) != length:
+                    raise ValueError('{} shrunk while sent'.format(f.name))
+            return frame
+
+        print('''Uploading {} to {}'''.format(tree_path, rem_dir or 'the remote working directory'))
+        send_success = False
+        user_cancellation = False
+        try:
+            send_success = self.send_blocks(read_block, self.new_meter('put_tree', tree_path))
+        except KeyboardInterrupt:
+            user_cancellation = True
+            self.send(MsgToSend.PUT_STOP)
+            _, _ = self.recv_until(MsgToRecv.PUT_FAILURE)
+        except Exception as e:
+            self.send(MsgToSend.PUT_STOP)
+            _, _ = self.recv_until(MsgToRecv.PUT_FAILURE)
+        finally:
+            frames.close()
+
+        self.disp_flush()
+        if send_success:
+            m3t, m3 = self.recv()
+            if m3t == MsgToRecv.PUT_SUCCESS:
+                print('''{} files, {} directories, {} bytes'''.format(*unpack_fields(m3)))
+                return True
+        if not user_cancellation:
+            print('Error Occured')
+        return False
+
+    """ delta sync ; the receiver's copy is the basis """
+    def sig_frames(self):
+        # SYNC_SIG frames of the server until the empty one
+        while True:
+            (mt, m) = self.recv()
+            if mt != MsgToRecv.SYNC_SIG:
+                raise ConnectionError('signatures expected')
+            if not m:
+                return
+            yield m
+
+    def sync_get(self, rem_path, loc_dir):
+
+        # (bytes sent, bytes matched) ; None on failure
+        if loc_dir and not self.existance_check(loc_dir, True):
+            print('''Couldn't get to local directory "{}": No such file or directory'''.format(loc_dir))
+            return
+        self.send(MsgToSend.CMD_SYNC_GET, rem_path)
+        m1t, m1 = self.recv()
+        if m1t == MsgToRecv.SERVER_BUSY:
+            self.disp_busy()
+            return
+        fields = unpack_fields(m1)
+        foreign_path_name = fields[0]
+        if m1t == MsgToRecv.GET_PATHERR:
+            print('''File "{}" not found.'''.format(foreign_path_name))
+            return
+
+        get_path = self.absolutify(loc_dir) if loc_dir else self.pwd
+        get_path = get_path + ('' if get_path[-1] == '/' else '/')
+        basis_path = get_path + rem_path.split('/')[-1]
+        block_size = sync_block_size(os.path.getsize(basis_path) if os.path.isfile(basis_path) else 0)
+        tmpfile_path = get_path + '.' + str(random.randint(10000000, 99999999))  # 8-digit number
+        try:
+            writer = DeltaWriter(basis_path, tmpfile_path, block_size)
+        except OSError:
+            self.send(MsgToSend.GET_STOP) # the server waits for the signatures
+            _, _ = self.recv()
+            print('Error Occured')
+            return
+
+        # signatures of the local copy ; the server answers with the delta
+        print('''Syncing {} to {}'''.format(foreign_path_name, basis_path))
+        self.send(MsgToSend.GET_PROCEED, str(block_size))
+        for frame in signature_frames(basis_path, block_size, self.block_size):
+            self.send(MsgToSend.SYNC_SIG, frame)
+        self.send(MsgToSend.SYNC_SIG, b'')
+        recv_success = False
+        user_cancellation = False
+        try:
+            recv_success = self.recv_blocks(writer.feed, self.new_meter('sync_get', foreign_path_name))
+            if recv_success:
+                writer.finish()
+                os.replace(tmpfile_path, basis_path)
+        except KeyboardInterrupt:
+            user_cancellation = True
+            self.send(MsgToSend.GET_STOP)
+            _, _ = self.recv_until(MsgToRecv.GET_FAILURE)
+        except Exception as e:
+            if not recv_success: # the server still sends
+                self.send(MsgToSend.GET_STOP)
+                _, _ = self.recv_until(MsgToRecv.GET_FAILURE)
+            recv_success = False
+
+        self.disp_flush()
+        if recv_success:
+            self.disp_delta(writer.literal, writer.copied)
+            return writer.literal, writer.copied
+        writer.abort()
+        if not user_cancellation:
+            print('Error Occured')
+
+    def sync_put(self, loc_path, rem_dir):
+
+        # (bytes sent, bytes matched) ; None on failure
+        if not self.existance_check(loc_path, False):
+            print('''Couldn't get to local directory "{}": No such file'''.format(loc_path))
+            return
+        put_filepath = self.absolutify(loc_path)
+        self.send(MsgToSend.CMD_SYNC_PUT, pack_fields(rem_dir or '', loc_path.split('/')[-1]))
+        m1t, m1 = self.recv()
+        if m1t == MsgToRecv.SERVER_BUSY:
+            self.disp_busy()
+            return
+        if m1t != MsgToRecv.PUT_PROCEED:
+            print('''Directory "{}" not found.'''.format(rem_dir or ''))
+            return
+
+        # signatures of the server's copy ; the delta goes back as put blocks
+        put_path, block_size = unpack_fields(m1)
+        table = read_signatures(self.sig_frames())
+        print('''Syncing {} to {}'''.format(put_filepath, put_path))
+        send_success = False
+        user_cancellation = False
+        with open(put_filepath, 'rb') as f:
+            frames = delta_frames(f, table, int(block_size), self.block_size)
+            try:
+                send_success = self.send_blocks(lambda: next(frames, b''),
+                                                self.new_meter('sync_put', put_filepath))
+            except KeyboardInterrupt:
+                user_cancellation = True
+                self.send(MsgToSend.PUT_STOP)
+                _, _ = self.recv_until(MsgToRecv.PUT_FAILURE)
+            except Exception as e:
+                self.send(MsgToSend.PUT_STOP)
+                _, _ = self.recv_until(MsgToRecv.PUT_FAILURE)
+
+        self.disp_flush()
+        if send_success:
+            m3t, m3 = self.recv()
+            if m3t == MsgToRecv.PUT_SUCCESS:
+                literal, copied = [int(field) for field in unpack_fields(m3)]
+                self.disp_delta(literal, copied)
+                return literal, copied
+        if not user_cancellation:
+            print('Error Occured')
+
+    def keep_alive(self):
+        # ALIVE_SIGNAL every self.alive seconds, answered by ALIVE_CHECK ; a running command holds
+        # the lock and keeps the session alive by itself
+        while not self.server_closed:
+            time.sleep(self.alive)
+            if not self.lock.acquire(blocking=False):
+                continue
+            try:
+                self.send(MsgToSend.ALIVE_SIGNAL)
+                m1t, _ = self.recv_until(MsgToRecv.ALIVE_CHECK, MsgToRecv.EXIT_SUCCESS)
+                self.server_closed = m1t != MsgToRecv.ALIVE_CHECK
+            except OSError:
+                self.server_closed = True
+            finally:
+                self.lock.release()
+
     def main_func_iter(self):
         cmd_str = self.get_user_input('sftp> ')
+        if self.server_closed:
+            self.disp_server_closed()
         valid_cmd, parsed = self.argparse(cmd_str)
         if not valid_cmd:
             print('Invalid command.')
             return
+        self.run_parsed(parsed)
 
-        cmd1, cmd2, cmd3 = parsed
+    def run_parsed(self, parsed):
+        # one command, Ctrl-C stopping it at a block boundary ; True when it succeeded
+        signal.signal(signal.SIGINT, self.request_stop)
+        self.compress_count[:] = [0, 0]
+        try:
+            with self.lock:
+                success = self.run_command(*parsed)
+            if parsed[0] in ('get', 'put', 'sync'):
+                self.disp_compression()
+            self.write_reports(success)
+            return success
+        finally:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            self.stop_requested = False
+
+    """ batch mode """
+    def pipeline_gets(self, cmds, idx, sent):
+        # a run of gets is sent up to PIPELINE_DEPTH ahead ; the server holds them until the running
+        # one is done, so each saves the round trip of its CMD_GET. Returns the new count of sent commands
+        def plain_get(parsed):
+            return parsed[0] == 'get' and not parsed[3].get('recursive') and not parsed[3].get('background')
+        if not self.pipeline or not plain_get(cmds[idx][2]):
+            return sent
+        while sent < len(cmds) and sent - idx <= PIPELINE_DEPTH and plain_get(cmds[sent][2]):
+            cmd1, cmd2, cmd3, options = cmds[sent][2]
+            self.send(MsgToSend.CMD_GET, self.get_request(cmd2, cmd3, options))
+            self.pipelined.append(cmd2)
+            sent = sent + 1
+        return sent
+
+    def get_request(self, rem_path, loc_dir, options):
+        # CMD_GET data ; with rtt1 also what the server needs to send at once : size and mtime of
+        # the partial file, and the largest file this get would not split into ranges
+        if not self.rtt1:
+            return rem_path
+        hint = (0, 0)
+        if self.resume:
+            get_path = self.absolutify(loc_dir) if loc_dir else self.pwd
+            try:
+                st = os.stat(os.path.join(get_path, partial_name(rem_path.split('/')[-1])))
+                hint = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                pass
+        inline_max = 2 * MIN_SEGMENT_SIZE - 1 if self.segments and options.get('streams', self.streams) > 1 \
+            else sys.maxsize
+        return pack_fields(rem_path, hint[0], hint[1], inline_max)
+
+    def drain_pipelined(self):
+        # gets sent ahead of a failed command ; each is answered, then refused
+        while self.pipelined:
+            self.pipelined.popleft()
+            m1t, m1 = self.recv()
+            if m1t != MsgToRecv.GET_PROCEED:
+                continue
+            self.stop_get(len(unpack_fields(m1)) >= 4) # rtt1 ; the blocks are on their way
+
+    def stop_get(self, blocks_due):
+        # refuses a get answered with GET_PROCEED before a block of it was taken. With blocks_due
+        # they are on their way and may all be in, the empty one too ; else a block is unacked
+        # or the server waits for our GET_PROCEED, and stops there
+        if blocks_due:
+            m2t, m2 = self.recv()
+            if m2t == MsgToRecv.GET_FAILURE:
+                return
+            if not m2: # nothing left to send ; done before a stop could reach it
+                if self.digest:
+                    _, _ = self.recv()
+                return
+        self.send(MsgToSend.GET_STOP)
+        _, _ = self.recv_until(MsgToRecv.GET_FAILURE)
+
+    def run_batch(self, uid, ip, port, lines):
+        # runs a script non-interactively and returns an exit code ; the password comes
+        # from SFTP_PASSWORD, else from the terminal
+        cmds = [] # (line number, line, parsed)
+        for lineno, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            valid_cmd, parsed = self.argparse(line)
+            if not valid_cmd:
+                print('Invalid command at line {} : {}'.format(lineno, line))
+                return EXIT_BAD_SCRIPT
+            cmds.append((lineno, line, parsed))
+
+        uid = uid or ADMIN_ID
+        try:
+            pw = os.environ.get('SFTP_PASSWORD')
+            if pw is None:
+                pw = getpass.getpass("{}@{}'s password : ".format(uid, ip))
+            self.login(ip, port, uid, pw)
+        except (OSError, EOFError) as e: # refused, busy or a wrong password
+            print('ssh: connect to {} {} port {}: {}'.format(uid, ip, port, e))
+            return EXIT_CONNECT_FAILED
+        print('Connected to {}@{}'.format(uid, ip))
+
+        sent = 0 # cmds[:sent] were sent to the server
+        for idx, (lineno, line, parsed) in enumerate(cmds):
+            if parsed[0] == 'exit':
+                break
+            print('sftp> {}'.format(line))
+            sent = self.pipeline_gets(cmds, idx, max(sent, idx))
+            if not self.run_parsed(parsed):
+                self.drain_pipelined()
+                print('Batch stopped at line {} : {}'.format(lineno, line))
+                self.wait_jobs()
+                self.end_session()
+                return EXIT_COMMAND_FAILED
+        jobs_success = self.wait_jobs()
+        self.end_session()
+        return EXIT_OK if jobs_success else EXIT_COMMAND_FAILED
+
+    def run_command(self, cmd1, cmd2, cmd3, options=None):
+        # True when the command succeeded
+        options = {} if options is None else options
+        self.meters = [] # of its transfers ; reported by run_parsed
+        if options.get('background'):
+            return self.start_job((cmd1, cmd2, cmd3, dict(options, background=False)))
         if cmd1 == 'cd':
             self.send(MsgToSend.CMD_CD, cmd2)
             m1t, m1 = self.recv()
             if m1t == MsgToRecv.CD_PATHERR:
                 print('''Couldn't stat remote file: No such file or directory''')
-                return
+                return False
+            elif m1t == MsgToRecv.CD_SUCCESS and self.rtt1: # changed at once
+                return True
             elif m1t == MsgToRecv.CD_PROCEED:
                 self.send(MsgToSend.CD_PROCEED)
                 m2t, m2 = self.recv()
-                if m2t != MsgToRecv.CD_SUCCESS:
-                    print('Error Occured')
-            return
+                if m2t == MsgToRecv.CD_SUCCESS:
+                    return True
+            print('Error Occured')
+            return False
 
         elif cmd1 == 'lcd':
             if not self.existance_check(cmd2, True):
                 print('''Couldn't change local directory to "{}": No such file or directory'''.format(cmd2))
-                return
+                return False
             self.pwd = self.get_absolute_path(cmd2)
         elif cmd1 == 'pwd':
             self.send(MsgToSend.CMD_PWD)
             m1t, m1 = self.recv()
+            if m1t != MsgToRecv.PWD_SUCCESS:
+                print('Error Occured')
+                return False
             print('Remote working directory: {}'.format(m1.decode()))
         elif cmd1 == 'lpwd':
             print('Local working directory: {}'.format(self.pwd))
         elif cmd1 == 'ls':
             cmd2 = '' if cmd2 is None else cmd2
-            self.send(MsgToSend.CMD_LS, cmd2)
+            offset, count = options.get('offset', 0), options.get('count', 0)
+            if self.ls2: # dir path, long, offset, count (0 : all)
+                self.send(MsgToSend.CMD_LS, pack_fields(
+                    cmd2, 'long' if options.get('long') else '', offset, count))
+            else:
+                self.send(MsgToSend.CMD_LS, cmd2)
             m1t, m1 = self.recv()
             if m1t == MsgToRecv.LS_PATHERR:
                 print('''Couldn't stat remote file: No such file or directory''')
-                return
+                return False
+            elif self.ls2 and (m1t == MsgToRecv.LS_PROCEED or self.rtt1):
+                # records stream until LS_SUCCESS ; a page is shown sorted. With rtt1 they
+                # follow the command at once
+                if m1t == MsgToRecv.LS_PROCEED:
+                    self.send(MsgToSend.LS_PROCCED)
+                    m1t, m1 = self.recv()
+                records = []
+                m2t, m2 = m1t, m1
+                while m2t == MsgToRecv.LS_DATA:
+                    fields = m2.decode(errors='replace').split('\0')
+                    records.extend(zip(*[iter(fields)] * 4))
+                    m2t, m2 = self.recv()
+                if m2t != MsgToRecv.LS_SUCCESS:
+                    print('Error Occured')
+                    return False
+                self.disp_listing(records, options.get('long'))
+                listed, more = unpack_fields(m2)
+                if more:
+                    print('''-- more ; ls -o {} -n {} for the next page --'''.format(
+                        offset + int(listed), count))
             elif m1t == MsgToRecv.LS_PROCEED:
                 self.send(MsgToSend.LS_PROCCED)
                 recv_data = b''
@@ -323,158 +1300,338 @@ class Client():
                     m2t, m2 = self.recv()
                     if m2t == MsgToRecv.LS_FAILURE:
                         print('Error Occured??')
-                        return
+                        return False
                     self.send(MsgToSend.LS_PROCCED)
                     if len(m2) == 0:
                         break
                     recv_data = recv_data + m2
                 # check success or failure
                 m3t, m3 = self.recv()
-                if m3t == MsgToRecv.LS_SUCCESS:
-                    print(recv_data.decode(), end='')
-                else:
+                if m3t != MsgToRecv.LS_SUCCESS:
                     print('Error Occured')
-            return
+                    return False
+                print(recv_data.decode(), end='')
+            else:
+                print('Error Occured')
+                return False
         elif cmd1 == 'lls':
             if not cmd2:
-                os.system('ls ' + self.pwd)
+                return os.system('ls ' + self.pwd) == 0
+            else:
+                return os.system('ls ' + cmd2) == 0
+        elif cmd1 == 'checksum':
+            if not self.digest:
+                print('Checksum is not supported by the server.')
+                return False
+            self.send(MsgToSend.CMD_CHECKSUM, cmd2)
+            m1t, m1 = self.recv()
+            if m1t != MsgToRecv.CHECKSUM_SUCCESS:
+                print('''File "{}" not found.'''.format(m1.decode()))
+                return False
+            foreign_path_name, algorithm, digest, size = unpack_fields(m1)
+            print('''{}  {} ({}, {} bytes)'''.format(digest, foreign_path_name, algorithm, size))
+            if cmd3: # compare with a local copy
+                if not self.existance_check(cmd3, False):
+                    print('''Couldn't stat local file "{}"'''.format(cmd3))
+                    return False
+                hasher = new_digest(algorithm)
+                with open(self.absolutify(cmd3), 'rb') as f:
+                    hash_range(f.fileno(), hasher, 0, os.fstat(f.fileno()).st_size)
+                print('''{}  {} : {}'''.format(hasher.hexdigest(), self.absolutify(cmd3),
+                                              'OK' if hasher.hexdigest() == digest else 'MISMATCH'))
+                return hasher.hexdigest() == digest
+        elif cmd1 == 'sync':
+            if not self.sync:
+                print('Sync is not supported by the server.')
+                return False
+            elif options['direction'] == 'get':
+                return self.sync_get(cmd2, cmd3) is not None
             else:
-                os.system('ls ' + cmd2)
+                return self.sync_put(cmd2, cmd3) is not None
+        elif cmd1 in ('get', 'put') and options.get('recursive'):
+            if not self.tree:
+                print('Recursive get/put is not supported by the server.')
+                return False
+            elif cmd1 == 'get':
+                return self.get_tree(cmd2, cmd3)
+            else:
+                return self.put_tree(cmd2, cmd3)
         elif cmd1 == 'get':
             if cmd3:
                 if not self.existance_check(cmd3, True):  # isDir
                     print('''Couldn't get to local directory "{}": No such file or directory'''.format(cmd3))
+                    return False
 
-            self.send(MsgToSend.CMD_GET, cmd2)
+            if self.pipelined and self.pipelined[0] == cmd2: # sent ahead by the batch runner
+                self.pipelined.popleft()
+            else:
+                self.send(MsgToSend.CMD_GET, self.get_request(cmd2, cmd3, options))
             m1t, m1 = self.recv()
-            foreign_path_name = m1.decode()
+            if m1t == MsgToRecv.SERVER_BUSY:
+                self.disp_busy()
+                return False
+            fields = unpack_fields(m1)
+            foreign_path_name = fields[0]
             if m1t == MsgToRecv.GET_PATHERR:
                 print('''File "{}" not found.'''.format(foreign_path_name))
-                return
+                return False
+            inline = len(fields) >= 4 # rtt1 ; path, size, mtime, offset and the blocks on their way
 
             get_path = (self.absolutify(cmd3) if cmd3 else self.pwd)
             get_path = get_path + ('' if get_path[-1] == '/' else '/')
             file_name = cmd2.split('/')[-1]
-            tmpfile_name = str(random.randint(10000000, 99999999))  # 8-digit number
-            tmpfile_name = '.' + tmpfile_name
+
+            # parallel get ; byte ranges over several connections
+            ranges = split_ranges(int(fields[1]), options.get('streams', self.streams), self.block_size) \
+                if self.segments and len(fields) >= 3 and not inline else []
+            if len(ranges) > 1:
+                print('''Fetching {} to {} over {} connections'''.format(
+                    foreign_path_name, get_path + file_name, len(ranges)))
+                recv_success, user_cancellation = self.get_segmented(
+                    foreign_path_name, int(fields[1]), int(fields[2]), get_path, file_name, ranges)
+                if not recv_success and not user_cancellation:
+                    print('Error Occured')
+                return recv_success
+
+            offset = 0
+            if self.resume and len(fields) >= 3: # path, size, mtime
+                tmpfile_name = partial_name(file_name)
+                foreign_mtime = int(fields[2])
+                offset = int(fields[3]) if inline else \
+                    resume_offset(get_path + tmpfile_name, int(fields[1]), foreign_mtime)
+            else:
+                tmpfile_name = str(random.randint(10000000, 99999999))  # 8-digit number
+                tmpfile_name = '.' + tmpfile_name
 
             recv_success = False
-            turn_to_send = True
             user_cancellation = False
-
-            uptime = 0
-            upspeed = 0.0
-            upbyte = 0
-            recent_time = int(round(time.time() * 1000))
-
+            digest_mismatch = False
+            hasher = new_digest(self.digest) if self.digest else None # of the whole file
+            blocks_due = inline # sent by the server, none taken yet
             try:
-                with open(get_path + tmpfile_name, 'wb') as f:
-                    self.send(MsgToSend.GET_PROCEED)  # be ready!
+                if inline and offset and \
+                        offset != resume_offset(get_path + tmpfile_name, int(fields[1]), foreign_mtime):
+                    raise ValueError('partial file changed since the request')
+                if hasher is not None and offset: # the part kept from before
+                    with open(get_path + tmpfile_name, 'rb') as f:
+                        hash_range(f.fileno(), hasher, 0, offset)
+                with open(get_path + tmpfile_name, 'ab' if offset else 'wb') as f:
+                    def write_block(data):
+                        f.write(data)
+                        if hasher is not None:
+                            hasher.update(data)
+                    if not inline:
+                        self.send(MsgToSend.GET_PROCEED, str(offset) if offset else '')  # be ready!
+                        blocks_due = True
                     print('''Fetching {} to {}'''.format(foreign_path_name, get_path + file_name))
-                    while True:
-                        turn_to_send = not turn_to_send
-                        m2t, m2 = self.recv()
-                        # stats
-                        val, dta, spd = self.stats(recent_time, uptime, upspeed, len(m2))
-                        if val:
-                            uptime = uptime + dta
-                            recent_time = int(round(time.time() * 1000))
-                            upspeed = spd
-                            upbyte = upbyte + len(m2)
-                            self.disp_mpbs(foreign_path_name, uptime, upbyte)
-                        # end stats
-                        turn_to_send = not turn_to_send
-                        if m2t == MsgToRecv.GET_FAILURE:
-                            break
-                        if not m2:  # empty
-                            recv_success = True
-                            break
-                        f.write(m2)
-                        self.send(MsgToSend.GET_PROCEED)
+                    if offset:
+                        print('''Resuming at byte {}'''.format(offset))
+                    blocks_due = False # recv_blocks stops before the ack of a block it took
+                    meter = self.new_meter('get', foreign_path_name,
+                                           int(fields[1]) if len(fields) >= 3 else None, offset)
+                    recv_success = self.recv_blocks(write_block, meter)
             except KeyboardInterrupt:
                 user_cancellation = True
                 #traceback.print_exc()
-                self.send(MsgToSend.GET_STOP)
-                _, _ = self.recv()  # recv fail
+                self.stop_get(blocks_due)  # recv fail
             except Exception as e:
                 #traceback.print_exc()
-                self.send(MsgToSend.GET_STOP)
-                _, _ = self.recv()  # recv fail
+                self.stop_get(blocks_due)  # recv fail
+
+            if recv_success and hasher is not None: # the server's digest follows the empty block
+                m3t, m3 = self.recv()
+                digest_mismatch = m3t != MsgToRecv.GET_SUCCESS or m3.decode() != hasher.hexdigest()
+                recv_success = not digest_mismatch
 
             self.disp_flush()
 
             if recv_success:
-                os.system('mv {} {}'.format(get_path + tmpfile_name, get_path + file_name))
-                return
-            os.system('rm {}'.format(get_path + tmpfile_name))
+                os.replace(get_path + tmpfile_name, get_path + file_name)
+                return True
+            if digest_mismatch: # corrupt ; nothing worth resuming
+                os.remove(get_path + tmpfile_name)
+                self.disp_mismatch(file_name)
+                return False
+            if tmpfile_name.endswith(PARTIAL_SUFFIX) and os.path.isfile(get_path + tmpfile_name):
+                # keep it for a resume ; the mtime ties it to this version of the remote file
+                os.utime(get_path + tmpfile_name, ns=(foreign_mtime, foreign_mtime))
+                print('''Partial file kept ; get it again to resume.''')
+            elif os.path.isfile(get_path + tmpfile_name):
+                os.remove(get_path + tmpfile_name)
             if not user_cancellation:
                 print('Error Occured')
+            return False
 
         elif cmd1 == 'put':
 
             if not self.existance_check(cmd2, False):  # isFile?
                 print('''Couldn't get to local directory "{}": No such file'''.format(cmd2))
-                return
+                return False
 
             target_path = cmd3 if cmd3 else ''
             self.send(MsgToSend.CMD_PUT, target_path)
             m1t, m1 = self.recv()
+            if m1t == MsgToRecv.SERVER_BUSY:
+                self.disp_busy()
+                return False
             if m1t == MsgToRecv.PUT_PATHERR:
                 print('''Directory "{}" not found.'''.format(target_path))
-                return
+                return False
 
             put_filepath = self.absolutify(cmd2)
             put_filename = cmd2.split('/')[-1]
-            self.send(MsgToSend.PUT_PROCEED, put_filename)
 
-            uptime = 0
-            upspeed = 0.0
-            upbyte = 0
-            recent_time = int(round(time.time() * 1000))
+            # parallel put ; byte ranges over several connections, renamed at CMD_COMMIT
+            st = os.stat(put_filepath)
+            ranges = split_ranges(st.st_size, options.get('streams', self.streams), self.block_size) \
+                if self.segments else []
+            if len(ranges) > 1:
+                print('''Uploading {} to {} over {} connections'''.format(
+                    put_filepath, m1.decode(), len(ranges)))
+                with open(put_filepath, 'rb') as f:
+                    send_success, user_cancellation = self.put_segmented(
+                        f.fileno(), m1.decode(), put_filename, st, ranges)
+                if not send_success and not user_cancellation:
+                    print('Error Occured')
+                return send_success
+
+            if self.resume: # size and mtime identify the version the server may hold
+                self.send(MsgToSend.PUT_PROCEED, pack_fields(put_filename, st.st_size, st.st_mtime_ns))
+            else:
+                self.send(MsgToSend.PUT_PROCEED, put_filename)
 
             user_cancellation = False
             send_success = False
+            hasher = new_digest(self.digest) if self.digest else None # of the whole file
             print('''Uploading {} to {}'''.format(put_filepath + put_filename, m1.decode()))
             try:
                 with open(put_filepath, 'rb') as f:
-                    while True:
-                        m2t, m2 = self.recv()
-                        if m2t == MsgToRecv.PUT_FAILURE:
-                            break
-                        data_frag_bin = f.read(DATA_BLOCK_SIZE)
-                        self.send(MsgToSend.PUT_DATA, data_frag_bin)
-                        # stats
-                        val, dta, spd = self.stats(recent_time, uptime, upspeed, len(data_frag_bin))
-                        if val:
-                            uptime = uptime + dta
-                            recent_time = int(round(time.time() * 1000))
-                            upspeed = spd
-                            upbyte = upbyte + len(data_frag_bin)
-                            self.disp_mpbs(put_filepath, uptime, upbyte)
-                        # end stats
-                        if not data_frag_bin:
-                            send_success = True
-                            break
+                    def read_block():
+                        data = f.read(self.block_size)
+                        if hasher is not None:
+                            hasher.update(data)
+                        return data
+                    # first go ; carries the bytes a resuming server already has
+                    m2t, m2 = self.recv()
+                    if m2t == MsgToRecv.PUT_PROCEED:
+                        offset = int(m2) if self.resume and m2 else 0
+                        if offset:
+                            print('''Resuming at byte {}'''.format(offset))
+                            if hasher is not None:
+                                hash_range(f.fileno(), hasher, 0, offset)
+                            f.seek(offset)
+                        meter = self.new_meter('put', put_filepath, st.st_size, offset)
+                        send_success = self.send_blocks(read_block, meter)
             except KeyboardInterrupt:
                 user_cancellation = True
                 #traceback.print_exc()
-                self.send(MsgToSend.PUT_STOP)
-                self.send(MsgToSend.PUT_STOP)
-                _, _ = self.recv()
+                if self.window > 1: # acks may be in flight
+                    self.send(MsgToSend.PUT_STOP)
+                    _, _ = self.recv_until(MsgToRecv.PUT_FAILURE)
+                else:
+                    self.send(MsgToSend.PUT_STOP)
+                    self.send(MsgToSend.PUT_STOP)
+                    _, _ = self.recv()
             except Exception as e:
                 #traceback.print_exc()
                 self.send(MsgToSend.PUT_STOP)
-                _, _ = self.recv()
+                _, _ = self.recv_until(MsgToRecv.PUT_FAILURE) if self.window > 1 \
+                    else self.recv()
+
+            if send_success and hasher is not None: # checked by the server before its rename
+                self.send(MsgToSend.PUT_DIGEST, hasher.hexdigest())
+                m3t, m3 = self.recv()
+                if m3t != MsgToRecv.PUT_SUCCESS:
+                    send_success = False
+                    if m3 == b'digest':
+                        self.disp_flush()
+                        self.disp_mismatch(put_filename)
+                        return False
 
             self.disp_flush()
 
             if not user_cancellation and not send_success:
                 print('Error Occured')
+            return send_success
 
+        elif cmd1 == 'jobs':
+            for job_id, job in sorted(self.jobs.items()):
+                meter = job.meters[-1] if job.meters else None
+                print('[{}] Running  {}{}'.format(job_id, job.command, '   ' + meter.line() if meter else ''))
         elif cmd1 == 'exit':
+            self.wait_jobs()
             self.close(True)
+        return True
+
+    """ background jobs ; 'get/put/sync ... &' on a stream of their own """
+    def start_job(self, parsed):
+
+        # the job is a client of its own stream id, inbox and window on this connection ; the server
+        # runs it in a channel beside stream 0, so the prompt stays usable
+        if not self.mux:
+            print('Background transfers are not supported by the server.')
+            return False
+        if len(self.jobs) >= self.mux:
+            print('{} background transfers running ; wait for one to finish.'.format(len(self.jobs)))
+            return False
+        if self.inbox is None: # frames are routed by stream id from the first job on
+            self.inbox = queue.Queue()
+            self.inboxes[0] = self.inbox
+            Thread(target=self.demux, daemon=True).start()
+        cmd1, cmd2, cmd3, options = parsed
+        command = ' '.join([cmd1] + ([options['direction']] if 'direction' in options else []) +
+                           [arg for arg in (cmd2, cmd3) if arg])
+        job = Job(self, self.next_stream, queue.Queue(), command)
+        self.next_stream = self.next_stream + 1
+        self.inboxes[job.stream_id] = job.inbox
+        self.jobs[job.stream_id] = job
+        print('[{}] {}'.format(job.stream_id, job.command))
+        job.thread = Thread(target=job.run_job, args=(parsed,), daemon=True)
+        job.thread.start()
+        return True
+
+    def run_job(self, parsed):
+        # in the job's thread ; its last line is printed when it ends, like a shell's
+        success = False
+        try:
+            success = self.run_command(*parsed)
+            self.write_reports(success)
+        except ConnectionError: # the connection is gone ; the prompt reports it
+            pass
+        except Exception as e:
+            print('[{}] sftp: {}'.format(self.stream_id, e))
+        finally:
+            self.inboxes.pop(self.stream_id, None)
+            self.jobs.pop(self.stream_id, None)
+            if not success:
+                self.failed_jobs.append(self.stream_id)
+            print('[{}] {}  {}'.format(self.stream_id, 'Done' if success else 'Failed', self.command))
+
+    def demux(self):
+        # reader thread once a job runs ; frames go to the inbox of their stream, those of a job
+        # that ended are dropped. The end of the connection reaches every stream
+        try:
+            while True:
+                frame = self.reader.read_frame()
+                inbox = self.inboxes.get(frame[2])
+                if inbox is not None:
+                    inbox.put(frame)
+        except (ValueError, ConnectionError, OSError) as e:
+            for inbox in list(self.inboxes.values()):
+                inbox.put(e)
+
+    def wait_jobs(self):
+        # True when every background transfer succeeded
+        jobs = list(self.jobs.values())
+        if jobs:
+            print('Waiting for {} background transfers.'.format(len(jobs)))
+        for job in jobs:
+            job.thread.join()
+        return not self.failed_jobs
 
     def main_func(self):
+        if self.alive:
+            Thread(target=self.keep_alive, daemon=True).start()
         while True:
             try:
                 self.main_func_iter()
@@ -515,11 +1672,11 @@ class Client():
                 uid = ADMIN_ID
             # open socket
             self.ip, self.port, self.uid = ip, port, uid
-            self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.attach(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
             # connect
             con_success, conned = self.connect(uid, ip, port)
             if not con_success:
-                self.close(conned)
+                self.close(conned, EXIT_CONNECT_FAILED)
 
             # authenticate
             self.authenticate(uid)
@@ -533,6 +1690,39 @@ class Client():
 
         self.close(True)
 
+""" background jobs """
+class Job(Client):
+
+    # a 'get/put/sync ... &' on a stream of its own. It shares the connection, the send lock
+    # and the inboxes of the client that started it and takes the options agreed at its hello
+    def __init__(self, client, stream_id, inbox, command):
+        Client.__init__(self, client.window_asked, client.streams, client.codecs_asked, client.report_path)
+        self.conn = client.conn
+        self.send_lock = client.send_lock
+        self.stream_id = stream_id
+        self.inbox = inbox
+        self.inboxes = client.inboxes
+        self.jobs = client.jobs
+        self.failed_jobs = client.failed_jobs
+        self.ip, self.port, self.uid, self.password = client.ip, client.port, client.uid, client.password
+        self.pwd = client.pwd
+        self.token = client.token
+        self.proto = client.proto
+        self.window = client.window
+        self.block_size = min(client.block_size, MUX_BLOCK_SIZE)
+        self.resume = client.resume
+        self.segments = client.segments
+        self.ls2 = client.ls2
+        self.codec = client.codec
+        self.tree = client.tree
+        self.sync = client.sync
+        self.digest = client.digest
+        self.pipeline = client.pipeline
+        self.rtt1 = client.rtt1
+        self.quiet = True
+        self.command = command
+        self.thread = None
+
 if __name__ == "__main__":
 
 
@@ -540,23 +1730,50 @@ if __name__ == "__main__":
     tcpIP = None
     argparse_success = True
     uID = ''
+    window = TRANSFER_WINDOW
+    streams = TRANSFER_STREAMS
+    codecs = ''
+    script = None
+    report = None
 
     try:
-        if len(sys.argv) >= 3 : # PORT option
-            tcpPORT = int(sys.argv[2])
-
-        if '@' in sys.argv[1]:
-            uID = sys.argv[1].split('@')[0]
-            tcpIP = sys.argv[1].split('@')[1]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'w:P:C:b:', ['report='])
+        for opt, val in opts:
+            if opt == '-w': # blocks in flight (1 : stop-and-wait)
+                window = max(1, int(val))
+            elif opt == '-P': # connections of a parallel get/put (1 : off)
+                streams = max(1, int(val))
+            elif opt == '-C': # block compression codecs, in order of preference
+                codecs = val
+            elif opt == '-b': # batch script ; '-' reads stdin
+                script = val
+            elif opt == '--report': # JSON lines of every get/put appended to this file
+                report = val
+
+        if len(args) >= 2 : # PORT option
+            tcpPORT = int(args[1])
+
+        if '@' in args[0]:
+            uID = args[0].split('@')[0]
+            tcpIP = args[0].split('@')[1]
         else:
-            tcpIP = sys.argv[1]
+            tcpIP = args[0]
 
     except:
         argparse_success = False
 
     # Argparse OK
-    if argparse_success:
-        cli = Client()
+    if argparse_success and script is not None:
+        try:
+            lines = sys.stdin.readlines() if script == '-' else open(script).readlines()
+        except OSError as e:
+            print('sftp: {}'.format(e))
+            sys.exit(EXIT_BAD_SCRIPT)
+        cli = Client(window, streams, codecs, report)
+        sys.exit(cli.run_batch(uID, tcpIP, tcpPORT, lines))
+    elif argparse_success:
+        cli = Client(window, streams, codecs, report)
         cli.run(uID, tcpIP, tcpPORT)
     else:
-        print('sftp: illegal argument(s)')
\ No newline at end of file
+        print('sftp: illegal argument(s)')
+        sys.exit(EXIT_BAD_SCRIPT)
\ No newline at end of file
@@ -0,0 +1,560 @@
+"""
+ftp_protocol.py
+TERM PROJECT FOR POSTECH CSED353 SPRING 2020
+IMPLEMENTED BY JINHO KO (jinho.ko@postech.ac.kr)
+DISTRIBUTION OR COMMERCIAL USE ONLY AVAILABLE UPON APPROVAL OF THE AUTHOR.
+
+Wire formats shared by ftp_server.py and ftp_client.py ; keep it next to them.
+"""
+
+""" load libraries """
+import socket
+import os
+import random
+import struct
+import zlib
+import hashlib
+import errno
+try:
+    import lzma
+except ImportError: # python built without liblzma ; zlib only
+    lzma = None
+
+""" configuration """
+CONN_BUFFER_SIZE = 262144 # 256KB ; larger messages are received in place
+DATA_BLOCK_SIZE = 2048000 # 2MB
+DATA_BLOCK_SIZE_V2 = 8192000 # 8MB ; protocol v2 lifts the 99,999,999-byte frame cap
+MAX_FRAME_SIZE = 1 << 30 # 1GB
+SFTP_DISCRIMINATOR_TOKEN = b'dg'
+SFTP_DISCRIMINATOR_TOKEN_V2 = b'dG'
+PARTIAL_SUFFIX = '.sftp-part' # '.' + name + suffix ; kept on failure to resume
+COMPRESS_PROBE_SIZE = 65536 # 64KB sample tried before compressing a block
+COMPRESS_MIN_SAVING = 0.1 # blocks saving less than 10% go raw
+TREE_INLINE_SIZE = 1048576 # 1MB ; smaller files of a get/put -r ride in a batch of records
+SYNC_MIN_BLOCK = 2048 # block size bounds of a delta sync ; about sqrt(file size) in between
+SYNC_MAX_BLOCK = 131072
+SYNC_READ_SIZE = 8388608 # 8MB read at a time while searching for matching blocks
+DIGESTS = ('sha256', 'blake2b') # end-to-end hashes of get/put, in order of preference ; sha256 runs on the cpu's sha extensions where present
+
+""" session options ; 'hi key=value key2' """
+def parse_options(msg_str):
+    options = {}
+    for elem in msg_str.split(' ')[1:]:
+        if elem == '':
+            continue
+        key, _, value = elem.partition('=')
+        options[key] = value
+    return options
+
+def format_options(options):
+    return ''.join(' {}'.format(key) if value == '' else ' {}={}'.format(key, value)
+                   for key, value in options.items())
+
+def set_nodelay(conn):
+    # whole messages are written at once ; no nagle stall on back-to-back small ones.
+    # Only for peers that negotiated options : old ones take what one recv returns for a
+    # single message, and nagle kept their messages apart
+    if conn.family in (socket.AF_INET, socket.AF_INET6):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+""" message fields ; '\0' never appears in a path """
+def pack_fields(*fields):
+    return '\0'.join(str(field) for field in fields)
+
+def unpack_fields(data):
+    return data.decode().split('\0')
+
+""" resumable transfers """
+def partial_name(file_name):
+    return '.' + file_name + PARTIAL_SUFFIX
+
+def resume_offset(part_path, size, mtime_ns):
+    # bytes of part_path to keep ; it must come from the same version of the source
+    try:
+        st = os.stat(part_path)
+    except OSError:
+        return 0
+    if st.st_size <= size and st.st_mtime_ns == mtime_ns:
+        return st.st_size
+    return 0
+
+""" parallel transfers ; byte ranges written in place """
+def preallocate(fd, size, offset=0):
+    # reserve the blocks up front so segments never fail half-way on a full disk
+    if not hasattr(os, 'posix_fallocate'):
+        os.ftruncate(fd, size)
+        return
+    try:
+        os.posix_fallocate(fd, offset, size - offset)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL): # e.g. a full disk is an error
+            raise
+        os.ftruncate(fd, size)
+
+""" recursive transfers ; a tree as one stream of records """
+TREE_RECORD = struct.Struct('!cQQI') # kind, size, mtime_ns, path length ; path (and data) follow
+
+def tree_frames(root, block_size):
+    # the frames of a tree : batches of records in directory order, a directory before its
+    # entries. Small files ride in the batch ('f' + data) ; a large one ends its batch ('F')
+    # and follows as (file, offset, length) slices of block_size. Symlinks and special
+    # files are skipped
+    batch = bytearray(TREE_RECORD.pack(b'D', 0, os.stat(root).st_mtime_ns, 0))
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            entries = list(it)
+        for entry in entries:
+            rel_name = os.fsencode(rel_dir + entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(rel_dir + entry.name + '/')
+                record = TREE_RECORD.pack(b'D', 0, entry.stat(follow_symlinks=False).st_mtime_ns,
+                                          len(rel_name)) + rel_name
+            elif entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                if st.st_size > TREE_INLINE_SIZE:
+                    f = open(entry.path, 'rb')
+                    try:
+                        batch.extend(TREE_RECORD.pack(b'F', st.st_size, st.st_mtime_ns, len(rel_name)))
+                        batch.extend(rel_name)
+                        yield bytes(batch)
+                        batch = bytearray()
+                        for offset in range(0, st.st_size, block_size):
+                            yield (f, offset, min(block_size, st.st_size - offset))
+                    finally:
+                        f.close()
+                    continue
+                with open(entry.path, 'rb') as f:
+                    data = f.read(TREE_INLINE_SIZE + 1)
+                if len(data) > TREE_INLINE_SIZE: # grew since the stat
+                    raise ValueError('{} changed while read'.format(entry.path))
+                record = TREE_RECORD.pack(b'f', len(data), st.st_mtime_ns, len(rel_name)) + rel_name + data
+            else:
+                continue
+            if batch and len(batch) + len(record) > block_size: # empty after an 'F' ; an empty frame ends the tree
+                yield bytes(batch)
+                batch = bytearray()
+            batch.extend(record)
+    if batch:
+        yield bytes(batch)
+
+class TreeWriter():
+
+    # rebuilds under root the tree of the frames fed in order. Files are written to
+    # temp names and renamed when complete ; directory mtimes are set at finish(),
+    # once their entries stopped changing them. The server journals its temp files
+    # by overriding temp_path, commit and discard
+    def __init__(self, root):
+        self.root = root
+        self.large = None # [temp path, path, file, bytes left, mtime] of the 'F' being received
+        self.dir_mtimes = []
+        self.files = 0
+        self.dirs = 0
+        self.nbytes = 0
+
+    def target(self, name):
+        # '' is the root ; no absolute path, '.', '..' or empty part gets out of it
+        if name == '':
+            return self.root
+        if any(part in ('', '.', '..') for part in name.split('/')):
+            raise ValueError('bad path in tree : {}'.format(name))
+        return os.path.join(self.root, name)
+
+    def temp_path(self, path):
+        return os.path.join(os.path.dirname(path), '.' + str(random.randint(10000000, 99999999)))
+
+    def commit(self, tmp_path, path):
+        os.replace(tmp_path, path)
+
+    def discard(self, tmp_path):
+        os.remove(tmp_path)
+
+    def feed(self, data):
+        if self.large is not None:
+            self.write_large(data)
+            return
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            kind, size, mtime, name_len = TREE_RECORD.unpack_from(view, pos)
+            pos = pos + TREE_RECORD.size
+            path = self.target(os.fsdecode(bytes(view[pos:pos + name_len])))
+            pos = pos + name_len
+            if kind == b'D':
+                os.makedirs(path, exist_ok=True)
+                self.dir_mtimes.append((path, mtime))
+                self.dirs = self.dirs + 1
+            elif kind == b'f':
+                if pos + size > len(view):
+                    raise ValueError('truncated tree record')
+                tmp_path = self.temp_path(path)
+                with open(tmp_path, 'wb') as f:
+                    f.write(view[pos:pos + size])
+                self.done_file(tmp_path, path, size, mtime)
+                pos = pos + size
+            elif kind == b'F' and pos == len(view): # its data comes in the next frames
+                tmp_path = self.temp_path(path)
+                self.large = [tmp_path, path, open(tmp_path, 'wb'), size, mtime]
+            else:
+                raise ValueError('bad tree record')
+
+    def write_large(self, data):
+        tmp_path, path, f, left, mtime = self.large
+        if len(data) > left:
+            raise ValueError('tree file longer than announced')
+        f.write(data)
+        self.large[3] = left - len(data)
+        if self.large[3] == 0:
+            f.close()
+            self.large = None
+            self.done_file(tmp_path, path, os.path.getsize(tmp_path), mtime)
+
+    def done_file(self, tmp_path, path, size, mtime):
+        os.utime(tmp_path, ns=(mtime, mtime))
+        self.commit(tmp_path, path)
+        self.files = self.files + 1
+        self.nbytes = self.nbytes + size
+
+    def finish(self):
+        if self.large is not None:
+            raise ValueError('tree ended inside a file')
+        for path, mtime in reversed(self.dir_mtimes): # deepest first
+            os.utime(path, ns=(mtime, mtime))
+
+    def abort(self):
+        # the files already renamed stay ; only the one being received is removed
+        if self.large is not None:
+            self.large[2].close()
+            self.discard(self.large[0])
+            self.large = None
+
+""" delta sync ; rsync-style signatures of the receiver's copy, literals for the rest """
+SIG_RECORD = struct.Struct('!I16s') # adler32 and blake2b-128 of one full block of the basis
+DELTA_RECORD = struct.Struct('!cQQ') # kind, a, b ; 'C' first block, count : 'L' length : 'E' size + digest
+ADLER_MOD = 65521
+
+def sync_block_size(basis_size):
+    # about sqrt(size) like rsync, in whole KB
+    return max(SYNC_MIN_BLOCK, min(SYNC_MAX_BLOCK, int(basis_size ** 0.5) // 1024 * 1024))
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def signature_frames(path, block_size, frame_size):
+    # signatures of the full blocks of path, in order ; the short tail block goes as a literal
+    batch = bytearray()
+    try:
+        f = open(path, 'rb')
+    except OSError: # no basis ; everything is literal
+        return
+    with f:
+        while True:
+            data = f.read(block_size)
+            if len(data) < block_size:
+                break
+            batch.extend(SIG_RECORD.pack(zlib.adler32(data), strong_hash(data)))
+            if len(batch) + SIG_RECORD.size > frame_size:
+                yield bytes(batch)
+                batch = bytearray()
+    if batch:
+        yield bytes(batch)
+
+def read_signatures(frames):
+    # weak -> {strong : block index}
+    table = {}
+    idx = 0
+    for frame in frames:
+        for weak, strong in SIG_RECORD.iter_unpack(frame):
+            table.setdefault(weak, {}).setdefault(strong, idx)
+            idx = idx + 1
+    return table
+
+def batch_records(records, frame_size):
+    # records packed into frames of at most frame_size bytes ; a record never spans frames
+    batch = bytearray()
+    for record in records:
+        if batch and len(batch) + len(record) > frame_size:
+            yield bytes(batch)
+            batch = bytearray()
+        batch.extend(record)
+    if batch:
+        yield bytes(batch)
+
+def literal_records(data, literal_max):
+    for lit_pos in range(0, len(data), literal_max):
+        literal = data[lit_pos:lit_pos + literal_max]
+        yield DELTA_RECORD.pack(b'L', len(literal), 0) + literal
+
+def delta_records(f, table, block_size, literal_max):
+
+    # the delta of file f against the blocks of table : runs of copied blocks and literals,
+    # then 'E' with the size and digest of f. The weak sum rolls byte by byte only where no
+    # block matches ; after a match it jumps a whole block (adler32 in C)
+    whole = hashlib.blake2b(digest_size=16)
+    total = 0
+    if not table: # no basis ; all literal
+        while True:
+            data = f.read(literal_max)
+            if not data:
+                break
+            whole.update(data)
+            total = total + len(data)
+            yield DELTA_RECORD.pack(b'L', len(data), 0) + data
+        yield DELTA_RECORD.pack(b'E', total, 0) + whole.digest()
+        return
+
+    buf = b''
+    pos, lit_start = 0, 0 # window start, start of the pending literal
+    copy_start, copy_count = 0, 0 # pending run of copied blocks
+    weak = None
+    eof = False
+    while True:
+        if len(buf) - pos <= block_size and not eof: # rolling needs buf[pos + block_size]
+            more = f.read(SYNC_READ_SIZE)
+            whole.update(more)
+            total = total + len(more)
+            eof = not more
+            buf = buf[lit_start:] + more
+            pos, lit_start = pos - lit_start, 0
+            continue
+        if len(buf) - pos < block_size: # tail shorter than a block
+            break
+        if weak is None:
+            weak = zlib.adler32(buf[pos:pos + block_size])
+            a, b = weak & 0xffff, weak >> 16
+        matched = table.get(weak)
+        idx = matched.get(strong_hash(buf[pos:pos + block_size])) if matched is not None else None
+        if idx is not None:
+            if pos > lit_start or idx != copy_start + copy_count: # the run ends
+                if copy_count:
+                    yield DELTA_RECORD.pack(b'C', copy_start, copy_count)
+                if pos > lit_start:
+                    yield DELTA_RECORD.pack(b'L', pos - lit_start, 0) + buf[lit_start:pos]
+                copy_start, copy_count = idx, 0
+            copy_count = copy_count + 1
+            pos = pos + block_size
+            lit_start = pos
+            weak = None
+            continue
+        if pos - lit_start >= literal_max: # bound the pending literal
+            if copy_count:
+                yield DELTA_RECORD.pack(b'C', copy_start, copy_count)
+                copy_count = 0
+            yield DELTA_RECORD.pack(b'L', pos - lit_start, 0) + buf[lit_start:pos]
+            lit_start = pos
+        limit = min(len(buf) - block_size, lit_start + literal_max)
+        if pos >= limit: # the last full block at the end of the file
+            break
+        # roll to the next weak hit
+        while pos < limit:
+            old, new = buf[pos], buf[pos + block_size]
+            a = (a - old + new) % ADLER_MOD
+            b = (b - block_size * old + a - 1) % ADLER_MOD
+            pos = pos + 1
+            if (b << 16 | a) in table:
+                break
+        weak = b << 16 | a
+
+    if copy_count:
+        yield DELTA_RECORD.pack(b'C', copy_start, copy_count)
+    yield from literal_records(buf[lit_start:], literal_max)
+    yield DELTA_RECORD.pack(b'E', total, 0) + whole.digest()
+
+def delta_frames(f, table, block_size, frame_size):
+    return batch_records(delta_records(f, table, block_size, frame_size - DELTA_RECORD.size), frame_size)
+
+class DeltaWriter():
+
+    # rebuilds the sender's file into tmp_path from the basis and the delta frames fed in
+    # order ; finish() fails unless the size and digest of the 'E' record match
+    def __init__(self, basis_path, tmp_path, block_size):
+        self.block_size = block_size
+        try:
+            self.basis = open(basis_path, 'rb')
+        except OSError:
+            self.basis = None
+        self.tmp_path = tmp_path
+        self.out = open(tmp_path, 'wb')
+        self.whole = hashlib.blake2b(digest_size=16)
+        self.written = 0
+        self.copied = 0 # bytes taken from the basis
+        self.literal = 0 # bytes sent
+        self.verified = False
+
+    def write(self, data):
+        self.out.write(data)
+        self.whole.update(data)
+        self.written = self.written + len(data)
+
+    def feed(self, data):
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            if self.verified:
+                raise ValueError('delta goes on after its end')
+            kind, first, second = DELTA_RECORD.unpack_from(view, pos)
+            pos = pos + DELTA_RECORD.size
+            if kind == b'C' and self.basis is not None:
+                for idx in range(first, first + second):
+                    block = os.pread(self.basis.fileno(), self.block_size, idx * self.block_size)
+                    if len(block) != self.block_size: # the basis changed
+                        raise ValueError('basis block {} missing'.format(idx))
+                    self.write(block)
+                self.copied = self.copied + second * self.block_size
+            elif kind == b'L' and pos + first <= len(view):
+                self.write(view[pos:pos + first])
+                self.literal = self.literal + first
+                pos = pos + first
+            elif kind == b'E' and pos + 16 <= len(view):
+                if first != self.written or bytes(view[pos:pos + 16]) != self.whole.digest():
+                    raise ValueError('delta result does not match the source')
+                self.verified = True
+                pos = pos + 16
+            else:
+                raise ValueError('bad delta record')
+
+    def close(self):
+        self.out.close()
+        if self.basis is not None:
+            self.basis.close()
+
+    def finish(self):
+        self.close()
+        if not self.verified:
+            raise ValueError('delta ended early')
+
+    def abort(self):
+        self.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+""" end-to-end digests ; hashed over the blocks as they go """
+def new_digest(algorithm):
+    return hashlib.blake2b(digest_size=32) if algorithm == 'blake2b' else hashlib.new(algorithm)
+
+def hash_range(fd, hasher, start, end):
+    # bytes already on disk, e.g. the part a resumed transfer does not resend
+    while start < end:
+        data = os.pread(fd, min(DATA_BLOCK_SIZE, end - start), start)
+        if not data:
+            raise ValueError('file shrunk while hashed')
+        hasher.update(data)
+        start = start + len(data)
+
+""" per-block compression ; the codec flag of a frame marks a compressed block """
+CODECS = {'zlib': 0x01} # codec -> frame flag
+if lzma is not None:
+    CODECS['lzma'] = 0x02
+
+def compress_block(codec, data):
+    # (flags, payload) ; raw when a zlib probe of the head or the whole block saves too little,
+    # so already-compressed files cost one 64KB probe per block
+    if not data:
+        return 0, data
+    probe = data[:COMPRESS_PROBE_SIZE]
+    if len(zlib.compress(probe, 1)) > len(probe) * (1 - COMPRESS_MIN_SAVING):
+        return 0, data
+    packed = zlib.compress(data, 1) if codec == 'zlib' else lzma.compress(data, preset=1)
+    if len(packed) > len(data) * (1 - COMPRESS_MIN_SAVING):
+        return 0, data
+    return CODECS[codec], packed
+
+def decompress_block(flags, data, limit=MAX_FRAME_SIZE):
+    if flags & CODECS['zlib']:
+        decomp = zlib.decompressobj()
+        raw = decomp.decompress(data, limit)
+        if decomp.unconsumed_tail or not decomp.eof:
+            raise ValueError('bad or oversized zlib block')
+    elif 'lzma' in CODECS and flags & CODECS['lzma']:
+        decomp = lzma.LZMADecompressor()
+        raw = decomp.decompress(data, max_length=limit)
+        if not decomp.eof:
+            raise ValueError('bad or oversized lzma block')
+    else:
+        raise ValueError('unknown codec flags {}'.format(flags))
+    return raw
+
+""" message framing
+v1 : token + 8-digit length (incl. header) + 2-digit msgtype + data
+v2 : struct-packed token, msgtype, flags, stream id, data length + data ; negotiated at AUTH_HI
+"""
+V2_HEADER = struct.Struct('!2sBBIQ')
+
+def pack_header(token, proto, msgtype_value, data_len, flags=0, stream_id=0):
+    if proto == 2:
+        return V2_HEADER.pack(SFTP_DISCRIMINATOR_TOKEN_V2, msgtype_value, flags, stream_id, data_len)
+    if data_len + 12 > 99999999:
+        raise ValueError('message too large for protocol v1')
+    return token + str(data_len + 12).zfill(8).encode() + str(msgtype_value).zfill(2).encode()
+
+class FrameReader():
+
+    def __init__(self, conn, token=SFTP_DISCRIMINATOR_TOKEN, buffer_size=CONN_BUFFER_SIZE):
+        self.conn = conn
+        self.token = token
+        self.proto = 1
+        self.buf = bytearray(buffer_size) # reused for headers and small bodies
+        self.view = memoryview(self.buf)
+        self.start = 0 # first byte not handed out yet
+        self.end = 0   # end of received bytes
+        # message in progress ; kept so an interrupted read can resume
+        self.header = None
+        self.body = None
+        self.body_got = 0
+
+    def recv_into(self, view):
+        nbytes = self.conn.recv_into(view)
+        if nbytes == 0:
+            raise ConnectionError('connection closed by peer')
+        return nbytes
+
+    def fill(self, size):
+        # at least size bytes buffered ; bytes after them stay for the next message
+        if self.start == self.end:
+            self.start, self.end = 0, 0
+        elif self.start + size > len(self.buf):
+            pending = bytes(self.view[self.start:self.end])
+            self.buf[:len(pending)] = pending
+            self.start, self.end = 0, len(pending)
+        while self.end - self.start < size:
+            self.end = self.end + self.recv_into(self.view[self.end:])
+
+    def read_frame(self):
+
+        # exactly the header
+        if self.header is None:
+            header_size = 12 if self.proto == 1 else V2_HEADER.size
+            self.fill(header_size)
+            header = bytes(self.view[self.start:self.start + header_size])
+            if self.proto == 1:
+                if header[:2] != self.token:
+                    raise ValueError('bad token {}'.format(header[:2]))
+                msgtype, flags, stream_id = int(header[10:12]), 0, 0
+                body_len = int(header[2:10]) - 12
+            else:
+                token, msgtype, flags, stream_id, body_len = V2_HEADER.unpack(header)
+                if token != SFTP_DISCRIMINATOR_TOKEN_V2 or body_len > MAX_FRAME_SIZE:
+                    raise ValueError('bad header {}'.format(header))
+            self.start = self.start + header_size
+            self.header = (msgtype, flags, stream_id, body_len)
+        msgtype, flags, stream_id, body_len = self.header
+
+        # exactly the body
+        if body_len <= len(self.buf):
+            self.fill(body_len)
+            data = bytes(self.view[self.start:self.start + body_len])
+            self.start = self.start + body_len
+        else: # larger than the buffer ; received in place
+            if self.body is None:
+                self.body = bytearray(body_len)
+                self.body_got = min(self.end - self.start, body_len)
+                self.body[:self.body_got] = self.view[self.start:self.start + self.body_got]
+                self.start = self.start + self.body_got
+            body_view = memoryview(self.body)
+            while self.body_got < body_len:
+                self.body_got = self.body_got + self.recv_into(body_view[self.body_got:])
+            data, self.body = self.body, None
+
+        self.header = None
+        return msgtype, flags, stream_id, data # (int, int, int, bytes or bytearray)
@@ -12,22 +12,68 @@ import enum
 import csv
 import copy
 import sys
-import subprocess
 import traceback
 import random
+import getopt
+import asyncio
+import hashlib
+import hmac
+import time
+import signal
+import itertools
+import bisect
+import collections
+import re
+import queue
+import json
+import select
+import threading
+import http.server
 from time import gmtime, strftime
-from threading import Thread
+from threading import Thread, Lock, BoundedSemaphore, Event
+from ftp_protocol import (DATA_BLOCK_SIZE, DATA_BLOCK_SIZE_V2, MAX_FRAME_SIZE, SFTP_DISCRIMINATOR_TOKEN,
+                          SFTP_DISCRIMINATOR_TOKEN_V2, PARTIAL_SUFFIX, SYNC_MIN_BLOCK, SYNC_MAX_BLOCK, DIGESTS,
+                          TREE_INLINE_SIZE, parse_options, format_options, set_nodelay, pack_fields, unpack_fields,
+                          partial_name, resume_offset, preallocate, tree_frames, TreeWriter, sync_block_size,
+                          signature_frames, read_signatures, delta_frames, DeltaWriter, new_digest, hash_range,
+                          CODECS, compress_block, decompress_block, V2_HEADER, pack_header, FrameReader)
 
 """ configuration """
 SFTP_FOLDER_PATH = os.path.expanduser("~") + "/.sftp-jhko/"
 USER_TABLE_PATH = SFTP_FOLDER_PATH + "auth.csv"
 ADMIN_ID = 'admin'
 ADMIN_PW = 'adminpw'
-CONN_BUFFER_SIZE = 10240000 # 10MB
-DATA_BLOCK_SIZE = 2048000 # 2MB
-KEEPALIVE_SEC = 60
-RESEND_COUNT = 5
-SFTP_DISCRIMINATOR_TOKEN = b'dg'
+TRANSFER_WINDOW = 16 # max blocks in flight per transfer
+USE_SENDFILE = hasattr(os, 'sendfile') # zero-copy get ; falls back to read+send
+KEEPALIVE_SEC = 60 # tcp keepalive idle time and ALIVE_SIGNAL period of 'alive' clients
+RESEND_COUNT = 5 # keepalive probes before the kernel drops a silent peer
+IDLE_TIMEOUT = 1800 # seconds a session may wait for a command before it is reaped
+REAP_INTERVAL = 15 # seconds between scans of the reaper
+DIGEST_CACHE_ENTRIES = 4096 # whole-file digests kept for checksum and get
+READ_CACHE_SIZE = 268435456 # 256MB of whole files shared by the gets that read ; 0 turns it off
+READ_CACHE_MAX_FILE = 67108864 # 64MB ; larger files are read per session
+LS_BATCH_SIZE = 65536 # 64KB of listing records per LS_DATA
+DURABILITY = 'none' # upload commit : 'none', 'file' (fsync the data before the rename) or 'dir' (and the rename)
+UPLOAD_JOURNAL_PATH = SFTP_FOLDER_PATH + "uploads.journal" # temp files of uploads in progress
+JOURNAL_COMPACT = 4096 # journal lines written before it is rewritten with the live ones
+RATE_LIMIT = 0 # bytes/s of all get/put data together, split evenly between transfers ; 0 is unlimited
+SESSION_RATE_LIMIT = 0 # bytes/s of each session's get/put data ; per user in the 3rd column of auth.csv
+RATE_BURST_SEC = 1 # seconds of its rate a bucket saves up while idle
+LIMITS_PATH = SFTP_FOLDER_PATH + "limits.conf" # 'global = 100M', 'session = 10M' ; applied when it changes
+LIMITS_CHECK_SEC = 1 # seconds between stats of limits.conf
+LISTEN_BACKLOG = 128 # connections the kernel holds before accept
+MAX_SESSIONS = 256 # sessions served at once ; more wait in the admission queue
+MAX_TRANSFERS = 64 # get/put/sync data transfers at once, ranges of a parallel one included
+ADMISSION_QUEUE = 128 # accepted connections waiting for a session slot
+ADMISSION_WAIT = 10 # seconds a connection waits for a session or transfer slot before SERVER_BUSY
+MUX_CHANNELS = 8 # commands a 'mux' session runs on their own streams beside stream 0
+MUX_BLOCK_SIZE = TREE_INLINE_SIZE + 65536 # blocks of a channel's transfers, so the frames of the others interleave finely ;
+                                          # a tree batch still holds one inline file, its record and path
+REUSE_PORT = hasattr(socket, 'SO_REUSEPORT') # a listening socket per worker ; else they share the parent's
+WORKER_RESTART_DELAY = 1 # seconds before a worker that died right after its start is restarted
+STATS_WAIT = 2 # seconds the supervisor waits for the stats of its workers
+BUSY_REPLY_TIMEOUT = 2 # seconds a refused client gets to send its hello
+MAX_BUSY_REPLIES = 16 # refusals in flight ; past them connections are closed without a reply
 
 
 """ MSGTYPE """
@@ -57,6 +103,12 @@ class MsgToSend(enum.Enum):
     PUT_SUCCESS =  enum.auto()
     PUT_FAILURE =  enum.auto()
     EXIT_SUCCESS = enum.auto()  # 24 exit
+    COMMIT_SUCCESS = enum.auto() # 25 commit of a parallel put
+    COMMIT_FAILURE = enum.auto()
+    SYNC_SIG = enum.auto()      # 27 block signatures of a sync put
+    CHECKSUM_PATHERR = enum.auto() # 28 checksum
+    CHECKSUM_SUCCESS = enum.auto()
+    SERVER_BUSY = enum.auto()   # 30 no session or transfer slot free
 
 @enum.unique
 class MsgToRecv(enum.Enum):
@@ -78,30 +130,954 @@ class MsgToRecv(enum.Enum):
     PUT_PROCEED = enum.auto()   # 15 put
     PUT_STOP = enum.auto()
     PUT_DATA = enum.auto()
+    CMD_COMMIT = enum.auto()    # 18 commit of a parallel put
+    CMD_GET_TREE = enum.auto()  # 19 get -r
+    CMD_PUT_TREE = enum.auto()  # 20 put -r
+    CMD_SYNC_GET = enum.auto()  # 21 sync
+    CMD_SYNC_PUT = enum.auto()
+    SYNC_SIG = enum.auto()      # 23 block signatures of a sync get
+    CMD_CHECKSUM = enum.auto()  # 24 checksum
+    PUT_DIGEST = enum.auto()    # 25 digest of the blocks of a put
+
+""" tcp keepalive """
+def set_keepalive(conn):
+    # the kernel probes a silent peer after KEEPALIVE_SEC and gives up after RESEND_COUNT probes ;
+    # data left unacked as long fails the send, so a vanished client cannot hold its session
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_SEC)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_SEC // RESEND_COUNT)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, RESEND_COUNT)
+    if hasattr(socket, 'TCP_USER_TIMEOUT'):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, 2 * KEEPALIVE_SEC * 1000)
+
+""" upload commit ; temp files renamed in place, no mv/rm process """
+TEMP_NAME = re.compile(r'\.[0-9]{8}$|\..+' + re.escape(PARTIAL_SUFFIX) + '$')
+
+def commit_file(tmp_path, path, durability=DURABILITY):
+    # atomic rename over path ; 'file' flushes the data first so a crash never leaves
+    # an empty file under the name, 'dir' also flushes the directory entry
+    if durability != 'none':
+        fd = os.open(tmp_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    os.replace(tmp_path, path)
+    if durability == 'dir':
+        fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class UploadJournal():
+
+    # temp files of uploads in progress, '+path' when created and '-path' when renamed or
+    # removed. The ones a crash left behind are removed by sweep() at the next start.
+    def __init__(self, path=UPLOAD_JOURNAL_PATH, durability=DURABILITY):
+        self.path = path
+        self.durability = durability
+        self.live = set()
+        self.lines = 0
+        self.f = None # no journal until sweep()
+        self.lock = Lock()
+
+    def write(self, line):
+        # with self.lock
+        if self.f is None:
+            return
+        self.f.write(line + '\n')
+        self.f.flush()
+        self.lines = self.lines + 1
+        if self.lines > JOURNAL_COMPACT and self.lines > 2 * len(self.live):
+            self.compact()
+
+    def begin(self, tmp_path):
+        with self.lock:
+            self.live.add(tmp_path)
+            self.write('+' + tmp_path)
+
+    def end(self, tmp_path):
+        with self.lock:
+            if tmp_path in self.live:
+                self.live.remove(tmp_path)
+                self.write('-' + tmp_path)
+
+    def commit(self, tmp_path, path):
+        commit_file(tmp_path, path, self.durability)
+        self.end(tmp_path)
+
+    def discard(self, tmp_path):
+        remove_file(tmp_path)
+        self.end(tmp_path)
+
+    def compact(self):
+        # with self.lock ; the live entries only, swapped in atomically
+        self.f.close()
+        with open(self.path + '.tmp', 'w') as f:
+            for tmp_path in self.live:
+                f.write('+' + tmp_path + '\n')
+        os.replace(self.path + '.tmp', self.path)
+        self.f = open(self.path, 'a')
+        self.lines = len(self.live)
+
+    def sweep(self):
+        # at start, before any session ; only temp names are ever removed
+        live = set()
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    line = line.rstrip('\n')
+                    if line[:1] == '+':
+                        live.add(line[1:])
+                    elif line[:1] == '-':
+                        live.discard(line[1:])
+        except FileNotFoundError:
+            pass
+        removed = 0
+        for tmp_path in live:
+            if TEMP_NAME.match(os.path.basename(tmp_path)) and os.path.isfile(tmp_path):
+                remove_file(tmp_path)
+                removed = removed + 1
+        with self.lock:
+            self.live = set()
+            self.lines = 0
+            self.f = open(self.path, 'w')
+        return removed
+
+UPLOADS = UploadJournal()
+
+""" recursive transfers ; a tree as one stream of records """
+class JournaledTreeWriter(TreeWriter):
+
+    # the temp files of a put -r are journaled like those of a put, so a crash leaves none behind
+    def temp_path(self, path):
+        tmp_path = TreeWriter.temp_path(self, path)
+        UPLOADS.begin(tmp_path)
+        return tmp_path
+
+    def commit(self, tmp_path, path):
+        UPLOADS.commit(tmp_path, path)
+
+    def discard(self, tmp_path):
+        UPLOADS.discard(tmp_path)
+
+""" directory listing ; os.scandir, no ls process """
+def scan_dir(path, long=False):
+    # (type, size, mtime_ns, name) in directory order, dot entries hidden like ls.
+    # size and mtime stay '' unless long ; that saves a stat per entry
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            # d_type of the entry ; no stat
+            if entry.is_dir(follow_symlinks=False):
+                ftype = 'd'
+            elif entry.is_file(follow_symlinks=False):
+                ftype = '-'
+            elif entry.is_symlink():
+                ftype = 'l'
+            else:
+                ftype = '?'
+            size, mtime = '', ''
+            if long:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError: # removed meanwhile
+                    continue
+                size, mtime = st.st_size, st.st_mtime_ns
+            yield ftype, size, mtime, entry.name
+
+def read_records(entries, limit_bytes=LS_BATCH_SIZE):
+    # about limit_bytes of whole records, fields and records all '\0'-separated ; (data, count)
+    batch, batch_len = [], 0
+    for entry in entries:
+        record = '{}\0{}\0{}\0{}'.format(*entry)
+        batch.append(record)
+        batch_len = batch_len + len(record) + 1
+        if batch_len >= limit_bytes:
+            break
+    return '\0'.join(batch).encode(errors='surrogateescape'), len(batch)
+
+def list_names(path):
+    # old clients ; sorted names, one per line, as ls printed them
+    names = sorted(entry[3] for entry in scan_dir(path))
+    return ''.join(name + '\n' for name in names).encode(errors='surrogateescape')
+
+""" user table """
+def hash_password(pw):
+    return hashlib.sha256(pw.encode()).digest()
+
+class UserTable():
+
+    # auth.csv loaded once into {uid: [password hash, ..]} ; a lookup only stats the file
+    # and reloads it when its mtime, inode or size changed
+    def __init__(self, path):
+        self.path = path
+        self.users = {}
+        self.rates = {} # uid -> bytes/s ; users without one are unlimited
+        self.stamp = None
+        self.lock = Lock()
+        # stats
+        self.loads = 0
+        self.load_time = 0.0 # seconds the last load took
+        self.loaded_at = None
+        self.lookups = 0
+
+    def refresh(self):
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_ino, st.st_size)
+        if stamp == self.stamp:
+            return
+        with self.lock:
+            if stamp == self.stamp: # loaded by another session meanwhile
+                return
+            start_time = time.perf_counter()
+            users, rates = {}, {}
+            with open(self.path, 'r') as f:
+                for line in csv.reader(f):
+                    if len(line) >= 2:
+                        users.setdefault(line[0], []).append(hash_password(line[1]))
+                    if len(line) >= 3 and line[2].strip(): # id, pw, rate limit
+                        try:
+                            rates[line[0]] = parse_rate(line[2])
+                        except ValueError:
+                            print('[ERROR] bad rate limit of {} in auth.csv'.format(line[0]))
+            self.users, self.rates, self.stamp = users, rates, stamp
+            self.loads = self.loads + 1
+            self.load_time = time.perf_counter() - start_time
+            self.loaded_at = time.time()
+
+    def check(self, uid, pw):
+        self.refresh()
+        self.lookups = self.lookups + 1
+        pw_hash = hash_password(pw)
+        return any(hmac.compare_digest(pw_hash, h) for h in self.users.get(uid, ()))
+
+    def rate(self, uid):
+        # bytes/s ; without a table no user is limited
+        try:
+            self.refresh()
+        except OSError:
+            return 0
+        return self.rates.get(uid, 0)
+
+    def stats(self):
+        return {'users': len(self.users), 'loads': self.loads, 'load_time_s': round(self.load_time, 6),
+                'loaded_at': self.loaded_at, 'lookups': self.lookups}
+
+USER_TABLES = {} # path -> UserTable
+
+def user_table(user_table_path):
+    if user_table_path not in USER_TABLES:
+        USER_TABLES[user_table_path] = UserTable(user_table_path)
+    return USER_TABLES[user_table_path]
+
+def check_password(uid, pw, user_table_path=USER_TABLE_PATH):
+    return user_table(user_table_path).check(uid, pw)
+
+""" bandwidth shaping ; token buckets around the data blocks of get/put """
+def parse_rate(text):
+    # bytes/s ; '512K', '10M', '1.5G' (powers of 1024) or plain bytes, '0' is unlimited
+    text = text.strip().upper()
+    scale = 1
+    if text[-1:] in ('K', 'M', 'G'):
+        scale = 1024 ** ('KMG'.index(text[-1]) + 1)
+        text = text[:-1]
+    rate = float(text) * scale
+    if rate < 0:
+        raise ValueError('negative rate')
+    return int(rate)
+
+def format_rate(rate):
+    return '{:.1f}MB/s'.format(rate / 1048576) if rate else 'unlimited'
+
+class TokenBucket():
+
+    # rate bytes/s, saving up RATE_BURST_SEC of it while idle. A block goes when the bucket is
+    # out of debt and may take it below zero, so blocks larger than the burst still pass.
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+
+    def reserve(self, nbytes, now):
+        # seconds to wait before sending nbytes
+        self.tokens = min(self.rate * RATE_BURST_SEC, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        wait = max(0.0, -self.tokens / self.rate)
+        self.tokens = self.tokens - nbytes
+        return wait
+
+class Shaper():
+
+    # rate limits of get/put data : a bucket per user and per session, and the global rate
+    # split evenly between the transfers running. Each transfer's blocks are due at its share
+    # (a virtual clock), so the blocks of a big get interleave with those of everyone else.
+    # reserve() returns the wait ; threads sleep it off, coroutines await it.
+    def __init__(self, rate=RATE_LIMIT, session_rate=SESSION_RATE_LIMIT, path=LIMITS_PATH):
+        self.defaults = (rate, session_rate) # of the command line ; limits.conf overrides them
+        self.rate = rate
+        self.session_rate = session_rate
+        self.path = path
+        self.stamp = None
+        self.checked = 0.0
+        self.flows = set() # sessions in a transfer
+        self.users = {} # uid -> TokenBucket shared by the user's sessions
+        self.user_rates = {} # (user table, uid) -> bytes/s, looked up again after LIMITS_CHECK_SEC
+        self.workers = 1 # processes enforcing the limits ; each takes an even share of the global and user rates
+        self.lock = Lock()
+        # stats
+        self.reloads = 0
+        self.delayed = 0.0 # seconds of waits handed out
+
+    def refresh(self, now):
+        # with self.lock ; limits.conf and the user tables are stat'ed at most every LIMITS_CHECK_SEC
+        if now - self.checked < LIMITS_CHECK_SEC:
+            return
+        self.checked = now
+        self.user_rates = {}
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime_ns, st.st_ino, st.st_size)
+        except OSError:
+            stamp = None
+        if stamp == self.stamp:
+            return
+        self.stamp = stamp
+        rate, session_rate = self.defaults
+        try:
+            if stamp is not None:
+                with open(self.path, 'r') as f:
+                    for line in f:
+                        name, _, value = line.split('#')[0].partition('=')
+                        if name.strip() == 'global':
+                            rate = parse_rate(value)
+                        elif name.strip() == 'session':
+                            session_rate = parse_rate(value)
+        except (OSError, ValueError) as e: # the limits in force stay
+            print('[ERROR] limits.conf : {}'.format(e))
+            return
+        self.rate, self.session_rate = rate, session_rate
+        self.reloads = self.reloads + 1
+        print('[INFO] rate limits : global {} session {}'.format(format_rate(rate), format_rate(session_rate)))
+
+    def start(self, session):
+        with self.lock:
+            self.flows.add(session)
+            session.due = 0.0
+
+    def stop(self, session):
+        with self.lock:
+            self.flows.discard(session)
+
+    def reserve(self, session, nbytes):
+        # seconds session waits before nbytes of data go (or, received, are acked)
+        now = time.monotonic()
+        wait = 0.0
+        with self.lock:
+            self.refresh(now)
+            key = (session.user_table_path, session.user_info)
+            user_rate = self.user_rates.get(key)
+            if user_rate is None:
+                user_rate = self.user_rates[key] = user_table(session.user_table_path).rate(session.user_info)
+            if self.rate:
+                start = max(now, session.due)
+                session.due = start + nbytes * max(1, len(self.flows)) * self.workers / self.rate
+                wait = start - now
+            if user_rate:
+                bucket = self.users.setdefault(session.user_info, TokenBucket())
+                bucket.rate = user_rate / self.workers
+                wait = max(wait, bucket.reserve(nbytes, now))
+            if self.session_rate:
+                session.bucket.rate = self.session_rate
+                wait = max(wait, session.bucket.reserve(nbytes, now))
+            self.delayed = self.delayed + wait
+        return wait
+
+    def stats(self):
+        return {'global': format_rate(self.rate), 'session': format_rate(self.session_rate),
+                'transfers': len(self.flows), 'reloads': self.reloads, 'delayed_s': round(self.delayed, 3)}
+
+SHAPER = Shaper()
+
+""" end-to-end digests ; hashed over the blocks as they go """
+class DigestCache():
+
+    # whole-file digests, least recently used out ; keyed by (device, inode, size, mtime),
+    # so a rewritten file never hits an old entry
+    def __init__(self, max_entries=DIGEST_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, fd, algorithm):
+        st = os.fstat(fd)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, algorithm)
+
+    def get(self, key):
+        with self.lock:
+            digest = self.entries.get(key)
+            if digest is None:
+                self.misses = self.misses + 1
+                return None
+            self.hits = self.hits + 1
+            self.entries.move_to_end(key)
+            return digest
+
+    def put(self, fd, key, digest):
+        # only when the file is still the one hashed
+        if self.key(fd, key[4]) != key:
+            return
+        with self.lock:
+            self.entries[key] = digest
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+DIGEST_CACHE = DigestCache()
+
+def file_digest(fd, algorithm):
+    # whole-file digest, hashed once per version of the file
+    key = DIGEST_CACHE.key(fd, algorithm)
+    digest = DIGEST_CACHE.get(key)
+    if digest is None:
+        hasher = new_digest(algorithm)
+        hash_range(fd, hasher, 0, key[2])
+        digest = hasher.hexdigest()
+        DIGEST_CACHE.put(fd, key, digest)
+    return digest
+
+""" hot files ; read once, shared by concurrent gets """
+class ReadCache():
+
+    # whole files as read-only buffers, least recently used out past max_bytes ; keyed by
+    # (path, device, inode, size, mtime), so a rewritten file never hits an old entry.
+    # Gets slice them without a copy ; an evicted buffer lives on until its last get is done.
+    def __init__(self, max_bytes=READ_CACHE_SIZE, max_file=READ_CACHE_MAX_FILE):
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.entries = collections.OrderedDict() # key -> [Event set once read, memoryview or None]
+        self.nbytes = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, f):
+        st = os.fstat(f.fileno())
+        return (f.name, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def acquire(self, f):
+        # the bytes of f, or None when it is not cached ; concurrent first gets
+        # of a file wait for the one that reads it
+        key = self.key(f)
+        if key[3] == 0 or key[3] > min(self.max_file, self.max_bytes):
+            return None
+        loader = False
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits = self.hits + 1
+                self.entries.move_to_end(key)
+            else:
+                self.misses = self.misses + 1
+                entry = self.entries[key] = [Event(), None]
+                self.nbytes = self.nbytes + key[3]
+                self.evict()
+                loader = True
+        if loader:
+            self.load(f, key, entry)
+        entry[0].wait()
+        return entry[1]
+
+    def load(self, f, key, entry):
+        data = bytearray(key[3])
+        view = memoryview(data)
+        try:
+            got = 0
+            f.seek(0)
+            while got < len(data):
+                n = f.readinto(view[got:])
+                if not n: # shrunk
+                    raise ValueError('file shrunk while cached')
+                got = got + n
+            entry[1] = view.toreadonly()
+        except (OSError, ValueError):
+            with self.lock: # the gets waiting for it read the file themselves
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+                    self.nbytes = self.nbytes - key[3]
+        finally:
+            entry[0].set()
+
+    def evict(self):
+        # with self.lock ; oldest first, files still being read stay
+        for key in list(self.entries):
+            if self.nbytes <= self.max_bytes:
+                break
+            if self.entries[key][0].is_set():
+                del self.entries[key]
+                self.nbytes = self.nbytes - key[3]
+                self.evictions = self.evictions + 1
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.nbytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+READ_CACHE = ReadCache()
+
+""" metrics ; Prometheus text format on --metrics-port """
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Counter():
+
+    kind = 'counter'
+
+    def __init__(self, name, help_str, label_names=(), func=None):
+        self.name = name
+        self.help = help_str
+        self.label_names = label_names
+        self.func = func # read at scrape time instead of inc()
+        self.values = {} # label values -> number
+        self.lock = Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def format_labels(self, labels, extra=''):
+        pairs = ['{}="{}"'.format(k, v) for k, v in zip(self.label_names, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self):
+        if self.func is not None:
+            yield self.name, self.func()
+            return
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield self.name + self.format_labels(labels), value
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+class Histogram(Counter):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_str, label_names=(), buckets=LATENCY_BUCKETS):
+        Counter.__init__(self, name, help_str, label_names)
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None: # [count per bucket .., +Inf], sum
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][idx] = state[0][idx] + 1
+            state[1] = state[1] + value
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative = cumulative + count
+                yield self.name + '_bucket' + self.format_labels(labels, 'le="{}"'.format(bound)), cumulative
+            yield self.name + '_sum' + self.format_labels(labels), total
+            yield self.name + '_count' + self.format_labels(labels), cumulative
+
+class MetricsRegistry():
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for sample_name, value in metric.samples():
+                lines.append('{} {}'.format(sample_name, value))
+        return '\n'.join(lines) + '\n'
+
+METRICS = MetricsRegistry()
+SESSIONS_ACTIVE = METRICS.add(Gauge('sftp_sessions_active', 'Client sessions open.'))
+SESSIONS_TOTAL = METRICS.add(Counter('sftp_sessions_total', 'Client sessions accepted.'))
+AUTH_FAILURES = METRICS.add(Counter('sftp_auth_failures_total', 'Failed password attempts.'))
+COMMANDS = METRICS.add(Counter('sftp_commands_total', 'Commands handled.', ('cmd',)))
+COMMAND_SECONDS = METRICS.add(Histogram('sftp_command_duration_seconds', 'Command latency.', ('cmd',)))
+TRANSFERS = METRICS.add(Counter('sftp_transfers_total', 'Finished get/put transfers.', ('cmd', 'result')))
+BYTES_SENT = METRICS.add(Counter('sftp_bytes_sent_total', 'Bytes sent to clients, headers included.'))
+BYTES_RECEIVED = METRICS.add(Counter('sftp_bytes_received_total', 'Bytes received from clients, headers included.'))
+BLOCK_RTT_SECONDS = METRICS.add(Histogram('sftp_block_rtt_seconds', 'GET_DATA block sent to its ack.'))
+SESSIONS_QUEUED = METRICS.add(Gauge('sftp_sessions_queued', 'Connections waiting for a session slot.'))
+TRANSFERS_ACTIVE = METRICS.add(Gauge('sftp_transfers_active', 'Data transfers holding a transfer slot.'))
+CHANNELS_ACTIVE = METRICS.add(Gauge('sftp_channels_active', 'Commands running on a stream of a mux session.'))
+SESSIONS_REAPED = METRICS.add(Counter('sftp_sessions_reaped_total', 'Sessions closed by the reaper.', ('reason',)))
+BUSY_REPLIES = METRICS.add(Counter('sftp_busy_replies_total', 'Sessions and transfers refused with SERVER_BUSY.', ('kind',)))
+METRICS.add(Counter('sftp_user_table_lookups_total', 'Password checks against the user table.',
+                    func=lambda: user_table(USER_TABLE_PATH).lookups))
+METRICS.add(Counter('sftp_user_table_loads_total', 'Loads of auth.csv.',
+                    func=lambda: user_table(USER_TABLE_PATH).loads))
+METRICS.add(Counter('sftp_digest_cache_hits_total', 'Whole-file digests found in the cache.',
+                    func=lambda: DIGEST_CACHE.hits))
+METRICS.add(Counter('sftp_digest_cache_misses_total', 'Whole-file digests hashed from disk.',
+                    func=lambda: DIGEST_CACHE.misses))
+METRICS.add(Counter('sftp_read_cache_hits_total', 'Gets served from a file in the read cache.',
+                    func=lambda: READ_CACHE.hits))
+METRICS.add(Counter('sftp_read_cache_misses_total', 'Files read into the read cache.',
+                    func=lambda: READ_CACHE.misses))
+METRICS.add(Counter('sftp_read_cache_evictions_total', 'Files dropped from the read cache for room.',
+                    func=lambda: READ_CACHE.evictions))
+METRICS.add(Counter('sftp_shaping_delay_seconds_total', 'Seconds get/put blocks were held back by rate limits.',
+                    func=lambda: SHAPER.delayed))
+METRICS.add(Gauge('sftp_read_cache_bytes', 'Bytes of files in the read cache.',
+                  func=lambda: READ_CACHE.nbytes))
+
+COMMAND_NAMES = {MsgToRecv.CMD_CD: 'cd', MsgToRecv.CMD_PWD: 'pwd', MsgToRecv.CMD_LS: 'ls',
+                 MsgToRecv.CMD_GET: 'get', MsgToRecv.CMD_PUT: 'put', MsgToRecv.CMD_COMMIT: 'commit',
+                 MsgToRecv.CMD_GET_TREE: 'get_tree', MsgToRecv.CMD_PUT_TREE: 'put_tree',
+                 MsgToRecv.CMD_SYNC_GET: 'sync_get', MsgToRecv.CMD_SYNC_PUT: 'sync_put',
+                 MsgToRecv.CMD_CHECKSUM: 'checksum'}
+TRANSFER_COMMANDS = (MsgToRecv.CMD_GET, MsgToRecv.CMD_PUT, MsgToRecv.CMD_GET_TREE, MsgToRecv.CMD_PUT_TREE,
+                     MsgToRecv.CMD_SYNC_GET, MsgToRecv.CMD_SYNC_PUT) # commands holding a transfer slot
+
+def observe_command(msgtype, start_time):
+    cmd = COMMAND_NAMES.get(msgtype)
+    if cmd is not None:
+        COMMANDS.inc(1, (cmd,))
+        COMMAND_SECONDS.observe(time.perf_counter() - start_time, (cmd,))
+
+def serve_metrics(port):
+    # GET /metrics on 127.0.0.1:port, in a daemon thread
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = METRICS.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.HTTPServer(('127.0.0.1', port), MetricsHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+""" admission control """
+class Admission():
+    # at most max_sessions sessions and max_transfers transfers at once ; a connection over the
+    # session limit waits in a FIFO of queue_size for ADMISSION_WAIT seconds, then gets SERVER_BUSY
+
+    def __init__(self, max_sessions=MAX_SESSIONS, max_transfers=MAX_TRANSFERS, queue_size=ADMISSION_QUEUE):
+        self.max_sessions = max_sessions
+        self.queue_size = queue_size
+        self.transfers = BoundedSemaphore(max_transfers)
+        self.active = 0
+        self.waiting = collections.deque() # (conn, ip, port, deadline), oldest first
+        self.lock = Lock()
+
+    def admit(self, conn, ip, port):
+        # from the accept loop
+        with self.lock:
+            expired = self.pop_expired()
+            if self.active < self.max_sessions:
+                self.active = self.active + 1
+                admitted = True
+            elif len(self.waiting) < self.queue_size:
+                self.waiting.append((conn, ip, port, time.monotonic() + ADMISSION_WAIT))
+                SESSIONS_QUEUED.inc()
+                admitted = None
+            else:
+                admitted = False
+        self.refuse(expired)
+        if admitted:
+            self.start(conn, ip, port)
+        elif admitted is None:
+            print('[INFO] client at {}:{} queued ; {} waiting.'.format(ip, port, len(self.waiting)))
+        else:
+            self.refuse([(conn, ip, port, None)])
+
+    def done(self):
+        # a session ended ; its slot goes to the oldest waiting connection. O(1), no thread list to scan
+        with self.lock:
+            expired = self.pop_expired()
+            entry = self.waiting.popleft() if self.waiting else None
+            if entry is None:
+                self.active = self.active - 1
+            else:
+                SESSIONS_QUEUED.dec()
+        self.refuse(expired)
+        if entry is not None:
+            self.start(*entry[:3])
+
+    def expire(self):
+        # from the accept loop while no connection comes
+        with self.lock:
+            expired = self.pop_expired()
+        self.refuse(expired)
+
+    def pop_expired(self):
+        # lock held ; deadlines grow along the queue
+        expired = []
+        now = time.monotonic()
+        while self.waiting and self.waiting[0][3] <= now:
+            expired.append(self.waiting.popleft())
+            SESSIONS_QUEUED.dec()
+        return expired
+
+    def start(self, conn, ip, port):
+        SESSIONS_ACTIVE.inc()
+        ClientThread(conn, ip, port, self).start()
+        print('[INFO] client at {}:{} thread started.'.format(ip, port))
+
+    def refuse(self, entries):
+        for (conn, ip, port, deadline) in entries:
+            print('[INFO] client at {}:{} refused ; server busy.'.format(ip, port))
+            reply_busy(conn)
+
+BUSY_REPLY_SLOTS = BoundedSemaphore(MAX_BUSY_REPLIES)
+
+def reply_busy(conn):
+    # SERVER_BUSY in answer to the client's hello (v1 ; nothing is negotiated yet), in a short
+    # thread so a slow client cannot stall the accept loop
+    BUSY_REPLIES.inc(1, ('session',))
+    if not BUSY_REPLY_SLOTS.acquire(blocking=False):
+        conn.close()
+        return
+
+    def reply():
+        try:
+            conn.settimeout(BUSY_REPLY_TIMEOUT)
+            FrameReader(conn).read_frame() # hello ; read so closing does not reset the reply
+            conn.sendall(pack_header(SFTP_DISCRIMINATOR_TOKEN, 1, MsgToSend.SERVER_BUSY.value, 4) + b'busy')
+        except (OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+            BUSY_REPLY_SLOTS.release()
+
+    Thread(target=reply, daemon=True).start()
+
+""" idle sessions """
+class Reaper(Thread):
+    # closes sessions waiting for a command past idle_timeout, and those of 'alive' clients
+    # whose pings stopped for three periods ; scans every REAP_INTERVAL (idle_timeout if
+    # shorter) in a daemon thread
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT):
+        Thread.__init__(self, daemon=True)
+        self.idle_timeout = idle_timeout
+        self.sessions = {} # id -> ClientThread ; added and removed in O(1)
+        self.lock = Lock()
+        self.reaped = 0
+
+    def add(self, session):
+        with self.lock:
+            self.sessions[id(session)] = session
+
+    def remove(self, session):
+        with self.lock:
+            self.sessions.pop(id(session), None)
+
+    def reason(self, session, now):
+        # why the session should go, or None
+        if session.idle_since is None or session.channels: # a command runs ; tcp keepalive covers it
+            return None
+        if session.alive: # its pings show the client is there ; only silence ends it
+            return 'silent' if now - session.last_recv > 3 * KEEPALIVE_SEC else None
+        if now - session.idle_since > self.idle_timeout:
+            return 'idle'
+        return None
+
+    def run(self):
+        while True:
+            time.sleep(min(REAP_INTERVAL, self.idle_timeout))
+            now = time.monotonic()
+            with self.lock:
+                sessions = list(self.sessions.values())
+            for session in sessions:
+                reason = self.reason(session, now)
+                if reason is not None:
+                    self.reap(session, reason)
+
+    def reap(self, session, reason):
+        with self.lock:
+            if self.sessions.pop(id(session), None) is None:
+                return
+        self.count(session, reason)
+        try: # the session's blocked recv sees end of file ; it says EXIT_SUCCESS and ends
+            session.conn.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def count(self, session, reason):
+        with self.lock:
+            self.reaped = self.reaped + 1
+        SESSIONS_REAPED.inc(1, (reason,))
+        print('[INFO] client at {}:{} reaped ; {}.'.format(session.ip, session.port, reason))
+
+REAPER = Reaper()
+
+""" server stats """
+def server_stats():
+    return {'user_table': user_table(USER_TABLE_PATH).stats(), 'digest_cache': DIGEST_CACHE.stats(),
+            'read_cache': READ_CACHE.stats(), 'shaping': SHAPER.stats(),
+            'sessions': {'active': SESSIONS_ACTIVE.values.get((), 0), 'reaped': REAPER.reaped,
+                         'channels': CHANNELS_ACTIVE.values.get((), 0)}}
+
+def print_stats(signum=None, frame=None, merged=None):
+    # on SIGUSR1 and at shutdown ; a supervisor passes the merged stats of its workers
+    for name, stats in (merged or server_stats()).items():
+        print('[STATS] {} {}'.format(name, ' '.join('{}={}'.format(k, v) for k, v in stats.items())))
 
 """ in each thread """
 class ClientThread(Thread):
 
-    def __init__(self, conn, ip, port):
+    FEATURES = ('window', 'proto', 'resume', 'segments', 'ls2', 'compress', 'tree',
+                'sync', 'digest', 'busy', 'alive', 'pipeline', 'rtt1', 'mux') # session options this engine accepts
+
+    def __init__(self, conn, ip, port, admission=None):
         Thread.__init__(self)
         self.conn = conn
         self.ip = ip
         self.port = port
+        self.admission = admission # session and transfer slots ; None runs unbounded
+        self.transfer_slot = False
 
-        self.conn_buffer_size = copy.deepcopy(CONN_BUFFER_SIZE)
         self.user_table_path = copy.deepcopy(USER_TABLE_PATH)
-        self.last_conn_time = copy.deepcopy(KEEPALIVE_SEC)
+        self.last_recv = time.monotonic() # any frame ; an 'alive' client pings every KEEPALIVE_SEC
+        self.idle_since = self.last_recv # waiting for a command since ; None while one runs
         self.token = copy.deepcopy(SFTP_DISCRIMINATOR_TOKEN)
 
+        self.reader = FrameReader(conn, self.token)
+
         self.user_info = "" # filled at auth stage.
+        self.bucket = TokenBucket() # session rate limit
+        self.due = 0.0 # when the next block of the transfer is due at its share of the global rate
         self.pwd = os.path.expanduser("~") + '/' # initialized to user base path
+        self.window = 1 # blocks in flight ; 1 is stop-and-wait
+        self.use_sendfile = USE_SENDFILE
+        self.proto = 1
+        self.block_size = DATA_BLOCK_SIZE
+        self.resume = False # byte-offset restart of get/put
+        self.segments = False # byte ranges of a parallel get/put
+        self.ls2 = False # structured, paged listing
+        self.codec = None # compression of GET_DATA/PUT_DATA blocks
+        self.tree = False # get/put -r
+        self.sync = False # delta sync get/put
+        self.digest = None # hash of get/put blocks, checked before the rename
+        self.busy = False # client understands SERVER_BUSY in answer to a transfer command
+        self.alive = False # client sends ALIVE_SIGNAL while idle
+        self.pipeline = False # client sends commands before the previous one is done
+        self.pending = collections.deque() # such commands, received while one ran
+        self.rtt1 = False # cd, ls and get answered in one round trip
+        self.mux = False # commands on their own stream ids, run by channels
+        self.stream_id = 0 # of the frames this thread sends and receives
+        self.inbox = None # frames of stream 0 routed by the reader thread of a mux session
+        self.channels = {} # stream id -> Channel running on it
+        self.send_lock = Lock() # one frame at a time on the socket ; shared with the channels
+
+    def negotiate(self, options):
+        accepted = {}
+        if 'window' in self.FEATURES and options.get('window', '').isdigit():
+            self.window = max(1, min(int(options['window']), TRANSFER_WINDOW))
+            accepted['window'] = self.window
+        if 'proto' in self.FEATURES and options.get('proto') == '2':
+            accepted['proto'] = 2 # switched once the reply is out
+        if 'resume' in self.FEATURES and 'resume' in options:
+            self.resume = True
+            accepted['resume'] = ''
+        if 'segments' in self.FEATURES and 'segments' in options:
+            self.segments = True
+            accepted['segments'] = ''
+        if 'ls2' in self.FEATURES and 'ls2' in options:
+            self.ls2 = True
+            accepted['ls2'] = ''
+        if 'compress' in self.FEATURES and accepted.get('proto') == 2: # codec flags need v2 frames
+            # the first codec of the client's list this side has
+            for codec in options.get('compress', '').split(','):
+                if codec in CODECS:
+                    self.codec = codec
+                    accepted['compress'] = codec
+                    break
+        if 'tree' in self.FEATURES and 'tree' in options:
+            self.tree = True
+            accepted['tree'] = ''
+        if 'sync' in self.FEATURES and 'sync' in options:
+            self.sync = True
+            accepted['sync'] = ''
+        if 'digest' in self.FEATURES:
+            for algorithm in options.get('digest', '').split(','):
+                if algorithm in DIGESTS:
+                    self.digest = algorithm
+                    accepted['digest'] = algorithm
+                    break
+        if 'busy' in self.FEATURES and 'busy' in options:
+            self.busy = True
+            accepted['busy'] = ''
+        if 'alive' in self.FEATURES and 'alive' in options:
+            self.alive = True
+            accepted['alive'] = KEEPALIVE_SEC
+        if 'pipeline' in self.FEATURES and 'pipeline' in options:
+            self.pipeline = True
+            accepted['pipeline'] = ''
+        if 'rtt1' in self.FEATURES and 'rtt1' in options:
+            self.rtt1 = True
+            accepted['rtt1'] = ''
+        if 'mux' in self.FEATURES and 'mux' in options and accepted.get('proto') == 2: # stream ids of v2 frames
+            self.mux = True
+            accepted['mux'] = MUX_CHANNELS
+        return accepted
+
+    def switch_proto(self, proto):
+        self.proto = proto
+        self.reader.proto = proto
+        self.block_size = DATA_BLOCK_SIZE_V2 if proto == 2 else DATA_BLOCK_SIZE
 
     def authenticate(self):
 
-        # MSG1 : recv hello
+        # MSG1 : recv hello (with session options)
         (m1t, m1) = self.recv()
-        # MSG2 : send hello back
-        self.send( MsgToSend.AUTH_PROCEED, 'hello+back')
+        accepted = self.negotiate(parse_options(m1.decode()))
+        # MSG2 : send hello back (with accepted options)
+        self.send( MsgToSend.AUTH_PROCEED, 'hello+back' + format_options(accepted))
+        if accepted:
+            set_nodelay(self.conn)
+        if accepted.get('proto') == 2:
+            self.switch_proto(2)
         # MSG3 :recv id
         (m3t, m3) = self.recv()
         # MSG4 : send what is pw
@@ -110,24 +1086,46 @@ class ClientThread(Thread):
         while True:
             # MSG5 : recv pw
             (m5t, m5) = self.recv()
-            # open file read mode and query password
-            with open(self.user_table_path, 'r') as f:
-                auth_granted = False
-                ff = csv.reader(f)
-                for line in ff:
-                    if line[0] == m3.decode() and line[1] == m5.decode():
-                        auth_granted = True
-                f.close()
+            auth_granted = check_password(m3.decode(), m5.decode(), self.user_table_path)
             if auth_granted:
                 self.user_info = m3.decode()
                 break
             else:
+                AUTH_FAILURES.inc()
                 # MSG6: send passwd error
                 self.send( MsgToSend.AUTH_FAILURE , 'passwderror')
         # MSG7 : send auth ok
         self.send( MsgToSend.AUTH_SUCCESS , 'auth ok')
         return
 
+    def begin_transfer(self):
+        # a transfer slot ; old clients wait for one, busy-aware ones get SERVER_BUSY after ADMISSION_WAIT
+        if self.admission is None:
+            SHAPER.start(self)
+            return True
+        slots = self.admission.transfers
+        if slots.acquire(timeout=ADMISSION_WAIT) or (not self.busy and slots.acquire()):
+            self.transfer_slot = True
+            TRANSFERS_ACTIVE.inc()
+            SHAPER.start(self)
+            return True
+        BUSY_REPLIES.inc(1, ('transfer',))
+        self.send(MsgToSend.SERVER_BUSY, 'busy')
+        return False
+
+    def end_transfer(self):
+        SHAPER.stop(self)
+        if self.transfer_slot:
+            self.transfer_slot = False
+            TRANSFERS_ACTIVE.dec()
+            self.admission.transfers.release()
+
+    def shape(self, nbytes):
+        # sleeps off the rate limits of nbytes of data
+        delay = SHAPER.reserve(self, nbytes)
+        if delay > 0:
+            time.sleep(delay)
+
     def terminate(self):
 
         try:
@@ -139,41 +1137,289 @@ class ClientThread(Thread):
         # exit thread
         sys.exit()
 
+    def read_frame(self):
+        # (msgtype, flags, data) ; a mux session's frames come through the inbox of their stream
+        if self.inbox is not None:
+            frame = self.inbox.get()
+            if frame is None: # the reader thread saw the end of the connection
+                self.inbox.put(None)
+                raise ConnectionError('connection closed by peer')
+            return frame
+        msgtype, flags, stream_id, recv_data_bin = self.reader.read_frame()
+        self.last_recv = time.monotonic()
+        BYTES_RECEIVED.inc((12 if self.proto == 1 else V2_HEADER.size) + len(recv_data_bin))
+        return msgtype, flags, recv_data_bin
+
     def recv(self):
 
-        recv_binary = b''
-        msg_len = -1
-        firstMsgArrived = False
+        # raises on a closed connection or a bad token ; the session ends
         while True:
-            recved = self.conn.recv(self.conn_buffer_size)
-            recv_binary = recv_binary + recved
-            if recv_binary[:2] != b'dg':
-                return (MsgToRecv.PUT_STOP, b'')
-            if not firstMsgArrived:
-                msg_len = int(recv_binary[2:10])
-                firstMsgArrived = True
-            if len(recv_binary) >= msg_len :
-                break
-
-        recv_msgtype = MsgToRecv(int(recv_binary[10:12]))
-        recv_data_bin = recv_binary[12:]
+            msgtype, flags, recv_data_bin = self.read_frame()
+            if flags and self.codec is not None: # compressed block
+                recv_data_bin = decompress_block(flags, recv_data_bin)
+            recv_msgtype = MsgToRecv(msgtype)
+            # a pipelined command waits until the one running is done
+            if self.pipeline and self.idle_since is None and \
+                    (recv_msgtype in COMMAND_NAMES or recv_msgtype == MsgToRecv.CMD_EXIT):
+                self.pending.append((recv_msgtype, recv_data_bin))
+                continue
+            break
 
         if recv_msgtype == MsgToRecv.CMD_EXIT:
             self.terminate()
 
         return recv_msgtype, recv_data_bin  # (MsgToRecv, bytes)
 
-    def send(self, send_msgtype, send_data=''):
+    def next_command(self):
+        # commands pipelined during the last one come first
+        if not self.pending:
+            return self.recv()
+        (recv_msgtype, recv_data_bin) = self.pending.popleft()
+        if recv_msgtype == MsgToRecv.CMD_EXIT:
+            self.terminate()
+        return recv_msgtype, recv_data_bin
+
+    def demux(self):
+
+        # reader thread of a mux session ; frames of stream 0 go to the session. The first frame
+        # of another stream opens a channel running that command, its later frames go to the channel
+        try:
+            while True:
+                msgtype, flags, stream_id, recv_data_bin = self.reader.read_frame()
+                self.last_recv = time.monotonic()
+                BYTES_RECEIVED.inc(V2_HEADER.size + len(recv_data_bin))
+                channel = self.channels.get(stream_id)
+                if stream_id == 0:
+                    self.inbox.put((msgtype, flags, recv_data_bin))
+                elif channel is not None:
+                    channel.inbox.put((msgtype, flags, recv_data_bin))
+                elif MsgToRecv(msgtype) not in COMMAND_NAMES: # late frames of a channel that ended
+                    continue
+                elif len(self.channels) >= MUX_CHANNELS:
+                    BUSY_REPLIES.inc(1, ('channel',))
+                    with self.send_lock:
+                        self.conn.sendall(pack_header(self.token, self.proto, MsgToSend.SERVER_BUSY.value, 4, 0,
+                                                      stream_id) + b'busy')
+                else:
+                    channel = Channel(self, stream_id)
+                    channel.inbox.put((msgtype, flags, recv_data_bin))
+                    self.channels[stream_id] = channel
+                    channel.start()
+        except Exception as e: # closed, reaped or a bad frame ; every stream sees the end
+            self.inbox.put(None)
+            for channel in list(self.channels.values()):
+                channel.inbox.put(None)
+
+    def send(self, send_msgtype, send_data='', flags=0):
 
-        send_msgtype_bin = str(send_msgtype.value).zfill(2).encode()
-        send_data_bin = send_data if type(send_data) is bytes \
+        send_data_bin = send_data if type(send_data) in (bytes, bytearray, memoryview) \
                                     else send_data.encode()
-        send_binary = send_msgtype_bin + send_data_bin
-        send_len_bin = str(int(len(send_binary))+10).zfill(8).encode()
-        send_binary = self.token + send_len_bin + send_binary
+        header = pack_header(self.token, self.proto, send_msgtype.value, len(send_data_bin), flags,
+                             self.stream_id)
 
-        self.conn.send(send_binary)
+        with self.send_lock:
+            if len(send_data_bin) < 65536: # one segment
+                self.conn.sendall(header + send_data_bin)
+            else: # no copy of the block
+                self.conn.sendall(header, getattr(socket, 'MSG_MORE', 0))
+                self.conn.sendall(send_data_bin)
+        BYTES_SENT.inc(len(header) + len(send_data_bin))
 
+    def send_block(self, send_msgtype, data):
+        # a data block, compressed when the session has a codec and it pays off
+        if self.codec is None:
+            self.send(send_msgtype, data)
+            return
+        flags, payload = compress_block(self.codec, data)
+        self.send(send_msgtype, payload, flags)
+
+    def sendfile(self, send_msgtype, f, offset, count):
+
+        # header first, then the body straight from the page cache
+        with self.send_lock:
+            self.conn.sendall(pack_header(self.token, self.proto, send_msgtype.value, count, 0, self.stream_id),
+                              getattr(socket, 'MSG_MORE', 0))
+            sent = self.conn.sendfile(f, offset, count)
+            if sent < count: # file shrunk ; pad to keep the frame length, then fail
+                self.conn.sendall(bytes(count - sent))
+        BYTES_SENT.inc((12 if self.proto == 1 else V2_HEADER.size) + count)
+        if sent < count:
+            raise Exception
+
+    def send_file_blocks(self, f, offset=0, length=None, hasher=None):
+
+        # GET_DATA blocks of [offset, offset + length) with self.window of them in flight,
+        # then the empty one ; hasher sees every byte sent
+        end = os.fstat(f.fileno()).st_size
+        if length is not None:
+            end = min(end, offset + length)
+        sent, acked = 0, 0
+        sent_times = collections.deque() # of the blocks not acked yet
+        use_sendfile = self.use_sendfile and self.codec is None and hasher is None # those need the bytes
+        cached = None if use_sendfile else READ_CACHE.acquire(f) # shared with the other gets of it
+        f.seek(offset)
+        while offset < end:
+            frag_len = min(self.block_size, end - offset)
+            self.shape(frag_len)
+            if use_sendfile:
+                self.sendfile(MsgToSend.GET_DATA, f, offset, frag_len)
+            else:
+                data_frag_bin = cached[offset:offset + frag_len] if cached is not None else f.read(frag_len)
+                if not data_frag_bin : # shrunk ; end
+                    break
+                if hasher is not None:
+                    hasher.update(data_frag_bin)
+                self.send_block(MsgToSend.GET_DATA, data_frag_bin)
+                frag_len = len(data_frag_bin)
+            offset = offset + frag_len
+            sent = sent + 1
+            sent_times.append(time.perf_counter())
+            while sent - acked >= self.window:
+                acked = self.recv_ack(acked, MsgToRecv.GET_STOP, sent_times)
+        # every block acked, then send the empty one
+        while acked < sent:
+            acked = self.recv_ack(acked, MsgToRecv.GET_STOP, sent_times)
+        self.send(MsgToSend.GET_DATA, b'')
+
+
+    def send_frames(self, frames):
+
+        # frames (of a tree or a delta) as GET_DATA with self.window of them in flight, then
+        # the empty one ; (file, offset, length) slices go by sendfile like a get
+        sent, acked = 0, 0
+        use_sendfile = self.use_sendfile and self.codec is None
+        for frame in frames:
+            self.shape(frame[2] if type(frame) is tuple else len(frame))
+            if type(frame) is tuple: # (file, offset, length)
+                f, offset, length = frame
+                if use_sendfile:
+                    self.sendfile(MsgToSend.GET_DATA, f, offset, length)
+                else:
+                    data_frag_bin = os.pread(f.fileno(), length, offset)
+                    if len(data_frag_bin) != length: # shrunk
+                        raise Exception
+                    self.send_block(MsgToSend.GET_DATA, data_frag_bin)
+            else:
+                self.send_block(MsgToSend.GET_DATA, frame)
+            sent = sent + 1
+            while sent - acked >= self.window:
+                acked = self.recv_ack(acked, MsgToRecv.GET_STOP)
+        while acked < sent:
+            acked = self.recv_ack(acked, MsgToRecv.GET_STOP)
+        self.send(MsgToSend.GET_DATA, b'')
+
+    def recv_frames(self, writer):
+
+        # PUT_DATA frames fed to writer, each acked, until the empty one ; the first go is out
+        recved = 0
+        while True:
+            m3t, m3 = self.recv()
+            if m3t == MsgToRecv.PUT_STOP:
+                raise Exception
+            if not m3 : # empty
+                break
+            writer.feed(m3)
+            recved = recved + 1
+            self.shape(len(m3)) # a late ack slows the client down
+            self.send(MsgToSend.PUT_PROCEED, str(recved))
+        writer.finish()
+
+    def sig_frames(self):
+        # SYNC_SIG frames of the client until the empty one
+        while True:
+            (mt, m) = self.recv()
+            if mt != MsgToRecv.SYNC_SIG:
+                raise Exception
+            if not m:
+                return
+            yield m
+
+    def recv_ack(self, acked, stop_msgtype, sent_times=None):
+        # cumulative ack ; payload is the number of blocks received (empty on old clients)
+        (mt, m) = self.recv()
+        if mt == stop_msgtype:
+            raise Exception
+        new_acked = int(m) if m else acked + 1
+        if sent_times is not None:
+            now = time.perf_counter()
+            for _ in range(min(new_acked - acked, len(sent_times))):
+                BLOCK_RTT_SECONDS.observe(now - sent_times.popleft())
+        return new_acked
+
+    def parse_ls(self, m1):
+        # (dir path, long, offset, count) ; old clients send the path only
+        fields = unpack_fields(m1) if self.ls2 else [m1.decode()]
+        if len(fields) < 4:
+            return fields[0], False, 0, 0
+        return fields[0], fields[1] == 'long', int(fields[2]), int(fields[3])
+
+    def send_listing(self, path, long, offset, count):
+
+        # LS_DATA batches of records as the directory is read, then LS_SUCCESS with the
+        # number of entries listed and 'more' when the page stopped before the end
+        it = scan_dir(path, long)
+        try:
+            page = itertools.islice(it, offset, offset + count if count else None)
+            listed = 0
+            while True:
+                ls_data_bin, num_records = read_records(page)
+                if not num_records:
+                    break
+                self.send(MsgToSend.LS_DATA, ls_data_bin)
+                listed = listed + num_records
+            more = count > 0 and next(it, None) is not None
+        finally:
+            it.close()
+        self.send(MsgToSend.LS_SUCCESS, pack_fields(listed, 'more' if more else ''))
+
+    def recv_segment(self, put_path, fields):
+
+        # one byte range of a parallel put, written in place into the shared temp file.
+        # The range at offset 0 creates and preallocates it ; the client starts the others
+        # once that one got its go.
+        file_name, size, _, offset, length, transfer_id = fields[:6]
+        size, offset, length = int(size), int(offset), int(length)
+        if not transfer_id.isdigit() or offset + length > size:
+            raise Exception
+        tmpfile_path = put_path + '.' + transfer_id
+        if offset == 0:
+            UPLOADS.begin(tmpfile_path)
+            fd = os.open(tmpfile_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        else:
+            fd = os.open(tmpfile_path, os.O_WRONLY)
+        try:
+            if offset == 0:
+                preallocate(fd, size)
+            self.send(MsgToSend.PUT_PROCEED) # first go
+            pos, end = offset, offset + length
+            hasher = new_digest(self.digest) if self.digest else None # of this range
+            recved = 0
+            while True:
+                m3t, m3 = self.recv()
+                if m3t == MsgToRecv.PUT_STOP:
+                    raise Exception
+                if not m3 : # empty
+                    break
+                if pos + len(m3) > end:
+                    raise Exception
+                os.pwrite(fd, m3, pos)
+                if hasher is not None:
+                    hasher.update(m3)
+                pos = pos + len(m3)
+                recved = recved + 1
+                self.shape(len(m3))
+                self.send(MsgToSend.PUT_PROCEED, str(recved))
+        finally:
+            os.close(fd)
+        if pos != end:
+            raise Exception
+        if hasher is not None: # the client's digest of the range follows the empty block
+            m4t, m4 = self.recv()
+            if m4t != MsgToRecv.PUT_DIGEST or m4.decode() != hasher.hexdigest():
+                self.send(MsgToSend.PUT_FAILURE, 'digest') # the commit removes the temp file
+                return
+        # the range is complete ; the temp file is renamed at CMD_COMMIT
+        self.send(MsgToSend.PUT_SUCCESS)
 
     def absolutify(self, path_str):
         if path_str[0] != '/':  # convert to abs. path
@@ -192,21 +1438,34 @@ class ClientThread(Thread):
 
     def main_func(self):
 
+        m1t = None
         while True:
+            if m1t is not None: # the previous command is done ; every branch ends here
+                observe_command(m1t, start_time)
+                self.end_transfer()
+            if self.idle_since is None:
+                self.idle_since = time.monotonic()
             # MSG1 : recv command and arguments
-            (m1t, m1) = self.recv()
+            (m1t, m1) = self.next_command()
+            start_time = time.perf_counter()
+            if m1t != MsgToRecv.ALIVE_SIGNAL: # pings do not make a session busy
+                self.idle_since = None
+            if m1t in TRANSFER_COMMANDS and not self.begin_transfer():
+                continue
 
             # parse and verify arguments
             if m1t == MsgToRecv.ALIVE_SIGNAL :
-                pass
+                if self.alive:
+                    self.send(MsgToSend.ALIVE_CHECK)
 
             elif m1t == MsgToRecv.CMD_CD :
                 path_str = m1.decode()
                 if not self.existance_check(path_str, True):
                     self.send(MsgToSend.CD_PATHERR)
                     continue
-                self.send(MsgToSend.CD_PROCEED)
-                (m2t, m2) = self.recv()
+                if not self.rtt1:
+                    self.send(MsgToSend.CD_PROCEED)
+                    (m2t, m2) = self.recv()
                 self.pwd = self.get_absolute_path(path_str)
                 self.send(MsgToSend.CD_SUCCESS)
 
@@ -214,22 +1473,26 @@ class ClientThread(Thread):
                 self.send(MsgToSend.PWD_SUCCESS, self.pwd)
 
             elif m1t == MsgToRecv.CMD_LS :
-                path_str = m1.decode()
-                if len(m1)!=0 and (not self.existance_check(path_str, True)) :
+                path_str, long, offset, count = self.parse_ls(m1)
+                if len(path_str)!=0 and (not self.existance_check(path_str, True)) :
                     self.send(MsgToSend.LS_PATHERR)
                     continue
-                self.send(MsgToSend.LS_PROCEED)
-                (m2t, m2) = self.recv()
+                if not (self.rtt1 and self.ls2): # rtt1 : the records follow the command at once
+                    self.send(MsgToSend.LS_PROCEED)
+                    (m2t, m2) = self.recv()
+
+                ls_path = self.absolutify(path_str) if path_str else self.pwd
+                if self.ls2:
+                    try:
+                        self.send_listing(ls_path, long, offset, count)
+                    except OSError as e:
+                        self.send(MsgToSend.LS_FAILURE)
+                    continue
 
                 ls_data_bin = b''
                 ls_success = True
                 try:
-                    if len(path_str) == 0 : # no arg
-                        ls_data_bin = subprocess.Popen(['ls', self.pwd ], stdout=subprocess.PIPE) \
-                            .communicate()[0]
-                    else:
-                        ls_data_bin = subprocess.Popen(['ls', path_str], stdout=subprocess.PIPE) \
-                            .communicate()[0]
+                    ls_data_bin = list_names(ls_path)
 
                     num_blocks = int( len(ls_data_bin) / DATA_BLOCK_SIZE) + 1
                     for idx, _ in enumerate(range(num_blocks)):
@@ -246,28 +1509,55 @@ class ClientThread(Thread):
                     else self.send(MsgToSend.LS_FAILURE)
 
             elif m1t == MsgToRecv.CMD_GET :
-                path_str = m1.decode()
+                # rtt1 : path, size and mtime of the client's partial, largest file to send at once
+                fields = unpack_fields(m1) if self.rtt1 else [m1.decode()]
+                path_str = fields[0]
                 if not self.existance_check(path_str, False) :
                     self.send(MsgToSend.GET_PATHERR, self.absolutify(path_str))
                     continue
-                self.send(MsgToSend.GET_PROCEED, self.absolutify(path_str))
-                (m2t, m2) = self.recv()
-                if m2t != MsgToRecv.GET_PROCEED :
-                    self.send(MsgToSend.GET_FAILURE)
-                    continue
-
                 file_addr = self.absolutify(path_str)
+                st = os.stat(file_addr)
+                if len(fields) >= 4 and st.st_size <= int(fields[3]):
+                    # one round trip ; the blocks follow from the offset decided here
+                    offset = int(fields[1]) if self.resume and int(fields[2]) == st.st_mtime_ns \
+                        and int(fields[1]) <= st.st_size else 0
+                    self.send(MsgToSend.GET_PROCEED, pack_fields(file_addr, st.st_size, st.st_mtime_ns, offset))
+                    m2 = str(offset).encode()
+                else:
+                    if self.resume: # size and mtime identify the version the client may hold
+                        self.send(MsgToSend.GET_PROCEED, pack_fields(file_addr, st.st_size, st.st_mtime_ns))
+                    else:
+                        self.send(MsgToSend.GET_PROCEED, file_addr)
+                    (m2t, m2) = self.recv()
+                    if m2t != MsgToRecv.GET_PROCEED :
+                        self.send(MsgToSend.GET_FAILURE)
+                        continue
+
                 try:
+                    # bytes the client already has, or the byte range of a parallel get
+                    fields = unpack_fields(m2) if self.resume and m2 else ['0']
+                    offset = int(fields[0])
+                    length = int(fields[1]) if self.segments and len(fields) >= 2 else None
                     with open(file_addr, 'rb') as f:
-                        while True:
-                            data_frag_bin = f.read(DATA_BLOCK_SIZE)
-                            self.send(MsgToSend.GET_DATA, data_frag_bin)
-                            if not data_frag_bin : # empty ; end
-                                break
-                            m3t, m3 = self.recv()
-                            if m3t == MsgToRecv.GET_STOP:
-                                raise Exception
+                        # digest of the whole file (cached, or hashed as it goes), or of the range
+                        digest, hasher, key = None, None, None
+                        if self.digest and length is None:
+                            key = DIGEST_CACHE.key(f.fileno(), self.digest)
+                            digest = DIGEST_CACHE.get(key)
+                        if self.digest and digest is None:
+                            hasher = new_digest(self.digest)
+                            if length is None:
+                                hash_range(f.fileno(), hasher, 0, offset)
+                        self.send_file_blocks(f, offset, length, hasher)
+                        if hasher is not None:
+                            digest = hasher.hexdigest()
+                            if length is None:
+                                DIGEST_CACHE.put(f.fileno(), key, digest)
+                    if self.digest: # checked by the client before its rename
+                        self.send(MsgToSend.GET_SUCCESS, digest)
+                    TRANSFERS.inc(1, ('get', 'ok'))
                 except Exception as e:
+                    TRANSFERS.inc(1, ('get', 'failed'))
                     self.send(MsgToSend.GET_FAILURE)
 
             elif m1t == MsgToRecv.CMD_PUT :
@@ -284,67 +1574,872 @@ class ClientThread(Thread):
                 m2t, m2 = self.recv()
 
                 # prepare
-                file_name = m2.decode()
-                tmpfile_name = str(random.randint(10000000, 99999999))  # 8-digit number
-                tmpfile_name = '.' + tmpfile_name
+                fields = unpack_fields(m2)
+                file_name = fields[0]
+                if self.segments and len(fields) >= 6: # name, size, mtime, offset, length, id
+                    try:
+                        self.recv_segment(put_path, fields)
+                    except Exception as e:
+                        self.send(MsgToSend.PUT_FAILURE)
+                    continue
+                offset = 0
+                file_size = None # announced by resuming clients ; preallocated
+                if self.resume and len(fields) >= 3: # name, size, mtime
+                    tmpfile_name = partial_name(file_name)
+                    file_size, file_mtime = int(fields[1]), int(fields[2])
+                    offset = resume_offset(put_path + tmpfile_name, file_size, file_mtime)
+                else:
+                    tmpfile_name = str(random.randint(10000000, 99999999))  # 8-digit number
+                    tmpfile_name = '.' + tmpfile_name
 
                 recv_success = False
+                digest_mismatch = False
+                hasher = new_digest(self.digest) if self.digest else None # of the whole file
+                UPLOADS.begin(put_path + tmpfile_name)
                 try:
-                    with open(put_path + tmpfile_name, 'wb') as f:
-                        while True:
-                            self.send(MsgToSend.PUT_PROCEED)
-                            m3t, m3 = self.recv()
-                            if m3t == MsgToRecv.PUT_STOP:
-                                raise Exception
-                            if not m3 : # empty
-                                recv_success = True
-                                break
-                            f.write(m3)
+                    if hasher is not None and offset: # the part kept from before
+                        with open(put_path + tmpfile_name, 'rb') as f:
+                            hash_range(f.fileno(), hasher, 0, offset)
+                    # not 'ab' ; the preallocated end is not where the data goes
+                    with open(put_path + tmpfile_name, 'r+b' if offset else 'wb') as f:
+                        f.seek(offset)
+                        if file_size is not None and file_size > offset:
+                            preallocate(f.fileno(), file_size, offset)
+                        try:
+                            # first go ; tells a resuming client where to start
+                            self.send(MsgToSend.PUT_PROCEED, str(offset) if self.resume else '')
+                            recved = 0
+                            while True:
+                                m3t, m3 = self.recv()
+                                if m3t == MsgToRecv.PUT_STOP:
+                                    raise Exception
+                                if not m3 : # empty
+                                    recv_success = True
+                                    break
+                                f.write(m3)
+                                if hasher is not None:
+                                    hasher.update(m3)
+                                recved = recved + 1
+                                # cumulative ack ; the client keeps self.window blocks in flight,
+                                # held back by the rate limits
+                                self.shape(len(m3))
+                                self.send(MsgToSend.PUT_PROCEED, str(recved))
+                        finally:
+                            if file_size is not None: # what arrived ; a partial stays resumable
+                                f.truncate()
+                    if hasher is not None: # the client's digest follows the empty block
+                        m4t, m4 = self.recv()
+                        digest_mismatch = m4t != MsgToRecv.PUT_DIGEST or m4.decode() != hasher.hexdigest()
+                        recv_success = not digest_mismatch
                 except Exception as e:
-                    pass
                     #traceback.print_exc()
-                    #self.send(MsgToSend.PUT_FAILURE)
+                    if self.window > 1: # acks may be in flight ; tell the client to stop
+                        self.send(MsgToSend.PUT_FAILURE)
+                finally:
+                    TRANSFERS.inc(1, ('put', 'ok' if recv_success else 'failed'))
+                    if recv_success:
+                        UPLOADS.commit(put_path + tmpfile_name, put_path + file_name)
+                        if hasher is not None: # verified ; a checksum of it is free
+                            with open(put_path + file_name, 'rb') as f:
+                                DIGEST_CACHE.put(f.fileno(), DIGEST_CACHE.key(f.fileno(), self.digest),
+                                                 hasher.hexdigest())
+                            self.send(MsgToSend.PUT_SUCCESS)
+                    elif digest_mismatch: # corrupt ; nothing worth resuming
+                        UPLOADS.discard(put_path + tmpfile_name)
+                        self.send(MsgToSend.PUT_FAILURE, 'digest')
+                    elif tmpfile_name.endswith(PARTIAL_SUFFIX):
+                        # keep it for a resume ; the mtime ties it to this version of the source.
+                        # One a crash leaves has a fresh mtime, so it is never resumed.
+                        if os.path.isfile(put_path + tmpfile_name):
+                            os.utime(put_path + tmpfile_name, ns=(file_mtime, file_mtime))
+                        UPLOADS.end(put_path + tmpfile_name)
+                    else:
+                        UPLOADS.discard(put_path + tmpfile_name)
+
+            elif m1t == MsgToRecv.CMD_COMMIT :
+                # end of a parallel put ; every range was acked with PUT_SUCCESS
+                commit_success = False
+                try:
+                    dir_str, transfer_id, file_name, size, action = unpack_fields(m1)
+                    # the directory the ranges went to, resolved as CMD_PUT did
+                    if not self.existance_check(dir_str, True) : # isDir
+                        raise Exception('no directory {}'.format(dir_str))
+                    put_path = self.absolutify(dir_str)
+                    put_path = put_path + ('' if put_path[-1] == '/' else '/')
+                    tmpfile_path = put_path + '.' + transfer_id
+                    if transfer_id.isdigit() and '/' not in file_name:
+                        if action == 'commit' and os.path.getsize(tmpfile_path) == int(size):
+                            UPLOADS.commit(tmpfile_path, put_path + file_name)
+                            commit_success = True
+                        else:
+                            UPLOADS.discard(tmpfile_path)
+                except Exception as e:
+                    print('[ERROR] client at {}:{} commit failed : {}'.format(self.ip, self.port, e))
+                TRANSFERS.inc(1, ('put', 'ok' if commit_success else 'failed'))
+                _ = self.send(MsgToSend.COMMIT_SUCCESS) if commit_success \
+                    else self.send(MsgToSend.COMMIT_FAILURE)
+
+            elif m1t == MsgToRecv.CMD_GET_TREE and self.tree :
+                path_str = m1.decode()
+                if not self.existance_check(path_str, True) :
+                    self.send(MsgToSend.GET_PATHERR, self.absolutify(path_str))
+                    continue
+                tree_path = self.get_absolute_path(path_str)
+                # the frames follow at once ; the client is ready before asking
+                self.send(MsgToSend.GET_PROCEED, tree_path)
+                try:
+                    self.send_frames(tree_frames(tree_path, self.block_size))
+                    TRANSFERS.inc(1, ('get_tree', 'ok'))
+                except Exception as e:
+                    TRANSFERS.inc(1, ('get_tree', 'failed'))
+                    self.send(MsgToSend.GET_FAILURE)
+
+            elif m1t == MsgToRecv.CMD_PUT_TREE and self.tree :
+                # target dir, name of the tree root in it
+                dir_str, tree_name = unpack_fields(m1)[:2]
+                if (dir_str and not self.existance_check(dir_str, True)) \
+                        or tree_name in ('', '.', '..') or '/' in tree_name :
+                    self.send(MsgToSend.PUT_PATHERR)
+                    continue
+                put_path = self.absolutify(dir_str) if dir_str else self.pwd
+                put_path = put_path + ('' if put_path[-1] == '/' else '/')
+
+                writer = JournaledTreeWriter(put_path + tree_name)
+                try:
+                    self.send(MsgToSend.PUT_PROCEED) # first go
+                    self.recv_frames(writer)
+                except Exception as e:
+                    TRANSFERS.inc(1, ('put_tree', 'failed'))
+                    writer.abort()
+                    self.send(MsgToSend.PUT_FAILURE)
+                    continue
+                TRANSFERS.inc(1, ('put_tree', 'ok'))
+                self.send(MsgToSend.PUT_SUCCESS, pack_fields(writer.files, writer.dirs, writer.nbytes))
+
+            elif m1t == MsgToRecv.CMD_SYNC_GET and self.sync :
+                path_str = m1.decode()
+                if not self.existance_check(path_str, False) :
+                    self.send(MsgToSend.GET_PATHERR, self.absolutify(path_str))
+                    continue
+                file_addr = self.absolutify(path_str)
+                self.send(MsgToSend.GET_PROCEED, pack_fields(file_addr, os.path.getsize(file_addr)))
+                # block size of the client's copy, then its signatures
+                (m2t, m2) = self.recv()
+                if m2t != MsgToRecv.GET_PROCEED :
+                    self.send(MsgToSend.GET_FAILURE)
+                    continue
+
+                try:
+                    block_size = int(m2)
+                    if not SYNC_MIN_BLOCK <= block_size <= SYNC_MAX_BLOCK:
+                        raise Exception
+                    table = read_signatures(self.sig_frames())
+                    with open(file_addr, 'rb') as f:
+                        self.send_frames(delta_frames(f, table, block_size, self.block_size))
+                    TRANSFERS.inc(1, ('sync_get', 'ok'))
+                except Exception as e:
+                    TRANSFERS.inc(1, ('sync_get', 'failed'))
+                    self.send(MsgToSend.GET_FAILURE)
 
-                if recv_success:
-                    os.system('mv {} {}'.format(put_path + tmpfile_name, put_path + file_name))
+            elif m1t == MsgToRecv.CMD_SYNC_PUT and self.sync :
+                # target dir, file name
+                dir_str, file_name = unpack_fields(m1)[:2]
+                if (dir_str and not self.existance_check(dir_str, True)) \
+                        or file_name in ('', '.', '..') or '/' in file_name :
+                    self.send(MsgToSend.PUT_PATHERR)
                     continue
-                os.system('rm {}'.format(put_path + tmpfile_name))
+                put_path = self.absolutify(dir_str) if dir_str else self.pwd
+                put_path = put_path + ('' if put_path[-1] == '/' else '/')
+
+                # the copy here is the basis ; its signatures are the first go
+                basis_path = put_path + file_name
+                block_size = sync_block_size(os.path.getsize(basis_path) if os.path.isfile(basis_path) else 0)
+                tmpfile_path = put_path + '.' + str(random.randint(10000000, 99999999))  # 8-digit number
+                UPLOADS.begin(tmpfile_path)
+                try:
+                    writer = DeltaWriter(basis_path, tmpfile_path, block_size)
+                except OSError:
+                    UPLOADS.discard(tmpfile_path)
+                    self.send(MsgToSend.PUT_PATHERR)
+                    continue
+                try:
+                    self.send(MsgToSend.PUT_PROCEED, pack_fields(put_path, block_size))
+                    for frame in signature_frames(basis_path, block_size, self.block_size):
+                        self.send(MsgToSend.SYNC_SIG, frame)
+                    self.send(MsgToSend.SYNC_SIG, b'')
+                    self.recv_frames(writer)
+                    UPLOADS.commit(tmpfile_path, basis_path)
+                except Exception as e:
+                    TRANSFERS.inc(1, ('sync_put', 'failed'))
+                    writer.abort()
+                    UPLOADS.end(tmpfile_path)
+                    self.send(MsgToSend.PUT_FAILURE)
+                    continue
+                TRANSFERS.inc(1, ('sync_put', 'ok'))
+                self.send(MsgToSend.PUT_SUCCESS, pack_fields(writer.literal, writer.copied))
+
+            elif m1t == MsgToRecv.CMD_CHECKSUM and self.digest :
+                path_str = m1.decode()
+                if not self.existance_check(path_str, False) :
+                    self.send(MsgToSend.CHECKSUM_PATHERR, self.absolutify(path_str))
+                    continue
+                file_addr = self.absolutify(path_str)
+                try:
+                    with open(file_addr, 'rb') as f:
+                        digest = file_digest(f.fileno(), self.digest)
+                        size = os.fstat(f.fileno()).st_size
+                except OSError as e:
+                    self.send(MsgToSend.CHECKSUM_PATHERR, file_addr)
+                    continue
+                self.send(MsgToSend.CHECKSUM_SUCCESS, pack_fields(file_addr, self.digest, digest, size))
 
             elif m1t == MsgToRecv.CMD_EXIT :
                 self.terminate()
 
     def run(self):
 
+        REAPER.add(self)
         try:
             self.authenticate()
+            if self.mux: # frames are routed by stream id from here on
+                self.inbox = queue.Queue()
+                Thread(target=self.demux, daemon=True).start()
             # main function
             self.main_func()
         except Exception as e:
             self.terminate()
+        finally:
+            REAPER.remove(self)
+            self.conn.close()
+            self.end_transfer()
+            SESSIONS_ACTIVE.dec() # counted in by Admission.start
+            if self.admission is not None:
+                self.admission.done()
+
+""" multiplexed channels ; commands of a 'mux' session on their own stream ids """
+class Channel(ClientThread):
+
+    # one command run on stream_id of a session, in its own thread with its own window and acks,
+    # on the frames the session's reader routes to it ; it ends with the command
+
+    def __init__(self, session, stream_id):
+        ClientThread.__init__(self, session.conn, session.ip, session.port, session.admission)
+        self.daemon = True
+        # the session's socket, send lock and rate limit ; its frames come through the inbox
+        self.send_lock = session.send_lock
+        self.channels = session.channels
+        self.bucket = session.bucket # a flow of its own at the global rate ; the session's bucket is shared
+        self.stream_id = stream_id
+        self.inbox = queue.Queue()
+        # user, pwd and options of the session as the command found them
+        self.user_table_path = session.user_table_path
+        self.user_info = session.user_info
+        self.pwd = session.pwd
+        self.token = session.token
+        self.proto = session.proto
+        self.window = session.window
+        self.use_sendfile = session.use_sendfile
+        self.block_size = min(session.block_size, MUX_BLOCK_SIZE)
+        self.resume = session.resume
+        self.segments = session.segments
+        self.ls2 = session.ls2
+        self.codec = session.codec
+        self.tree = session.tree
+        self.sync = session.sync
+        self.digest = session.digest
+        self.busy = session.busy
+        self.alive = session.alive
+        self.rtt1 = session.rtt1 # the pipeline stays off ; one command per channel
+        self.idle_since = None
+        self.served = False
+
+    def next_command(self):
+        # the frame that opened the channel, then the end of it
+        if self.served:
+            raise EOFError
+        self.served = True
+        return self.recv()
+
+    def terminate(self):
+        # CMD_EXIT ends the session on stream 0 only
+        raise EOFError
+
+    def run(self):
+
+        CHANNELS_ACTIVE.inc()
+        try:
+            self.main_func()
+        except Exception as e: # the command is done, or the connection closed
+            pass
+        finally:
+            self.end_transfer()
+            self.channels.pop(self.stream_id, None)
+            CHANNELS_ACTIVE.dec()
+
+""" in each coroutine ; asyncio engine (same wire protocol) """
+class AsyncSession():
+
+    FEATURES = ('window', 'proto', 'ls2', 'alive')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.ip, self.port = writer.get_extra_info('peername')[:2]
+        self.loop = asyncio.get_event_loop()
+
+        self.user_table_path = USER_TABLE_PATH
+        self.token = SFTP_DISCRIMINATOR_TOKEN
+
+        self.user_info = "" # filled at auth stage.
+        self.bucket = TokenBucket() # session rate limit
+        self.due = 0.0 # when the next block of the transfer is due at its share of the global rate
+        self.pwd = os.path.expanduser("~") + '/' # initialized to user base path
+        self.window = 1 # blocks in flight ; 1 is stop-and-wait
+        self.proto = 1
+        self.block_size = DATA_BLOCK_SIZE
+        self.ls2 = False
+        self.alive = False # client sends ALIVE_SIGNAL while idle
+        self.idle_since = time.monotonic()
+
+    negotiate = ClientThread.negotiate
+    parse_ls = ClientThread.parse_ls
+    absolutify = ClientThread.absolutify
+    existance_check = ClientThread.existance_check
+    get_absolute_path = ClientThread.get_absolute_path
+
+    async def authenticate(self):
+
+        # MSG1, MSG2 : hello (with session options)
+        (m1t, m1) = await self.recv()
+        accepted = self.negotiate(parse_options(m1.decode()))
+        await self.send(MsgToSend.AUTH_PROCEED, 'hello+back' + format_options(accepted))
+        if accepted.get('proto') == 2:
+            self.proto = 2
+            self.block_size = DATA_BLOCK_SIZE_V2
+        # MSG3, MSG4 : id
+        (m3t, m3) = await self.recv()
+        await self.send(MsgToSend.AUTH_PROCEED, 'givemepw')
+
+        while True:
+            # MSG5 : recv pw
+            (m5t, m5) = await self.recv()
+            auth_granted = await self.loop.run_in_executor(
+                None, check_password, m3.decode(), m5.decode(), self.user_table_path)
+            if auth_granted:
+                self.user_info = m3.decode()
+                break
+            AUTH_FAILURES.inc()
+            # MSG6: send passwd error
+            await self.send(MsgToSend.AUTH_FAILURE, 'passwderror')
+        # MSG7 : send auth ok
+        await self.send(MsgToSend.AUTH_SUCCESS, 'auth ok')
+
+    async def recv_command(self):
+        # the reaper of this engine : a timeout on the wait for a command. Pings are answered
+        # here ; an 'alive' client is only closed when they stop
+        self.idle_since = time.monotonic()
+        while True:
+            timeout = self.idle_since + REAPER.idle_timeout - time.monotonic()
+            reason = 'idle'
+            if self.alive:
+                timeout, reason = 3 * KEEPALIVE_SEC, 'silent'
+            try:
+                (m1t, m1) = await asyncio.wait_for(self.recv(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                REAPER.count(self, reason)
+                raise EOFError
+            if m1t != MsgToRecv.ALIVE_SIGNAL:
+                return m1t, m1
+            if self.alive:
+                await self.send(MsgToSend.ALIVE_CHECK)
+
+    async def terminate(self):
+
+        try:
+            await self.send(MsgToSend.EXIT_SUCCESS)
+        except:
+            pass
+        self.writer.close()
+        print('[INFO] client at {}:{} coroutine terminated.'.format(self.ip, self.port))
+
+    async def recv(self):
+
+        # exactly the header, then exactly the body ; never more than one block buffered
+        if self.proto == 1:
+            header = await self.reader.readexactly(12)
+            if header[:2] != self.token:
+                raise ConnectionError
+            msgtype, body_len = int(header[10:12]), int(header[2:10]) - 12
+        else:
+            token, msgtype, flags, stream_id, body_len = \
+                V2_HEADER.unpack(await self.reader.readexactly(V2_HEADER.size))
+            if token != SFTP_DISCRIMINATOR_TOKEN_V2 or body_len > MAX_FRAME_SIZE:
+                raise ConnectionError
+        recv_data_bin = await self.reader.readexactly(body_len)
+        BYTES_RECEIVED.inc((12 if self.proto == 1 else V2_HEADER.size) + body_len)
+        recv_msgtype = MsgToRecv(msgtype)
+
+        if recv_msgtype == MsgToRecv.CMD_EXIT:
+            raise EOFError
+
+        return recv_msgtype, recv_data_bin  # (MsgToRecv, bytes)
+
+    async def send(self, send_msgtype, send_data=''):
+
+        send_data_bin = send_data if type(send_data) in (bytes, memoryview) \
+                                    else send_data.encode()
+        header = pack_header(self.token, self.proto, send_msgtype.value, len(send_data_bin))
+        if len(send_data_bin) < 65536: # one segment ; no nagle stall between header and body
+            self.writer.write(header + send_data_bin)
+        else:
+            self.writer.write(header)
+            self.writer.write(send_data_bin)
+        BYTES_SENT.inc(len(header) + len(send_data_bin))
+        await self.writer.drain()
+
+    async def shape(self, nbytes):
+        delay = SHAPER.reserve(self, nbytes)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def recv_ack(self, acked, stop_msgtype):
+        (mt, m) = await self.recv()
+        if mt == stop_msgtype:
+            raise Exception
+        return int(m) if m else acked + 1
+
+    async def send_listing(self, path, long, offset, count):
+
+        # as ClientThread.send_listing ; the directory is read in the executor
+        it = scan_dir(path, long)
+        try:
+            page = itertools.islice(it, offset, offset + count if count else None)
+            listed = 0
+            while True:
+                ls_data_bin, num_records = await self.loop.run_in_executor(None, read_records, page)
+                if not num_records:
+                    break
+                await self.send(MsgToSend.LS_DATA, ls_data_bin)
+                listed = listed + num_records
+            more = count > 0 and await self.loop.run_in_executor(None, next, it, None) is not None
+        finally:
+            it.close()
+        await self.send(MsgToSend.LS_SUCCESS, pack_fields(listed, 'more' if more else ''))
+
+    async def main_func(self):
+
+        m1t = None
+        while True:
+            if m1t is not None: # the previous command is done ; every branch ends here
+                observe_command(m1t, start_time)
+                SHAPER.stop(self)
+            # MSG1 : recv command and arguments
+            (m1t, m1) = await self.recv_command()
+            start_time = time.perf_counter()
+            if m1t in TRANSFER_COMMANDS:
+                SHAPER.start(self)
+
+            if m1t == MsgToRecv.CMD_CD :
+                path_str = m1.decode()
+                if not self.existance_check(path_str, True):
+                    await self.send(MsgToSend.CD_PATHERR)
+                    continue
+                await self.send(MsgToSend.CD_PROCEED)
+                (m2t, m2) = await self.recv()
+                self.pwd = self.get_absolute_path(path_str)
+                await self.send(MsgToSend.CD_SUCCESS)
+
+            elif m1t == MsgToRecv.CMD_PWD :
+                await self.send(MsgToSend.PWD_SUCCESS, self.pwd)
+
+            elif m1t == MsgToRecv.CMD_LS :
+                path_str, long, offset, count = self.parse_ls(m1)
+                if len(path_str)!=0 and (not self.existance_check(path_str, True)) :
+                    await self.send(MsgToSend.LS_PATHERR)
+                    continue
+                await self.send(MsgToSend.LS_PROCEED)
+                (m2t, m2) = await self.recv()
+
+                ls_path = self.absolutify(path_str) if path_str else self.pwd
+                if self.ls2:
+                    try:
+                        await self.send_listing(ls_path, long, offset, count)
+                    except (ConnectionError, asyncio.IncompleteReadError):
+                        raise
+                    except OSError as e:
+                        await self.send(MsgToSend.LS_FAILURE)
+                    continue
+
+                ls_success = True
+                try:
+                    ls_data_bin = await self.loop.run_in_executor(None, list_names, ls_path)
+
+                    num_blocks = int( len(ls_data_bin) / DATA_BLOCK_SIZE) + 1
+                    for idx in range(num_blocks):
+                        await self.send(MsgToSend.LS_DATA,
+                                        ls_data_bin[idx*DATA_BLOCK_SIZE : (idx+1)*DATA_BLOCK_SIZE])
+                        _, _ = await self.recv()
+                    await self.send(MsgToSend.LS_DATA, '')
+                    _, _ = await self.recv()
+                except Exception as e:
+                    ls_success = False
+
+                await self.send(MsgToSend.LS_SUCCESS if ls_success else MsgToSend.LS_FAILURE)
+
+            elif m1t == MsgToRecv.CMD_GET :
+                path_str = m1.decode()
+                if not self.existance_check(path_str, False) :
+                    await self.send(MsgToSend.GET_PATHERR, self.absolutify(path_str))
+                    continue
+                await self.send(MsgToSend.GET_PROCEED, self.absolutify(path_str))
+                (m2t, m2) = await self.recv()
+                if m2t != MsgToRecv.GET_PROCEED :
+                    await self.send(MsgToSend.GET_FAILURE)
+                    continue
+
+                f = None
+                try:
+                    f = await self.loop.run_in_executor(None, open, self.absolutify(path_str), 'rb')
+                    # a cached file is sliced in the loop ; no executor round per block
+                    cached = await self.loop.run_in_executor(None, READ_CACHE.acquire, f)
+                    offset, sent, acked = 0, 0, 0
+                    while True:
+                        if cached is not None:
+                            data_frag_bin = cached[offset:offset + self.block_size]
+                            offset = offset + len(data_frag_bin)
+                        else:
+                            data_frag_bin = await self.loop.run_in_executor(None, f.read, self.block_size)
+                        if not data_frag_bin : # empty ; end
+                            break
+                        await self.shape(len(data_frag_bin))
+                        await self.send(MsgToSend.GET_DATA, data_frag_bin)
+                        sent = sent + 1
+                        while sent - acked >= self.window:
+                            acked = await self.recv_ack(acked, MsgToRecv.GET_STOP)
+                    while acked < sent:
+                        acked = await self.recv_ack(acked, MsgToRecv.GET_STOP)
+                    await self.send(MsgToSend.GET_DATA, b'')
+                    TRANSFERS.inc(1, ('get', 'ok'))
+                except (EOFError, ConnectionError, asyncio.IncompleteReadError):
+                    TRANSFERS.inc(1, ('get', 'failed'))
+                    raise
+                except Exception as e:
+                    TRANSFERS.inc(1, ('get', 'failed'))
+                    await self.send(MsgToSend.GET_FAILURE)
+                finally:
+                    if f is not None:
+                        f.close()
+
+            elif m1t == MsgToRecv.CMD_PUT :
+                m1_decoded = m1.decode()
+                if len(m1_decoded) != 0 :
+                    if not self.existance_check(m1_decoded, True) : # isDir
+                        await self.send(MsgToSend.PUT_PATHERR)
+                        continue
+
+                put_path = self.absolutify(m1_decoded) if m1_decoded else self.pwd
+                put_path = put_path + ('' if put_path[-1] == '/' else '/')
+
+                await self.send(MsgToSend.PUT_PROCEED, self.absolutify(put_path))
+                m2t, m2 = await self.recv()
+
+                # prepare
+                file_name = m2.decode()
+                tmpfile_name = '.' + str(random.randint(10000000, 99999999))  # 8-digit number
+
+                recv_success = False
+                f = None
+                UPLOADS.begin(put_path + tmpfile_name)
+                try:
+                    f = await self.loop.run_in_executor(None, open, put_path + tmpfile_name, 'wb')
+                    await self.send(MsgToSend.PUT_PROCEED)
+                    recved = 0
+                    while True:
+                        m3t, m3 = await self.recv()
+                        if m3t == MsgToRecv.PUT_STOP:
+                            raise Exception
+                        if not m3 : # empty
+                            recv_success = True
+                            break
+                        await self.loop.run_in_executor(None, f.write, m3)
+                        recved = recved + 1
+                        await self.shape(len(m3))
+                        await self.send(MsgToSend.PUT_PROCEED, str(recved))
+                except (EOFError, ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    if self.window > 1: # acks may be in flight ; tell the client to stop
+                        await self.send(MsgToSend.PUT_FAILURE)
+                finally:
+                    TRANSFERS.inc(1, ('put', 'ok' if recv_success else 'failed'))
+                    if f is not None:
+                        f.close()
+                    if recv_success: # a durable commit waits for the disk ; not in the loop
+                        await self.loop.run_in_executor(None, UPLOADS.commit,
+                                                        put_path + tmpfile_name, put_path + file_name)
+                    else:
+                        UPLOADS.discard(put_path + tmpfile_name)
+
+    async def run(self):
+
+        try:
+            await asyncio.wait_for(self.authenticate(), REAPER.idle_timeout)
+            # main function
+            await self.main_func()
+        except Exception as e:
+            pass
+        SHAPER.stop(self)
+        await self.terminate()
 
 """ receive connections and run threads """
-def runServer(soc):
+def runServer(soc, max_sessions=MAX_SESSIONS, max_transfers=MAX_TRANSFERS):
 
-    threads = []
+    admission = Admission(max_sessions, max_transfers)
+    REAPER.start()
+    soc.settimeout(1) # wake up to refuse queued connections past their wait
     while True:
-        soc.listen(4)
-        (cli_conn, (ip, port)) = soc.accept()
-        cli_thread = ClientThread(cli_conn, ip, port)
-        cli_thread.start()
-        print('[INFO] client at {}:{} thread started.'.format(ip, port))
-        threads.append(cli_thread)
+        try:
+            (cli_conn, (ip, port)) = soc.accept()
+        except socket.timeout:
+            admission.expire()
+            continue
+        cli_conn.settimeout(None)
+        set_keepalive(cli_conn)
+        SESSIONS_TOTAL.inc()
+        admission.admit(cli_conn, ip, port)
+
+""" receive connections and run coroutines """
+def runServerAsync(soc, max_sessions=MAX_SESSIONS):
+
+    async def reply_busy_async(session, writer):
+        BUSY_REPLIES.inc(1, ('session',))
+        try:
+            await asyncio.wait_for(session.recv(), BUSY_REPLY_TIMEOUT) # hello
+            writer.write(pack_header(SFTP_DISCRIMINATOR_TOKEN, 1, MsgToSend.SERVER_BUSY.value, 4) + b'busy')
+            await writer.drain()
+        except (OSError, ValueError, EOFError, asyncio.TimeoutError):
+            pass
+        writer.close()
 
-        # if not alive) Collect and remove from thread list
-        for th in threads:
+    async def run_session(reader, writer):
+        set_keepalive(writer.get_extra_info('socket'))
+        session = AsyncSession(reader, writer)
+        SESSIONS_TOTAL.inc()
+        if slots.locked(): # waiting coroutines cost little ; the queue is the semaphore's
+            SESSIONS_QUEUED.inc()
             try:
-                if not th.is_alive():
-                    threads.remove(th)
-                    th.join()
-            except:
+                await asyncio.wait_for(slots.acquire(), ADMISSION_WAIT)
+            except asyncio.TimeoutError:
+                print('[INFO] client at {}:{} refused ; server busy.'.format(session.ip, session.port))
+                await reply_busy_async(session, writer)
+                return
+            finally:
+                SESSIONS_QUEUED.dec()
+        else:
+            await slots.acquire()
+        print('[INFO] client at {}:{} coroutine started.'.format(session.ip, session.port))
+        SESSIONS_ACTIVE.inc()
+        try:
+            await session.run()
+        finally:
+            SESSIONS_ACTIVE.dec()
+            slots.release()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    slots = asyncio.Semaphore(max_sessions)
+    server = loop.run_until_complete(asyncio.start_server(run_session, sock=soc))
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+""" worker processes ; --workers N pre-forked servers on one port """
+STATS_MAX = ('users', 'loaded_at') # the same in every worker ; the largest, not the sum
+
+def merge_stats(reports):
+    # server_stats() of several workers ; numbers add up, strings are the first worker's
+    merged = {}
+    for report in reports:
+        for name, stats in report.items():
+            section = merged.setdefault(name, {})
+            for key, value in stats.items():
+                if key not in section:
+                    section[key] = value
+                elif key in STATS_MAX:
+                    section[key] = max(section[key], value)
+                elif isinstance(value, (int, float)):
+                    section[key] = round(section[key] + value, 6)
+    return merged
+
+def listen_socket(tcpIP, tcpPORT, reuse_port=False, listen=True):
+    soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port: # several sockets on the port ; the kernel spreads connections between the listening ones
+        soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    soc.bind((tcpIP, tcpPORT))
+    if listen:
+        soc.listen(LISTEN_BACKLOG)
+    return soc
+
+class Worker():
+
+    def __init__(self, index, pid, fd):
+        self.index = index
+        self.pid = pid
+        self.fd = fd # read end of its stats pipe ; None once closed
+        self.buf = b''
+        self.started = time.monotonic()
+
+class Supervisor():
+
+    # forks the workers, restarts those that die and merges their stats. serve(index, stats_fd)
+    # runs a worker ; it writes a JSON line of server_stats() to stats_fd on each SIGUSR1
+    # forwarded to it, and a last one when it stops
+    def __init__(self, count, serve):
+        self.count = count
+        self.serve = serve
+        self.workers = {} # pid -> Worker
+        self.reports = {} # worker index -> (time, stats)
+        self.requested = None # SIGUSR1 time ; the merged stats are printed once every worker answered
+        self.stopping = False
+        self.restarts = 0
+
+    def spawn(self, index):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0: # the worker ; never returns
+            os.close(read_fd)
+            for worker in self.workers.values():
+                if worker.fd is not None:
+                    os.close(worker.fd)
+            # Ctrl-C reaches it with the forwarded SIGTERM ; the first one stops it
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+            code = 0
+            try:
+                self.serve(index, write_fd)
+                # like a single server, the sessions running end before the process
+                for thread in threading.enumerate():
+                    if thread is not threading.current_thread() and not thread.daemon:
+                        thread.join()
+            except BaseException as e:
+                traceback.print_exc()
+                code = 1
+            sys.stdout.flush()
+            os._exit(code)
+        os.close(write_fd)
+        self.workers[pid] = Worker(index, pid, read_fd)
+        print('[INFO] worker {} started (pid {})'.format(index, pid))
+
+    def request_stats(self, signum=None, frame=None):
+        # SIGUSR1 ; forwarded to every worker
+        self.requested = time.monotonic()
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except ProcessLookupError:
                 pass
 
+    def stop(self, signum=None, frame=None):
+        # SIGTERM, and SIGINT in a worker ; stops like Ctrl-C, once
+        if self.stopping:
+            return
+        self.stopping = True
+        raise KeyboardInterrupt
+
+    def read_reports(self, worker):
+        data = os.read(worker.fd, 65536)
+        if not data: # the worker is gone ; waitpid tells how
+            os.close(worker.fd)
+            worker.fd = None
+            return
+        worker.buf = worker.buf + data
+        while b'\n' in worker.buf:
+            line, _, worker.buf = worker.buf.partition(b'\n')
+            try:
+                self.reports[worker.index] = (time.monotonic(), json.loads(line.decode()))
+            except ValueError:
+                pass
+
+    def poll(self, timeout):
+        # stats of the workers, then the ones that exited
+        fds = {worker.fd: worker for worker in self.workers.values() if worker.fd is not None}
+        if fds:
+            readable = select.select(list(fds), [], [], timeout)[0]
+        else:
+            time.sleep(timeout)
+            readable = []
+        for fd in readable:
+            self.read_reports(fds[fd])
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            self.exited(pid, status)
+
+    def exited(self, pid, status):
+        worker = self.workers.pop(pid, None)
+        if worker is None:
+            return
+        while worker.fd is not None: # its last stats
+            self.read_reports(worker)
+        if self.stopping:
+            return
+        how = 'signal {}'.format(os.WTERMSIG(status)) if os.WIFSIGNALED(status) \
+            else 'status {}'.format(os.WEXITSTATUS(status))
+        print('[INFO] worker {} (pid {}) exited with {} ; restarting'.format(worker.index, pid, how))
+        self.restarts = self.restarts + 1
+        self.reports.pop(worker.index, None) # a new worker counts from zero
+        if time.monotonic() - worker.started < WORKER_RESTART_DELAY: # no tight loop of failed starts
+            time.sleep(WORKER_RESTART_DELAY)
+        self.spawn(worker.index)
+
+    def merged_stats(self):
+        merged = merge_stats(stats for _, stats in self.reports.values())
+        merged['workers'] = {'running': len(self.workers), 'restarts': self.restarts}
+        return merged
+
+    def run(self):
+
+        signal.signal(signal.SIGTERM, self.stop)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.request_stats)
+        for index in range(self.count):
+            self.spawn(index)
+        try:
+            while True:
+                self.poll(1)
+                if self.requested is not None:
+                    answered = all(self.reports.get(worker.index, (0,))[0] >= self.requested
+                                   for worker in self.workers.values())
+                    if answered or time.monotonic() - self.requested > STATS_WAIT:
+                        self.requested = None
+                        print_stats(merged=self.merged_stats())
+        except KeyboardInterrupt:
+            print('')
+        # the workers finish their sessions and send their last stats ; a second Ctrl-C kills them
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        try:
+            while self.workers:
+                self.poll(1)
+        except KeyboardInterrupt:
+            for pid in list(self.workers):
+                os.kill(pid, signal.SIGKILL)
+        print_stats(merged=self.merged_stats())
+
 """ main """
-def main(tcpIP, tcpPORT):
+def main(tcpIP, tcpPORT, engine='thread', metrics_port=None,
+         max_sessions=MAX_SESSIONS, max_transfers=MAX_TRANSFERS, idle_timeout=IDLE_TIMEOUT,
+         durability=DURABILITY, read_cache_size=READ_CACHE_SIZE,
+         rate_limit=RATE_LIMIT, session_rate_limit=SESSION_RATE_LIMIT, workers=1):
 
     """ init server """
     print("[INFO] server initialize")
@@ -366,26 +2461,130 @@ def main(tcpIP, tcpPORT):
         wr = csv.writer(f)
         wr.writerow([ADMIN_ID, ADMIN_PW])
         f.close()
+    # temp files of uploads a crash interrupted
+    UPLOADS.durability = durability
+    READ_CACHE.max_bytes = read_cache_size
+    SHAPER.defaults = (rate_limit, session_rate_limit)
+    SHAPER.rate, SHAPER.session_rate = rate_limit, session_rate_limit
+    removed = UPLOADS.sweep()
+    for name in os.listdir(SFTP_FOLDER_PATH): # those of the workers of an earlier run
+        if name.startswith(os.path.basename(UPLOAD_JOURNAL_PATH) + '.') and name.rpartition('.')[2].isdigit():
+            removed = removed + UploadJournal(SFTP_FOLDER_PATH + name).sweep()
+    if removed:
+        print("[INFO] removed {} orphaned temp files".format(removed))
 
-    # open socket
-    soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    soc.bind((tcpIP, tcpPORT))
+    # open socket ; with workers and SO_REUSEPORT each of them listens on its own, this one
+    # only holds the port
+    soc = listen_socket(tcpIP, tcpPORT, workers > 1 and REUSE_PORT, not (workers > 1 and REUSE_PORT))
+    REAPER.idle_timeout = idle_timeout
 
     """ run """
-    print("[INFO] server running in {} port {}".format(tcpIP, tcpPORT))
-    runServer(soc)
+    if workers > 1:
+        def serve(index, stats_fd):
+            # in worker index ; its own journal, metrics port and share of the limits
+            def report_stats(signum=None, frame=None):
+                try:
+                    os.write(stats_fd, (json.dumps(server_stats()) + '\n').encode())
+                except OSError: # the supervisor is gone
+                    pass
+            signal.signal(signal.SIGUSR1, report_stats)
+            UPLOADS.path = UPLOAD_JOURNAL_PATH + '.{}'.format(index)
+            removed = UPLOADS.sweep() # left by the worker it replaces
+            if removed:
+                print("[INFO] worker {} removed {} orphaned temp files".format(index, removed))
+            SHAPER.workers = workers
+            if metrics_port is not None:
+                serve_metrics(metrics_port + index)
+            worker_soc = listen_socket(tcpIP, tcpPORT, True) if REUSE_PORT else soc
+            # the session and transfer slots are split between the workers, rounded up
+            sessions, transfers = -(-max_sessions // workers), -(-max_transfers // workers)
+            try:
+                if engine == 'asyncio':
+                    runServerAsync(worker_soc, sessions)
+                else:
+                    runServer(worker_soc, sessions, transfers)
+            except KeyboardInterrupt:
+                pass
+            report_stats()
+
+        if metrics_port is not None:
+            print("[INFO] metrics on http://127.0.0.1:{}-{}/metrics".format(metrics_port, metrics_port + workers - 1))
+        print("[INFO] server running in {} port {} ({} engine, {} workers{})".format(
+            tcpIP, tcpPORT, engine, workers, ', SO_REUSEPORT' if REUSE_PORT else ''))
+        Supervisor(workers, serve).run()
+        sys.exit()
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, print_stats)
+    if metrics_port is not None:
+        serve_metrics(metrics_port)
+        print("[INFO] metrics on http://127.0.0.1:{}/metrics".format(metrics_port))
+    print("[INFO] server running in {} port {} ({} engine)".format(tcpIP, tcpPORT, engine))
+    try:
+        if engine == 'asyncio':
+            runServerAsync(soc, max_sessions)
+        else:
+            runServer(soc, max_sessions, max_transfers)
+    except KeyboardInterrupt:
+        print('')
 
     """ terminate server """
+    print_stats()
     sys.exit()
 
 if __name__ == "__main__":
 
     tcpIP = '0.0.0.0'
     tcpPORT = 2022
+    engine = 'thread'
+    metrics_port = None
+    max_sessions = MAX_SESSIONS
+    max_transfers = MAX_TRANSFERS
+    idle_timeout = IDLE_TIMEOUT
+    durability = DURABILITY
+    read_cache_size = READ_CACHE_SIZE
+    rate_limit = RATE_LIMIT
+    session_rate_limit = SESSION_RATE_LIMIT
+    workers = 1
+
+    opts, args = getopt.gnu_getopt(sys.argv[1:], '', ['engine=', 'metrics-port=', 'max-sessions=',
+                                                      'max-transfers=', 'idle-timeout=', 'durability=',
+                                                      'read-cache=', 'rate-limit=', 'session-rate-limit=',
+                                                      'workers='])
+    for opt, val in opts:
+        if opt == '--engine': # thread (thread per client) or asyncio (coroutine per client)
+            if val not in ('thread', 'asyncio'):
+                print('[ERROR] unknown engine {}'.format(val))
+                sys.exit(1)
+            engine = val
+        elif opt == '--metrics-port': # Prometheus text on 127.0.0.1
+            metrics_port = int(val)
+        elif opt == '--max-sessions': # sessions served at once
+            max_sessions = max(1, int(val))
+        elif opt == '--max-transfers': # get/put/sync transfers at once (thread engine)
+            max_transfers = max(1, int(val))
+        elif opt == '--idle-timeout': # seconds without a command before a session is reaped
+            idle_timeout = max(1, int(val))
+        elif opt == '--durability': # none, file (fsync) or dir (fsync file and directory)
+            if val not in ('none', 'file', 'dir'):
+                print('[ERROR] unknown durability {}'.format(val))
+                sys.exit(1)
+            durability = val
+        elif opt == '--read-cache': # MB of hot files shared by gets ; 0 turns it off
+            read_cache_size = max(0, int(val)) * 1024 * 1024
+        elif opt == '--rate-limit': # bytes/s of all transfers, e.g. 100M ; limits.conf overrides it
+            rate_limit = parse_rate(val)
+        elif opt == '--session-rate-limit': # bytes/s of each session
+            session_rate_limit = parse_rate(val)
+        elif opt == '--workers': # processes accepting on the port, restarted when they die
+            workers = max(1, int(val))
+            if workers > 1 and not hasattr(os, 'fork'):
+                print('[ERROR] --workers needs os.fork')
+                sys.exit(1)
 
-    if len(sys.argv) >= 2 : # PORT option
-        tcpPORT = int(sys.argv[1])
+    if len(args) >= 1 : # PORT option
+        tcpPORT = int(args[0])
 
     print("[INFO] argparse OK")
-    main(tcpIP, tcpPORT)
\ No newline at end of file
+    main(tcpIP, tcpPORT, engine, metrics_port, max_sessions, max_transfers, idle_timeout,
+         durability, read_cache_size, rate_limit, session_rate_limit, workers)
\ No newline at end of file
@@ -0,0 +1,121 @@
+"""
+loopback sessions ; ftp_server.py and ftp_client.py run as they are, on a free port
+"""
+
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import tempfile
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+from ftp_server import MsgToRecv, MsgToSend
+from ftp_client import Client
+
+ADMIN_ID = 'admin'
+ADMIN_PW = 'adminpw'
+CLIENT_TIMEOUT = 120 # seconds ; a session that hangs fails its test instead of the run
+
+class ServerProcess():
+
+    def __init__(self, args=()):
+        self.args = list(args)
+        self.home = tempfile.mkdtemp(prefix='sftp-test-')
+        self.proc = None
+        self.port = None
+
+    def __enter__(self):
+        # a free port, then the server with its own HOME (auth.csv, served files)
+        soc = socket.socket()
+        soc.bind(('127.0.0.1', 0))
+        self.port = soc.getsockname()[1]
+        soc.close()
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.join(REPO, 'ftp_server.py')] + self.args + [str(self.port)],
+            env=dict(os.environ, HOME=self.home), start_new_session=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc):
+        # the whole process group ; nothing it started outlives the test
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.proc.wait()
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    def path(self, *names):
+        return os.path.join(self.home, *names)
+
+    def client(self, local_dir):
+        # logged in within the test's process ; commands go through run_command
+        cli = Client()
+        cli.login('127.0.0.1', self.port, ADMIN_ID, ADMIN_PW)
+        cli.pwd = local_dir
+        return cli
+
+class RawSession():
+
+    # an old-style client speaking v1 frames, so the acks can be held back and counted
+    def __init__(self, port, options):
+        self.conn = socket.create_connection(('127.0.0.1', port))
+        self.conn.settimeout(10)
+        self.pending = b''
+        self.send(MsgToRecv.AUTH_HI, 'hi' + options)
+        self.hello = self.recv()[1].decode()
+        self.send(MsgToRecv.AUTH_ID, ADMIN_ID)
+        self.recv()
+        self.send(MsgToRecv.AUTH_PW, ADMIN_PW)
+        assert self.recv()[0] == MsgToSend.AUTH_SUCCESS.value
+
+    def send(self, msgtype, data=b''):
+        data = data.encode() if isinstance(data, str) else data
+        body = str(msgtype.value).zfill(2).encode() + data
+        self.conn.sendall(b'dg' + str(len(body) + 10).zfill(8).encode() + body)
+
+    def recv_exactly(self, size):
+        while len(self.pending) < size:
+            recved = self.conn.recv(1048576)
+            if not recved:
+                raise ConnectionError('connection closed by peer')
+            self.pending = self.pending + recved
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def recv(self):
+        header = self.recv_exactly(12)
+        return int(header[10:12]), self.recv_exactly(int(header[2:10]) - 12)
+
+    def close(self):
+        self.send(MsgToRecv.CMD_EXIT)
+        self.conn.close()
+
+def run_client(port, commands, local_dir, args=(), password=ADMIN_PW, timeout=CLIENT_TIMEOUT):
+    # the password, then one command per line on stdin ; without a terminal getpass reads stdin
+    result = subprocess.run(
+        [sys.executable, os.path.join(REPO, 'ftp_client.py')] + list(args) +
+        ['{}@127.0.0.1'.format(ADMIN_ID), str(port)],
+        input='\n'.join([password] + list(commands) + ['exit']) + '\n', cwd=local_dir,
+        start_new_session=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True, timeout=timeout)
+    return result.returncode, result.stdout
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
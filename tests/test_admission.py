@@ -0,0 +1,78 @@
+"""
+admission control ; sessions and transfers over the limits wait, then get SERVER_BUSY
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from support import ServerProcess, RawSession, run_client, write_file
+from ftp_server import ADMISSION_WAIT, MsgToRecv, MsgToSend
+
+class SessionLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ServerProcess(['--max-sessions', '1']).__enter__()
+        self.local = tempfile.mkdtemp()
+        self.first = RawSession(self.server.port, '')
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        shutil.rmtree(self.local)
+
+    def test_busy_after_the_wait(self):
+        start = time.monotonic()
+        rc, out = run_client(self.server.port, ['pwd'], self.local)
+        self.assertIn('Server busy', out)
+        self.assertGreater(time.monotonic() - start, ADMISSION_WAIT - 1)
+        self.first.close()
+
+    def test_queued_until_a_slot_frees(self):
+        Thread(target=lambda: (time.sleep(1), self.first.close())).start()
+        rc, out = run_client(self.server.port, ['pwd'], self.local)
+        self.assertEqual(rc, 0, out)
+        self.assertNotIn('Server busy', out)
+        self.assertIn(self.server.home, out)
+
+class TransferLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ServerProcess(['--max-transfers', '1']).__enter__()
+        write_file(self.server.path('f.bin'), os.urandom(1000))
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+
+    def test_old_client_waits(self):
+        # the first get holds the only slot until its next command
+        holder = RawSession(self.server.port, '')
+        holder.send(MsgToRecv.CMD_GET, 'f.bin')
+        self.assertEqual(holder.recv()[0], MsgToSend.GET_PROCEED.value)
+        old = RawSession(self.server.port, '')
+        aware = RawSession(self.server.port, ' busy')
+        aware.conn.settimeout(ADMISSION_WAIT + 5)
+        old.send(MsgToRecv.CMD_GET, 'f.bin')
+        aware.send(MsgToRecv.CMD_GET, 'f.bin')
+        self.assertEqual(aware.recv()[0], MsgToSend.SERVER_BUSY.value)
+
+        # past the wait the old client still has no answer ; it gets the slot once the holder is done
+        old.conn.settimeout(1)
+        with self.assertRaises(socket.timeout):
+            old.recv()
+        holder.send(MsgToRecv.GET_STOP)
+        holder.recv()
+        holder.send(MsgToRecv.CMD_PWD)
+        holder.recv()
+        old.conn.settimeout(10)
+        self.assertEqual(old.recv()[0], MsgToSend.GET_PROCEED.value)
+        for session in (holder, old, aware):
+            session.conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+batch mode ; exit codes of a script run with -b, pipelined gets included
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from support import ServerProcess, write_file, read_file, REPO, ADMIN_ID, ADMIN_PW, CLIENT_TIMEOUT
+from ftp_client import EXIT_OK, EXIT_COMMAND_FAILED, EXIT_BAD_SCRIPT
+
+class Batch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerProcess().__enter__()
+        for name in 'abcd':
+            write_file(cls.server.path(name), os.urandom(100000))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.__exit__(None, None, None)
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.local = os.path.join(self.tmp, 'local')
+        os.mkdir(self.local)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_batch(self, lines):
+        script = os.path.join(self.tmp, 'script')
+        with open(script, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        result = subprocess.run(
+            [sys.executable, os.path.join(REPO, 'ftp_client.py'), '-b', script,
+             '{}@127.0.0.1'.format(ADMIN_ID), str(self.server.port)],
+            env=dict(os.environ, SFTP_PASSWORD=ADMIN_PW), cwd=self.local, stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=CLIENT_TIMEOUT)
+        return result.returncode, result.stdout
+
+    def test_clean_run(self):
+        rc, out = self.run_batch(['# comment', '', 'pwd', 'get a', 'get b', 'get c'])
+        self.assertEqual(rc, EXIT_OK, out)
+        self.assertEqual(sorted(os.listdir(self.local)), ['a', 'b', 'c'])
+        for name in 'abc':
+            self.assertEqual(read_file(os.path.join(self.local, name)), read_file(self.server.path(name)))
+
+    def test_invalid_line(self):
+        # every line is checked first ; nothing runs
+        rc, out = self.run_batch(['get a', 'frobnicate', 'get b'])
+        self.assertEqual(rc, EXIT_BAD_SCRIPT, out)
+        self.assertIn('Invalid command at line 2', out)
+        self.assertEqual(os.listdir(self.local), [])
+
+    def test_failing_get_mid_pipeline(self):
+        # the gets after the missing file were sent ahead ; they are refused, not run
+        rc, out = self.run_batch(['get a', 'get b', 'get missing', 'get c', 'get d', 'pwd'])
+        self.assertEqual(rc, EXIT_COMMAND_FAILED, out)
+        self.assertIn('Batch stopped at line 3', out)
+        self.assertEqual(sorted(os.listdir(self.local)), ['a', 'b'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+message framing ; v1 and v2 headers read back by FrameReader
+"""
+
+import os
+import sys
+import socket
+import unittest
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ftp_protocol import SFTP_DISCRIMINATOR_TOKEN, V2_HEADER, pack_header, FrameReader
+
+class Framing(unittest.TestCase):
+
+    def setUp(self):
+        self.sender, receiver = socket.socketpair()
+        self.reader = FrameReader(receiver, buffer_size=64) # larger bodies are received in place
+        self.receiver = receiver
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def send(self, frames):
+        # from a thread of its own ; bodies larger than the socket buffers block until read
+        def run():
+            self.sender.sendall(b''.join(frames))
+        thread = Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_v1(self):
+        bodies = [b'', b'x', os.urandom(63), os.urandom(64), os.urandom(65), os.urandom(1 << 20)]
+        thread = self.send([pack_header(SFTP_DISCRIMINATOR_TOKEN, 1, idx, len(body)) + body
+                            for idx, body in enumerate(bodies)])
+        for idx, body in enumerate(bodies):
+            self.assertEqual(self.reader.read_frame(), (idx, 0, 0, body))
+        thread.join()
+
+    def test_v2_after_v1(self):
+        # the hello goes in v1 ; both sides switch once v2 is agreed
+        frames = [(16, 0x01, 0, os.urandom(100)), (16, 0, 7, b''), (3, 0x02, 2 ** 32 - 1, os.urandom(3 << 20))]
+        thread = self.send([pack_header(SFTP_DISCRIMINATOR_TOKEN, 1, 1, 2) + b'hi'] +
+                           [pack_header(SFTP_DISCRIMINATOR_TOKEN, 2, msgtype, len(body), flags, stream_id) + body
+                            for msgtype, flags, stream_id, body in frames])
+        self.assertEqual(self.reader.read_frame(), (1, 0, 0, b'hi'))
+        self.reader.proto = 2
+        for frame in frames:
+            self.assertEqual(self.reader.read_frame(), frame)
+        thread.join()
+
+    def test_v1_size_cap(self):
+        with self.assertRaises(ValueError):
+            pack_header(SFTP_DISCRIMINATOR_TOKEN, 1, 16, 99999999)
+        self.assertEqual(len(pack_header(SFTP_DISCRIMINATOR_TOKEN, 2, 16, 99999999)), V2_HEADER.size)
+
+    def test_bad_headers(self):
+        self.sender.sendall(b'xx00000012' + b'16')
+        with self.assertRaises(ValueError):
+            self.reader.read_frame()
+        self.reader = FrameReader(self.receiver)
+        self.reader.proto = 2
+        self.sender.sendall(V2_HEADER.pack(b'xx', 16, 0, 0, 0))
+        with self.assertRaises(ValueError):
+            self.reader.read_frame()
+
+    def test_closed_mid_frame(self):
+        self.sender.sendall(pack_header(SFTP_DISCRIMINATOR_TOKEN, 1, 16, 10) + b'short')
+        self.sender.close()
+        with self.assertRaises(ConnectionError):
+            self.reader.read_frame()
+
+if __name__ == '__main__':
+    unittest.main()
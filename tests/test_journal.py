@@ -0,0 +1,94 @@
+"""
+upload commit ; the journal of temp files, its sweep at start and --durability
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from support import ServerProcess, run_client, write_file, read_file
+from ftp_server import UploadJournal, commit_file, UPLOAD_JOURNAL_PATH
+from ftp_protocol import partial_name
+
+class Journal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'uploads.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def touch(self, name):
+        write_file(os.path.join(self.tmp, name), b'data')
+        return os.path.join(self.tmp, name)
+
+    def test_sweep_removes_leftovers(self):
+        journal = UploadJournal(self.path)
+        journal.sweep()
+        tmp_path = self.touch('.12345678')
+        part_path = self.touch(partial_name('f.bin'))
+        done_path = self.touch('.87654321')
+        for path in (tmp_path, part_path, done_path):
+            journal.begin(path)
+        journal.commit(done_path, os.path.join(self.tmp, 'done.bin'))
+        unjournaled = self.touch('.11111111')
+        # the process dies here ; a new one sweeps what the journal still holds
+        self.assertEqual(UploadJournal(self.path).sweep(), 2)
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['.11111111', 'done.bin', 'uploads.journal'])
+        self.assertEqual(UploadJournal(self.path).sweep(), 0)
+
+    def test_sweep_keeps_other_names(self):
+        # a corrupt or foreign line never removes a file that is not a temp name
+        path = self.touch('data.bin')
+        with open(self.path, 'w') as f:
+            f.write('+' + path + '\n')
+        self.assertEqual(UploadJournal(self.path).sweep(), 0)
+        self.assertTrue(os.path.exists(path))
+
+    def test_commit_file(self):
+        for durability in ('none', 'file', 'dir'):
+            tmp_path = os.path.join(self.tmp, '.12345678')
+            write_file(tmp_path, durability.encode())
+            commit_file(tmp_path, os.path.join(self.tmp, 'f.bin'), durability)
+            self.assertFalse(os.path.exists(tmp_path))
+            self.assertEqual(read_file(os.path.join(self.tmp, 'f.bin')), durability.encode())
+
+class StartupSweep(unittest.TestCase):
+
+    def test_leftovers_removed(self):
+        server = ServerProcess()
+        leftovers = [server.path('.12345678'), server.path('d', partial_name('f.bin'))]
+        for path in leftovers + [server.path('kept.bin')]:
+            write_file(path, b'data')
+        journal_name = os.path.relpath(UPLOAD_JOURNAL_PATH, os.path.expanduser('~')) # under the server's HOME
+        write_file(server.path(journal_name), ''.join('+' + path + '\n' for path in leftovers).encode())
+        with server:
+            for path in leftovers:
+                self.assertFalse(os.path.exists(path), path)
+            self.assertTrue(os.path.exists(server.path('kept.bin')))
+
+class Durability(unittest.TestCase):
+
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+
+    def test_put(self):
+        data = os.urandom(3 * 1048576 + 1)
+        write_file(os.path.join(self.local, 'up.bin'), data)
+        for durability in ('file', 'dir'):
+            with ServerProcess(['--durability', durability]) as server:
+                os.mkdir(server.path('up'))
+                rc, out = run_client(server.port, ['put up.bin up'], self.local)
+                self.assertEqual(rc, 0, out)
+                self.assertEqual(os.listdir(server.path('up')), ['up.bin'])
+                self.assertEqual(read_file(server.path('up', 'up.bin')), data)
+
+if __name__ == '__main__':
+    unittest.main()
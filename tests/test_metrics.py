@@ -0,0 +1,60 @@
+"""
+metrics ; the registry rendered in Prometheus text format
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ftp_server import MetricsRegistry, Counter, Gauge, Histogram
+
+class Exposition(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.transfers = self.registry.add(Counter('t_transfers_total', 'Transfers.', ('cmd', 'result')))
+        self.active = self.registry.add(Gauge('t_active', 'Active.'))
+        self.latency = self.registry.add(Histogram('t_seconds', 'Latency.', ('cmd',), buckets=(0.1, 1.0)))
+        self.registry.add(Counter('t_loads_total', 'Loads.', func=lambda: 7))
+
+    def test_render(self):
+        self.transfers.inc(1, ('get', 'ok'))
+        self.transfers.inc(2, ('get', 'ok'))
+        self.transfers.inc(1, ('put', 'failed'))
+        self.active.inc()
+        self.active.inc()
+        self.active.dec()
+        for value in (0.05, 1.0, 5.0): # a bound counts in its own bucket
+            self.latency.observe(value, ('ls',))
+        self.assertEqual(self.registry.render().split('\n'), [
+            '# HELP t_transfers_total Transfers.',
+            '# TYPE t_transfers_total counter',
+            't_transfers_total{cmd="get",result="ok"} 3',
+            't_transfers_total{cmd="put",result="failed"} 1',
+            '# HELP t_active Active.',
+            '# TYPE t_active gauge',
+            't_active 1',
+            '# HELP t_seconds Latency.',
+            '# TYPE t_seconds histogram',
+            't_seconds_bucket{cmd="ls",le="0.1"} 1',
+            't_seconds_bucket{cmd="ls",le="1.0"} 2',
+            't_seconds_bucket{cmd="ls",le="+Inf"} 3',
+            't_seconds_sum{cmd="ls"} 6.05',
+            't_seconds_count{cmd="ls"} 3',
+            '# HELP t_loads_total Loads.',
+            '# TYPE t_loads_total counter',
+            't_loads_total 7',
+            ''])
+
+    def test_unlabeled_histogram(self):
+        histogram = self.registry.add(Histogram('t_rtt_seconds', 'RTT.', buckets=(0.1,)))
+        histogram.observe(0.2)
+        lines = self.registry.render().split('\n')
+        self.assertIn('t_rtt_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('t_rtt_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('t_rtt_seconds_sum 0.2', lines)
+        self.assertIn('t_rtt_seconds_count 1', lines)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+background transfers ; jobs on their own streams of one connection, run by server channels
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from support import ServerProcess, write_file, read_file
+
+FILE_SIZE = 16 * 1048576 # blocks of both jobs are on the wire at once
+
+class Streams(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerProcess().__enter__()
+        for name in ('a', 'b'):
+            write_file(cls.server.path(name), os.urandom(FILE_SIZE))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.__exit__(None, None, None)
+
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.cli = self.server.client(self.local + '/')
+        self.assertTrue(self.cli.mux)
+        self.stream_ids = [] # of the frames received, in order
+        read_frame = self.cli.reader.read_frame
+        def recording_read_frame():
+            frame = read_frame()
+            self.stream_ids.append(frame[2])
+            return frame
+        self.cli.reader.read_frame = recording_read_frame
+
+    def tearDown(self):
+        self.cli.end_session()
+        shutil.rmtree(self.local)
+
+    def test_interleaved_gets(self):
+        for name in ('a', 'b'):
+            self.assertTrue(self.cli.run_command('get', name, None, {'background': True}))
+        self.assertTrue(self.cli.wait_jobs())
+        for name in ('a', 'b'):
+            self.assertEqual(read_file(os.path.join(self.local, name)), read_file(self.server.path(name)))
+        streams = [stream_id for stream_id in self.stream_ids if stream_id]
+        self.assertEqual(set(streams), {1, 2})
+        switches = sum(1 for prev, cur in zip(streams, streams[1:]) if prev != cur)
+        self.assertGreater(switches, 2, 'the second job waited for the first')
+
+    def test_put_beside_get(self):
+        write_file(os.path.join(self.local, 'c'), os.urandom(FILE_SIZE))
+        self.assertTrue(self.cli.run_command('get', 'a', None, {'background': True}))
+        self.assertTrue(self.cli.run_command('put', 'c', None, {'background': True}))
+        self.assertTrue(self.cli.run_command('pwd', None, None)) # stream 0 is served meanwhile
+        self.assertTrue(self.cli.wait_jobs())
+        self.assertEqual(read_file(os.path.join(self.local, 'a')), read_file(self.server.path('a')))
+        self.assertEqual(read_file(self.server.path('c')), read_file(os.path.join(self.local, 'c')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+read cache ; hits, misses and evictions of ReadCache under a small budget
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ftp_server import ReadCache
+
+class Budget(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = ReadCache(max_bytes=3000, max_file=2000)
+        self.files = []
+
+    def tearDown(self):
+        for f in self.files:
+            f.close()
+        shutil.rmtree(self.tmp)
+
+    def open(self, name, data=None):
+        path = os.path.join(self.tmp, name)
+        if data is not None:
+            with open(path, 'wb') as f:
+                f.write(data)
+        f = open(path, 'rb')
+        self.files.append(f)
+        return f
+
+    def assert_counts(self, hits, misses, evictions):
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (hits, misses, evictions))
+
+    def test_hit_and_miss(self):
+        data = os.urandom(1000)
+        f = self.open('a', data)
+        self.assertEqual(bytes(self.cache.acquire(f)), data)
+        self.assertEqual(bytes(self.cache.acquire(self.open('a'))), data) # a second session's file
+        self.assert_counts(1, 1, 0)
+        self.assertEqual(self.cache.stats()['bytes'], 1000)
+
+    def test_eviction(self):
+        a, b = self.open('a', os.urandom(1000)), self.open('b', os.urandom(1000))
+        self.cache.acquire(a)
+        self.cache.acquire(b)
+        self.cache.acquire(a) # b is now the least recently used
+        self.cache.acquire(self.open('c', os.urandom(1500)))
+        self.assert_counts(1, 3, 1)
+        self.assertEqual(self.cache.stats()['bytes'], 2500)
+        self.cache.acquire(a)
+        self.cache.acquire(b)
+        self.assert_counts(2, 4, 2)
+
+    def test_not_cached(self):
+        # empty files and files over max_file are read per session
+        self.assertIsNone(self.cache.acquire(self.open('empty', b'')))
+        self.assertIsNone(self.cache.acquire(self.open('large', os.urandom(2001))))
+        self.assert_counts(0, 0, 0)
+
+    def test_rewritten_file(self):
+        self.cache.acquire(self.open('a', b'old data'))
+        f = self.open('a', b'new data, longer')
+        self.assertEqual(bytes(self.cache.acquire(f)), b'new data, longer')
+        self.assert_counts(0, 2, 0)
+
+    def test_budget_off(self):
+        self.cache.max_bytes = 0
+        self.assertIsNone(self.cache.acquire(self.open('a', b'data')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+reaper ; idle sessions are closed after --idle-timeout, 'alive' clients are kept
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from support import ServerProcess, RawSession
+from ftp_server import MsgToRecv, MsgToSend
+
+IDLE_TIMEOUT = 1 # seconds ; the reaper scans this often too
+
+class Reaper(unittest.TestCase):
+
+    engine = 'thread'
+
+    def setUp(self):
+        self.server = ServerProcess(['--engine', self.engine, '--idle-timeout', str(IDLE_TIMEOUT)]).__enter__()
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+
+    def assert_closed(self, session):
+        # the session says EXIT_SUCCESS, then the connection ends
+        try:
+            self.assertEqual(session.recv()[0], MsgToSend.EXIT_SUCCESS.value)
+            session.recv()
+        except ConnectionError:
+            return
+        self.fail('session still open')
+
+    def test_idle_session_closed(self):
+        session = RawSession(self.server.port, '')
+        start = time.monotonic()
+        self.assert_closed(session)
+        self.assertGreater(time.monotonic() - start, IDLE_TIMEOUT)
+
+    def test_busy_session_kept(self):
+        session = RawSession(self.server.port, '')
+        for _ in range(6): # a command every half timeout
+            time.sleep(IDLE_TIMEOUT / 2)
+            session.send(MsgToRecv.CMD_PWD)
+            self.assertEqual(session.recv()[0], MsgToSend.PWD_SUCCESS.value)
+        session.close()
+
+    def test_alive_client_survives(self):
+        idle = RawSession(self.server.port, '')
+        alive = RawSession(self.server.port, ' alive')
+        self.assertIn('alive=', alive.hello)
+        self.assert_closed(idle)
+        time.sleep(2 * IDLE_TIMEOUT)
+        alive.send(MsgToRecv.ALIVE_SIGNAL)
+        self.assertEqual(alive.recv()[0], MsgToSend.ALIVE_CHECK.value)
+        alive.send(MsgToRecv.CMD_PWD)
+        self.assertEqual(alive.recv()[0], MsgToSend.PWD_SUCCESS.value)
+        alive.close()
+
+class AsyncioReaper(Reaper):
+
+    engine = 'asyncio'
+
+if __name__ == '__main__':
+    unittest.main()
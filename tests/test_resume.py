@@ -0,0 +1,143 @@
+"""
+resume ; a get or put cut mid-transfer keeps its partial file and continues from its size
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from support import ServerProcess, run_client, write_file, read_file
+from ftp_protocol import DATA_BLOCK_SIZE_V2, partial_name
+
+FILE_SIZE = 2 * DATA_BLOCK_SIZE_V2 + 12345
+CUT_AFTER = DATA_BLOCK_SIZE_V2 + DATA_BLOCK_SIZE_V2 // 2 # bytes ; the cut falls in the second block
+
+class CutProxy():
+
+    # forwards one session to the server and drops it once CUT_AFTER bytes went in one direction
+    def __init__(self, server_port, cut_upload):
+        self.server_port = server_port
+        self.cut_upload = cut_upload
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        client, _ = self.listener.accept()
+        server = socket.create_connection(('127.0.0.1', self.server_port))
+        self.listener.close()
+        upload = Thread(target=self.forward, args=(client, server, self.cut_upload), daemon=True)
+        upload.start()
+        self.forward(server, client, not self.cut_upload)
+
+    def forward(self, src, dst, cut):
+        left = CUT_AFTER
+        try:
+            while not cut or left > 0:
+                data = src.recv(min(65536, left) if cut else 65536)
+                if not data:
+                    break
+                dst.sendall(data)
+                left = left - len(data)
+        except OSError:
+            pass
+        for conn in (src, dst):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class Resume(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerProcess().__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.__exit__(None, None, None)
+
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.data = os.urandom(FILE_SIZE)
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+
+    def cut(self, command, cut_upload):
+        proxy = CutProxy(self.server.port, cut_upload)
+        run_client(proxy.port, [command], self.local)
+
+    def test_get(self):
+        write_file(self.server.path('g.bin'), self.data)
+        part_path = os.path.join(self.local, partial_name('g.bin'))
+        self.cut('get g.bin', False)
+        kept = os.path.getsize(part_path)
+        self.assertTrue(0 < kept < FILE_SIZE, kept)
+        self.assertFalse(os.path.exists(os.path.join(self.local, 'g.bin')))
+
+        rc, out = run_client(self.server.port, ['get g.bin'], self.local)
+        self.assertEqual(rc, 0, out)
+        self.assertIn('Resuming at byte {}'.format(kept), out)
+        self.assertEqual(read_file(os.path.join(self.local, 'g.bin')), self.data)
+        self.assertFalse(os.path.exists(part_path))
+
+    def test_get_source_changed(self):
+        write_file(self.server.path('gc.bin'), self.data)
+        part_path = os.path.join(self.local, partial_name('gc.bin'))
+        self.cut('get gc.bin', False)
+        self.assertTrue(os.path.exists(part_path))
+        st = os.stat(self.server.path('gc.bin'))
+        os.utime(self.server.path('gc.bin'), ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+        rc, out = run_client(self.server.port, ['get gc.bin'], self.local)
+        self.assertEqual(rc, 0, out)
+        self.assertNotIn('Resuming', out)
+        self.assertEqual(read_file(os.path.join(self.local, 'gc.bin')), self.data)
+
+    def test_put(self):
+        write_file(os.path.join(self.local, 'p.bin'), self.data)
+        part_path = self.server.path(partial_name('p.bin'))
+        self.cut('put p.bin', True)
+        kept = wait_for_size(part_path, os.path.join(self.local, 'p.bin'))
+        self.assertTrue(0 < kept < FILE_SIZE, kept)
+        self.assertFalse(os.path.exists(self.server.path('p.bin')))
+
+        rc, out = run_client(self.server.port, ['put p.bin'], self.local)
+        self.assertEqual(rc, 0, out)
+        self.assertIn('Resuming at byte {}'.format(kept), out)
+        self.assertEqual(read_file(self.server.path('p.bin')), self.data)
+        self.assertFalse(os.path.exists(part_path))
+
+    def test_put_source_changed(self):
+        write_file(os.path.join(self.local, 'pc.bin'), self.data)
+        self.cut('put pc.bin', True)
+        part_path = self.server.path(partial_name('pc.bin'))
+        self.assertGreater(wait_for_size(part_path, os.path.join(self.local, 'pc.bin')), 0)
+        self.data = self.data + b'appended'
+        write_file(os.path.join(self.local, 'pc.bin'), self.data)
+
+        rc, out = run_client(self.server.port, ['put pc.bin'], self.local)
+        self.assertEqual(rc, 0, out)
+        self.assertNotIn('Resuming', out)
+        self.assertEqual(read_file(self.server.path('pc.bin')), self.data)
+
+def wait_for_size(path, source_path):
+    # the server notices the cut on its own ; its partial file is final once it has the source's mtime
+    mtime_ns = os.stat(source_path).st_mtime_ns
+    for _ in range(100):
+        if os.path.exists(path) and os.stat(path).st_mtime_ns == mtime_ns:
+            break
+        time.sleep(0.05)
+    return os.path.getsize(path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+rtt1 gets ; the server sends the blocks with its answer, so a get refused on our side
+may already be complete
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from support import ServerProcess
+from ftp_protocol import partial_name
+
+REPLY_TIMEOUT = 10 # seconds ; a client waiting for a reply that never comes fails instead of hanging
+
+class InlineGet(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerProcess().__enter__()
+        for name, size in (('empty', 0), ('small', 10), ('three', 3 * 1048576)):
+            with open(os.path.join(cls.server.home, name), 'wb') as f:
+                f.write(os.urandom(size))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.__exit__(None, None, None)
+
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.cli = self.server.client(self.local + '/')
+        self.cli.conn.settimeout(REPLY_TIMEOUT)
+        self.assertTrue(self.cli.rtt1)
+
+    def tearDown(self):
+        self.cli.end_session()
+        shutil.rmtree(self.local)
+
+    def assert_got(self, name):
+        with open(os.path.join(self.server.home, name), 'rb') as f1, open(os.path.join(self.local, name), 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_get(self):
+        for name in ('empty', 'small', 'three'):
+            self.assertTrue(self.cli.run_command('get', name, None))
+            self.assert_got(name)
+
+    def test_local_failure(self):
+        # the partial file's name is taken by a directory, so the get fails before its first
+        # block ; the session must be left in step for the next command
+        for name in ('empty', 'small', 'three'):
+            part_path = os.path.join(self.local, partial_name(name))
+            os.mkdir(part_path)
+            self.assertFalse(self.cli.run_command('get', name, None))
+            self.assertTrue(os.path.isdir(part_path))
+            os.rmdir(part_path)
+            self.assertTrue(self.cli.run_command('get', name, None))
+            self.assert_got(name)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+parallel get/put ; byte ranges over several connections, renamed at CMD_COMMIT
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from support import ServerProcess, RawSession, run_client, write_file, read_file
+from ftp_server import MsgToRecv, MsgToSend
+from ftp_client import MIN_SEGMENT_SIZE
+from ftp_protocol import pack_fields
+
+class Segments(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerProcess().__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.__exit__(None, None, None)
+
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+
+    def test_put_then_get(self):
+        # two ranges each way ; only the renamed file is left, no temp file
+        data = os.urandom(2 * MIN_SEGMENT_SIZE + 12345)
+        write_file(os.path.join(self.local, 'big.bin'), data)
+        os.mkdir(self.server.path('up'))
+        os.mkdir(os.path.join(self.local, 'down'))
+        rc, out = run_client(self.server.port, ['put big.bin up', 'get up/big.bin down'], self.local, ['-P', '2'])
+        self.assertEqual(rc, 0, out)
+        self.assertEqual(out.count('over 2 connections'), 2, out)
+        self.assertEqual(os.listdir(self.server.path('up')), ['big.bin'])
+        self.assertEqual(read_file(self.server.path('up', 'big.bin')), data)
+        self.assertEqual(os.listdir(os.path.join(self.local, 'down')), ['big.bin'])
+        self.assertEqual(read_file(os.path.join(self.local, 'down', 'big.bin')), data)
+
+    def commit(self, dir_str, file_name, size, action):
+        session = RawSession(self.server.port, ' segments')
+        session.send(MsgToRecv.CMD_COMMIT, pack_fields(dir_str, '12345678', file_name, size, action))
+        msgtype, _ = session.recv()
+        session.close()
+        return msgtype
+
+    def test_commit_relative_dir(self):
+        # the directory is resolved against the session's working directory
+        write_file(self.server.path('rel', '.12345678'), b'12345')
+        self.assertEqual(self.commit('rel', 'r.bin', 5, 'commit'), MsgToSend.COMMIT_SUCCESS.value)
+        self.assertEqual(os.listdir(self.server.path('rel')), ['r.bin'])
+
+    def test_commit_abort_discards_temp_file(self):
+        write_file(self.server.path('abort', '.12345678'), b'12345')
+        self.assertEqual(self.commit('abort', 'a.bin', 5, 'abort'), MsgToSend.COMMIT_FAILURE.value)
+        self.assertEqual(os.listdir(self.server.path('abort')), [])
+
+    def test_commit_short_temp_file(self):
+        write_file(self.server.path('short', '.12345678'), b'1234')
+        self.assertEqual(self.commit('short', 's.bin', 5, 'commit'), MsgToSend.COMMIT_FAILURE.value)
+        self.assertEqual(os.listdir(self.server.path('short')), [])
+
+    def test_commit_missing_dir(self):
+        self.assertEqual(self.commit('missing', 'm.bin', 5, 'commit'), MsgToSend.COMMIT_FAILURE.value)
+        self.assertFalse(os.path.exists(self.server.path('missing')))
+
+if __name__ == '__main__':
+    unittest.main()
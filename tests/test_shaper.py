@@ -0,0 +1,94 @@
+"""
+rate limits ; TokenBucket and the fair share of Shaper.reserve
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ftp_server import RATE_BURST_SEC, LIMITS_CHECK_SEC, TokenBucket, Shaper
+
+class Bucket(unittest.TestCase):
+
+    def test_burst(self):
+        bucket = TokenBucket(1000)
+        bucket.stamp = 0.0
+        self.assertEqual(bucket.reserve(500, 10.0), 0.0) # idle for 10s, saved up RATE_BURST_SEC only
+        self.assertEqual(bucket.tokens, 1000 * RATE_BURST_SEC - 500)
+
+    def test_debt(self):
+        # a block goes while the bucket is out of debt ; the next waits the debt off
+        bucket = TokenBucket(1000)
+        bucket.stamp = 0.0
+        self.assertEqual(bucket.reserve(3000, 0.0), 0.0)
+        self.assertEqual(bucket.reserve(100, 0.0), 3.0)
+        self.assertEqual(bucket.reserve(100, 2.0), 1.1)
+
+class Session():
+
+    def __init__(self, user_table_path, user_info='alice'):
+        self.user_table_path = user_table_path
+        self.user_info = user_info
+        self.bucket = TokenBucket()
+        self.due = 0.0
+
+class FairShare(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.user_table_path = os.path.join(self.tmp, 'auth.csv')
+        self.now = 100.0
+        patcher = mock.patch('time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def shaper(self, rate=0, session_rate=0):
+        return Shaper(rate, session_rate, os.path.join(self.tmp, 'limits.conf'))
+
+    def test_due(self):
+        # each transfer's blocks are due at rate / transfers, independently of the others
+        shaper = self.shaper(1000)
+        s1, s2 = Session(self.user_table_path), Session(self.user_table_path)
+        shaper.start(s1)
+        self.assertEqual([shaper.reserve(s1, 500) for _ in range(3)], [0.0, 0.5, 1.0])
+        shaper.start(s2)
+        self.assertEqual(s1.due, 101.5)
+        self.assertEqual([shaper.reserve(s1, 500), shaper.reserve(s2, 500), shaper.reserve(s2, 500)], [1.5, 0.0, 1.0])
+        self.assertEqual((s1.due, s2.due), (102.5, 102.0))
+        shaper.stop(s2)
+        self.assertEqual(shaper.reserve(s1, 500), 2.5)
+        self.assertEqual(s1.due, 103.0)
+
+    def test_session_and_user_rates(self):
+        with open(self.user_table_path, 'w') as f:
+            f.write('alice,pw,1000\nbob,pw\n')
+        shaper = self.shaper(session_rate=4000)
+        alice, alice2 = Session(self.user_table_path), Session(self.user_table_path)
+        bob = Session(self.user_table_path, 'bob')
+        self.assertEqual(shaper.reserve(alice, 2000), 0.0)
+        self.assertEqual(shaper.reserve(alice2, 500), 2.0) # the user's bucket is shared
+        self.assertEqual(shaper.reserve(bob, 2000), 0.0)
+        self.assertEqual(shaper.reserve(bob, 2000), 0.5) # bob has the session rate only
+        self.assertEqual(shaper.reserve(bob, 2000), 1.0)
+
+    def test_user_rate_changed(self):
+        # user rates are looked up again after LIMITS_CHECK_SEC ; without a table no user is limited
+        shaper = self.shaper()
+        alice = Session(self.user_table_path)
+        self.assertEqual(shaper.reserve(alice, 2000), 0.0)
+        with open(self.user_table_path, 'w') as f:
+            f.write('alice,pw,1000\n')
+        self.assertEqual(shaper.reserve(alice, 2000), 0.0)
+        self.now = self.now + LIMITS_CHECK_SEC
+        self.assertEqual(shaper.reserve(alice, 2000), 0.0)
+        self.assertEqual(shaper.reserve(alice, 2000), 2.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+delta sync ; signatures of a basis, the delta against them and DeltaWriter
+"""
+
+import os
+import sys
+import shutil
+import random
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ftp_protocol import (DELTA_RECORD, sync_block_size, signature_frames, read_signatures, delta_frames,
+                          DeltaWriter)
+
+FRAME_SIZE = 65536
+
+class DeltaRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.basis = os.path.join(self.tmp, 'basis')
+        self.source = os.path.join(self.tmp, 'source')
+        self.result = os.path.join(self.tmp, 'result')
+        self.rand = random.Random(353)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def randbytes(self, n):
+        return self.rand.getrandbits(8 * n).to_bytes(n, 'little') if n else b''
+
+    def write(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def sync(self, block_size):
+        # the receiver's signatures, the sender's delta, the receiver's rebuild
+        table = read_signatures(signature_frames(self.basis, block_size, FRAME_SIZE))
+        writer = DeltaWriter(self.basis, self.result, block_size)
+        with open(self.source, 'rb') as f:
+            for frame in delta_frames(f, table, block_size, FRAME_SIZE):
+                self.assertLessEqual(len(frame), FRAME_SIZE)
+                writer.feed(frame)
+        writer.finish()
+        with open(self.source, 'rb') as f1, open(self.result, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        return writer
+
+    def test_overwritten_spots(self):
+        data = bytearray(self.randbytes(1 << 20))
+        self.write(self.basis, data)
+        for _ in range(10):
+            pos = self.rand.randrange(len(data) - 100)
+            data[pos:pos + 100] = self.randbytes(100)
+        self.write(self.source, data)
+        writer = self.sync(sync_block_size(len(data)))
+        self.assertLess(writer.literal, len(data) // 10)
+
+    def test_insertions_and_append(self):
+        data = self.randbytes(1 << 20)
+        self.write(self.basis, data)
+        changed = data[:1000] + b'inserted' + data[1000:500000] + b'x' + data[500000:] + self.randbytes(5000)
+        self.write(self.source, changed)
+        writer = self.sync(2048)
+        self.assertGreater(writer.copied, len(data) * 9 // 10)
+
+    def test_no_basis(self):
+        self.write(self.source, self.randbytes(100000))
+        writer = self.sync(2048)
+        self.assertEqual(writer.copied, 0)
+        self.assertEqual(writer.literal, 100000)
+
+    def test_empty_and_short_files(self):
+        self.write(self.basis, b'abc')
+        for data in (b'', b'abc', b'abcd'):
+            self.write(self.source, data)
+            self.sync(2048)
+
+    def test_basis_changed(self):
+        data = self.randbytes(100000)
+        self.write(self.basis, data)
+        self.write(self.source, data)
+        table = read_signatures(signature_frames(self.basis, 2048, FRAME_SIZE))
+        self.write(self.basis, data[:50000]) # truncated after the signatures went
+        writer = DeltaWriter(self.basis, self.result, 2048)
+        with self.assertRaises(ValueError):
+            with open(self.source, 'rb') as f:
+                for frame in delta_frames(f, table, 2048, FRAME_SIZE):
+                    writer.feed(frame)
+        writer.abort()
+        self.assertFalse(os.path.exists(self.result))
+
+    def test_wrong_digest(self):
+        self.write(self.source, b'data')
+        with open(self.source, 'rb') as f:
+            frames = b''.join(delta_frames(f, {}, 2048, FRAME_SIZE))
+        end = len(frames) - 16
+        self.assertEqual(frames[end - DELTA_RECORD.size:end - DELTA_RECORD.size + 1], b'E')
+        writer = DeltaWriter(self.basis, self.result, 2048)
+        with self.assertRaises(ValueError):
+            writer.feed(frames[:end] + bytes(16))
+        writer.abort()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+recursive transfers ; tree_frames read back by TreeWriter
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import contextlib
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ftp_protocol import TREE_INLINE_SIZE, TREE_RECORD, tree_frames, TreeWriter
+
+real_scandir = os.scandir
+
+@contextlib.contextmanager
+def sorted_scandir(path):
+    # entries in name order, so the frames are the same on every filesystem
+    with real_scandir(path) as it:
+        yield sorted(it, key=lambda entry: entry.name)
+
+def send_tree(root, block_size):
+    # the frames as they go on the wire ; (file, offset, length) slices read in place
+    for frame in tree_frames(root, block_size):
+        if isinstance(frame, tuple):
+            f, offset, length = frame
+            frame = os.pread(f.fileno(), length, offset)
+        yield frame
+
+class TreeRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        path = os.path.join(self.src, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def receive(self, frames):
+        writer = TreeWriter(self.dst)
+        for frame in frames:
+            self.assertTrue(frame, 'empty frame inside the tree') # it would end the tree
+            writer.feed(frame)
+        writer.finish()
+        return writer
+
+    def assert_same_tree(self):
+        for dir_path, dir_names, file_names in os.walk(self.src):
+            rel_dir = os.path.relpath(dir_path, self.src)
+            for name in dir_names + file_names:
+                src_path = os.path.join(dir_path, name)
+                dst_path = os.path.join(self.dst, rel_dir, name)
+                self.assertTrue(os.path.exists(dst_path), dst_path)
+                if os.path.isfile(src_path):
+                    with open(src_path, 'rb') as f1, open(dst_path, 'rb') as f2:
+                        self.assertEqual(f1.read(), f2.read(), dst_path)
+                self.assertEqual(os.stat(src_path).st_mtime_ns, os.stat(dst_path).st_mtime_ns, dst_path)
+
+    def test_large_file_then_inline_size_file(self):
+        # a large file's 'F' leaves the batch empty ; with blocks of TREE_INLINE_SIZE the
+        # next record never fits, and flushing the empty batch ended the tree there
+        self.write('a.bin', os.urandom(3 * 1048576))
+        self.write('b.bin', os.urandom(TREE_INLINE_SIZE))
+        self.write('c/d.txt', b'after')
+        os.makedirs(os.path.join(self.src, 'e'))
+        with mock.patch('os.scandir', sorted_scandir):
+            writer = self.receive(send_tree(self.src, TREE_INLINE_SIZE))
+        self.assertEqual(writer.files, 3)
+        self.assertEqual(writer.dirs, 3)
+        self.assert_same_tree()
+
+    def test_small_blocks(self):
+        for idx in range(20):
+            self.write('d{}/f{}'.format(idx % 3, idx), os.urandom(idx * 1000))
+        self.write('big', os.urandom(TREE_INLINE_SIZE + 1))
+        writer = self.receive(send_tree(self.src, 4096))
+        self.assertEqual(writer.files, 21)
+        self.assert_same_tree()
+
+    def test_path_outside_root(self):
+        name = b'../escape'
+        record = TREE_RECORD.pack(b'f', 1, 0, len(name)) + name + b'x'
+        writer = TreeWriter(self.dst)
+        with self.assertRaises(ValueError):
+            writer.feed(TREE_RECORD.pack(b'D', 0, 0, 0) + record)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'escape')))
+
+if __name__ == '__main__':
+    unittest.main()
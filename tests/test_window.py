@@ -0,0 +1,96 @@
+"""
+transfer window ; the blocks in flight of get/put and their cumulative acks
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from support import ServerProcess, RawSession, run_client, write_file, read_file
+from ftp_server import DATA_BLOCK_SIZE, TRANSFER_WINDOW, MsgToRecv, MsgToSend
+
+SIZES = {'empty': 0, 'one': 1, 'exact': DATA_BLOCK_SIZE, 'short_last': 3 * DATA_BLOCK_SIZE + 12345}
+
+class Window(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerProcess().__enter__()
+        cls.data = {}
+        for name, size in SIZES.items():
+            cls.data[name] = os.urandom(size)
+            write_file(cls.server.path(name), cls.data[name])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.__exit__(None, None, None)
+
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+
+    def test_window_1_and_8_same_bytes(self):
+        for window in ('1', '8'):
+            local = os.path.join(self.local, 'w' + window)
+            os.mkdir(local)
+            os.mkdir(self.server.path('w' + window))
+            commands = ['get ' + name for name in SIZES]
+            rc, out = run_client(self.server.port, commands, local, ['-w', window])
+            self.assertEqual(rc, 0, out)
+            for name in SIZES:
+                self.assertEqual(read_file(os.path.join(local, name)), self.data[name], (window, name))
+            commands = ['put {} w{}'.format(name, window) for name in SIZES]
+            rc, out = run_client(self.server.port, commands, local, ['-w', window])
+            self.assertEqual(rc, 0, out)
+            for name in SIZES:
+                self.assertEqual(read_file(self.server.path('w' + window, name)), self.data[name], (window, name))
+
+    def test_get_blocks_before_one_cumulative_ack(self):
+        # the 4 blocks of short_last come without an ack in between ; one ack for all ends the get
+        session = RawSession(self.server.port, ' window=8')
+        self.assertIn('window=8', session.hello)
+        session.send(MsgToRecv.CMD_GET, 'short_last')
+        self.assertEqual(session.recv()[0], MsgToSend.GET_PROCEED.value)
+        session.send(MsgToRecv.GET_PROCEED)
+        blocks = [session.recv() for _ in range(4)]
+        self.assertEqual([msgtype for msgtype, _ in blocks], [MsgToSend.GET_DATA.value] * 4)
+        self.assertEqual(len(blocks[-1][1]), 12345)
+        self.assertEqual(b''.join(data for _, data in blocks), self.data['short_last'])
+        session.send(MsgToRecv.GET_PROCEED, '4')
+        self.assertEqual(session.recv(), (MsgToSend.GET_DATA.value, b''))
+        session.close()
+
+    def test_put_acks_count_blocks(self):
+        # blocks sent back to back are acked with the number received so far
+        session = RawSession(self.server.port, ' window=8')
+        os.mkdir(self.server.path('raw'))
+        session.send(MsgToRecv.CMD_PUT, 'raw')
+        self.assertEqual(session.recv()[0], MsgToSend.PUT_PROCEED.value)
+        session.send(MsgToRecv.PUT_PROCEED, 'short_last')
+        self.assertEqual(session.recv(), (MsgToSend.PUT_PROCEED.value, b''))
+        data = self.data['short_last']
+        for offset in range(0, len(data), DATA_BLOCK_SIZE):
+            session.send(MsgToRecv.PUT_DATA, data[offset:offset + DATA_BLOCK_SIZE])
+        acks = [session.recv() for _ in range(4)]
+        self.assertEqual(acks, [(MsgToSend.PUT_PROCEED.value, str(idx).encode()) for idx in range(1, 5)])
+        session.send(MsgToRecv.PUT_DATA)
+        session.close()
+        for _ in range(100):
+            if os.path.exists(self.server.path('raw', 'short_last')):
+                break
+            time.sleep(0.05)
+        self.assertEqual(read_file(self.server.path('raw', 'short_last')), data)
+
+    def test_window_capped_by_server(self):
+        session = RawSession(self.server.port, ' window=1000')
+        self.assertIn('window={}'.format(TRANSFER_WINDOW), session.hello)
+        session.close()
+
+if __name__ == '__main__':
+    unittest.main()